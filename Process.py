@@ -2,112 +2,76 @@ import numpy as np
 import pandas as pd
 import csv
 from lifelines.statistics import logrank_test
+from data import RaggedVisits, HORIZONS
+from feature_store import default_store
+
+
+# 一次读入csv，按病人分组：得到每行所属病人的编号、是该病人的第几次入院以及每个病人的入院次数
+def _group_patient_visits(file, dtype):
+    df = pd.read_csv(file, header=0, sep=',')
+    patient_ids = df.iloc[:, 0].astype(str).values
+    values = df.iloc[:, 2:].values.astype(dtype)
+    _, first_index, inverse = np.unique(patient_ids, return_index=True, return_inverse=True)
+    # 病人按在文件中第一次出现的顺序编号
+    rank = np.empty_like(first_index)
+    rank[np.argsort(first_index)] = np.arange(first_index.shape[0])
+    codes = rank[inverse.reshape(-1)]
+    lengths = np.bincount(codes)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    # 同一病人内部保持原始行序
+    order = np.argsort(codes, kind='stable')
+    visit = np.empty_like(codes)
+    visit[order] = np.arange(codes.shape[0]) - starts[codes[order]]
+    return values, codes, visit, order, lengths
+
+
+# 直接写入预先分配好的 (patients × max_visits × features) 张量
+def pack_patient_visits(file, max_visits=42, dtype=np.int64):
+    """
+    :param file: 每行一次入院记录的csv，第0列为病人id，第1列为入院id，之后为特征或标签
+    :param max_visits: 每个病人padding到的入院次数，None时取最大入院次数；有病人的入院次数超过它时抛出 ValueError
+    :param dtype: 输出张量的类型
+    :return: packed (patients × max_visits × features), lengths (每个病人的入院次数)
+    """
+    values, codes, visit, _, lengths = _group_patient_visits(file, dtype)
+    if max_visits is None:
+        max_visits = int(np.max(lengths))
+    if np.max(lengths) > max_visits:
+        raise ValueError("{} patients have more than {} visits (at most {}), increase max_visits".format(
+            int(np.sum(lengths > max_visits)), max_visits, int(np.max(lengths))))
+    packed = np.zeros(shape=(lengths.shape[0], max_visits, values.shape[1]), dtype=dtype)
+    packed[codes, visit] = values
+    return packed, lengths
+
+
+# 不做padding，按病人顺序拼接所有入院记录
+def pack_patient_visits_ragged(file, dtype=np.int64):
+    values, _, _, order, lengths = _group_patient_visits(file, dtype)
+    return RaggedVisits(values[order], lengths)
 
 
 # 得到数据的feature 并将每个病人数据padding 成 42 次入院记录（2）
 def get_all_patients_features():
     file = 'E:\\survival analysis\\resources\\合并特征值之后的特征.csv'
-    df=pd.read_csv(file,header=0,sep=',',engine='python',usecols=[0])
-    patient_id_list = []
-    for i in df.values:
-        if i not in patient_id_list:
-            for x in i:
-                j = str(x).split(',')
-                patient_id_list += j
-    print(len(patient_id_list))
-    print(patient_id_list)
-
-    with open(file,'r') as myFile:
-        lines = csv.reader(myFile)
-        next(lines, None)
-        i = 0
-        temp = []
-        all_patient_features = []  # 3 dims
-        one_patient_features = [] # 2 dims
-        one_patient_features_arrays = None
-        for line in lines:
-            print(line)
-            patientId = line[0]
-            visitId = line[1]
-            feature = list(map(int,line[2:]))
-            featureArray = np.array(feature)
-            print(featureArray.shape)
-            if patientId != patient_id_list[i]:
-                    i += 1
-                    print(len(all_patient_features))
-                    # allPatientFeatures.append(onePatientFeatures[:-1])
-                    all_patient_features.append(one_patient_features)
-                    one_patient_features_arrays_temp = np.array(one_patient_features)
-                    one_patient_features_arrays = np.pad(one_patient_features_arrays_temp,((0,42-one_patient_features_arrays_temp.shape[0]),(0,0)),'constant')
-                    temp.append(one_patient_features_arrays)
-                    all_patient_features_arrays = np.array(temp)
-                    one_patient_features = []
-                    one_patient_features.append(feature)
-
-                    print(one_patient_features_arrays_temp.shape)
-            else:
-                one_patient_features.append(feature)
-        all_patient_features.append(one_patient_features)   # get all patients features
-        temp.append(one_patient_features_arrays)
-        all_patient_features_arrays = np.array(temp)
-        np.save("allPatientFeatures_merge.npy",all_patient_features_arrays)
-        # allPatientFeaturesArrays = np.dstack((allPatientFeaturesArrays,onePatientFeaturesArrays))
-
-        print(len(all_patient_features))
-        print(all_patient_features)
+    all_patient_features_arrays, lengths = pack_patient_visits(file)
+    default_store().put("allPatientFeatures_merge", all_patient_features_arrays, source=file)
+    print(all_patient_features_arrays.shape)
 
 
 # （3）得到数据的label 并将每个patient visit padding into 42  次入院记录
 def get_all_patients_labels():
     file = 'E:\\survival analysis\\resources\\预处理后的长期纵向数据_标签.csv'
-    df = pd.read_csv(file, header=0, sep=',', engine='python', usecols=[0])
-    patientIdList = []
-    for i in df.values:
-        if i not in patientIdList:
-            for x in i:
-                j = str(x).split(',')
-                patientIdList += j
-    print(len(patientIdList))
-    print(patientIdList)
-    with open(file, 'r') as myFile:
-        lines = csv.reader(myFile)
-        next(lines, None)
-        i = 0
-        temp = []
-        all_patient_labels = []  # 3 dims
-        one_patient_labels = []  # 2 dims
-        all_patient_labels_arrays = None
-        one_patient_labels_arrays = None
-        for line in lines:
-            patientId = line[0]
-            label = list(map(int, line[2:]))
-            labelArray = np.array(label)
-            print(labelArray.shape)
-            if patientId != patientIdList[i]:
-                i += 1
-                print(len(all_patient_labels))
-                # allPatientLabels.append(onePatientLabels[:-1])
-                # onePatientLabelsArraysTemp = np.array(onePatientLabels[:-1])
-                all_patient_labels.append(one_patient_labels)
-                one_patient_labels_arrays_temp = np.array(one_patient_labels)
-                one_patient_labels_arrays = np.pad(one_patient_labels_arrays_temp,
-                                                  ((0, 42 - one_patient_labels_arrays_temp.shape[0]), (0, 0)), 'constant')
-                temp.append(one_patient_labels_arrays)
-                all_patient_labels_arrays = np.array(temp)
-                one_patient_labels = []
-                one_patient_labels.append(label)
-
-                print(one_patient_labels_arrays_temp.shape)
-            else:
-                one_patient_labels.append(label)
-        all_patient_labels.append(one_patient_labels)  # get all patients features
-        temp.append(one_patient_labels_arrays)
-        all_patient_labels_arrays = np.array(temp)
-        np.save("allPatientLabels_merge_1.npy", all_patient_labels_arrays)
-        # allPatientFeaturesArrays = np.dstack((allPatientFeaturesArrays,onePatientFeaturesArrays))
+    all_patient_labels_arrays, lengths = pack_patient_visits(file)
+    default_store().put("allPatientLabels_merge_1", all_patient_labels_arrays, horizon=HORIZONS, source=file)
+    print(all_patient_labels_arrays.shape)
+
 
-        print(len(all_patient_labels))
-        print(all_patient_labels)
+# 保存不padding的特征和标签，供 read_data / pick_5_visit / DataSet 直接使用
+def get_all_patients_ragged():
+    features_file = 'E:\\survival analysis\\resources\\合并特征值之后的特征.csv'
+    labels_file = 'E:\\survival analysis\\resources\\预处理后的长期纵向数据_标签.csv'
+    pack_patient_visits_ragged(features_file).save("allPatientFeatures_merge_ragged.npz")
+    pack_patient_visits_ragged(labels_file).save("allPatientLabels_merge_1_ragged.npz")
 
 
 # （3）将之前的200个特征 去除时间差 心功能一级 心功能二级 心功能三级 心功能四级  改成195个特征
@@ -190,7 +154,7 @@ def get_logistic_labels():
 def get_patient_in_stage():
     stages = np.load("all_patient_stage_ave.npy")
     all_patient_weights = np.load("average_weight.npy")
-    labels =np.load("pick_5_visit_labels_merge_1.npy")[0:2100,:,-1].reshape(-1,5,1)
+    labels = default_store().get("pick_5_visit_labels_merge_1", np.s_[0:2100,:,-1]).reshape(-1,5,1)
     patient_in_stage0 = np.zeros(shape=(0,92),dtype=np.int32)
     patient_in_stage1 = np.zeros(shape=(0,92),dtype=np.int32)
     patient_in_stage2 = np.zeros(shape=(0,92),dtype=np.int32)
@@ -366,7 +330,7 @@ def get_feature_selection():
 
 
 def get_logistic_log_rank():
-    time_real = np.load("pick_5_visit_features_merge_1.npy")[0:2100, :, 0].reshape(-1)
+    time_real = default_store().get("pick_5_visit_features_merge_1", np.s_[0:2100, :, 0]).reshape(-1)
     logistic_file = "E:\\survival analysis\\src\\result_9_16_0\\采用整合特征之后的数据\\2年\\logistic regression\\LogisticRegression 2019-10-14-21-02-15.xls"
     df = pd.read_excel(logistic_file,usecols=['label','pre'])
     label_real = df['label']
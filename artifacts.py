@@ -0,0 +1,67 @@
+import atexit
+import queue
+import threading
+
+
+class ArtifactWriter(object):
+    """
+        在后台线程中依次写出checkpoint、ROC图和结果文件，训练不用等待磁盘和画图。
+        队列有上限，写盘跟不上时 submit 会阻塞；flush 等待已提交的全部写完，之后这些文件才保证存在
+    """
+    def __init__(self, max_pending=16):
+        """
+        :param max_pending: 队列中最多等待写出的任务数
+        """
+        self._tasks = queue.Queue(max_pending)
+        self._errors = []
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        :param fn: 写出文件的函数，参数在调用前不能再被修改
+        """
+        if not self._worker.is_alive():
+            raise RuntimeError("artifact writer is closed")
+        self._tasks.put((fn, args, kwargs))
+
+    def _run(self):
+        while True:
+            task = self._tasks.get()
+            try:
+                if task is None:
+                    return
+                fn, args, kwargs = task
+                fn(*args, **kwargs)
+            except Exception as e:
+                with self._lock:
+                    self._errors.append("{}: {!r}".format(getattr(fn, "__name__", fn), e))
+            finally:
+                self._tasks.task_done()
+
+    def flush(self):
+        # 等待已提交的任务全部完成，有任务失败时抛出 RuntimeError
+        self._tasks.join()
+        with self._lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise RuntimeError("failed to write artifacts: {}".format(errors))
+
+    def close(self):
+        if self._worker.is_alive():
+            self._tasks.put(None)
+            self._worker.join()
+        self.flush()
+
+
+_default_writer = None
+
+
+def default_writer():
+    # 每个进程共用一个 ArtifactWriter，进程退出前写完队列中剩下的任务
+    global _default_writer
+    if _default_writer is None:
+        _default_writer = ArtifactWriter()
+        atexit.register(_default_writer.close)
+    return _default_writer
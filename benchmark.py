@@ -0,0 +1,112 @@
+import time
+import numpy as np
+import tensorflow as tf
+from data import DataSet
+from inference import NumpyAttentionLSTM
+from models import AttentionLSTMModel, SelfAttentionLSTMModel
+
+
+def random_batch(batch_size, time_steps=5, num_features=92):
+    # 第0列为时间，1:93 为0/1特征，与 pick_5_visit_features_merge_1 的前93列相同
+    dynamic_features = np.zeros(shape=(batch_size, time_steps, num_features + 1), dtype=np.float32)
+    dynamic_features[:, :, 0] = np.random.random((batch_size, time_steps))
+    dynamic_features[:, :, 1:] = np.random.randint(0, 2, size=(batch_size, time_steps, num_features))
+    labels = np.random.randint(0, 2, size=(batch_size, time_steps, 1)).astype(np.float32)
+    return dynamic_features, labels
+
+
+def activation_memory(model_class, batch_sizes, time_steps=5, num_features=92, lstm_size=128, repeats=5):
+    """
+    统计不同 batch_size 下一次训练的用时和所有op输出的内存总量
+    :return: {batch_size: (平均用时(秒), 内存(字节))}
+    """
+    model = model_class(time_steps=time_steps, num_features=num_features, lstm_size=lstm_size, n_output=1)
+    model.initialize()
+    result = {}
+    for batch_size in batch_sizes:
+        dynamic_features, labels = random_batch(batch_size, time_steps, num_features)
+        model.train_step_statistics(dynamic_features, labels)
+        elapsed = []
+        activation_bytes = 0
+        for _ in range(repeats):
+            seconds, activation_bytes = model.train_step_statistics(dynamic_features, labels)
+            elapsed.append(seconds)
+        result[batch_size] = (float(np.mean(elapsed)), activation_bytes)
+        print("{}\tbatch_size={}\t{:.4f}s\t{:.2f}MB".format(model.name, batch_size, np.mean(elapsed),
+                                                          activation_bytes / 2.0 ** 20),
+              time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
+    model.close()
+    return result
+
+
+def compare_cell_impl(model_class, batch_size=64, time_steps=5, num_features=92, lstm_size=128, steps=50,
+                      atol=1e-4):
+    """
+    比较 cell_impl="basic" 和 cell_impl="fused" 的训练速度，并检查相同权重下两者的预测是否一致
+    dropout 设为1.0，否则两者的随机 mask 不同
+    :return: {cell_impl: 每秒训练步数}, 预测的最大绝对误差
+    """
+    dynamic_features, labels = random_batch(batch_size, time_steps, num_features)
+    # 随机截断每个病人的就诊次数，检查反向LSTM在变长序列上的结果
+    for i, length in enumerate(np.random.randint(1, time_steps + 1, size=batch_size)):
+        dynamic_features[i, length:] = 0
+    test_set = DataSet(dynamic_features, labels)
+    models = {}
+    for cell_impl in ["basic", "fused"]:
+        models[cell_impl] = model_class(time_steps=time_steps, num_features=num_features, lstm_size=lstm_size,
+                                        n_output=1, dropout=1.0,
+                                        name="{}_{}".format(cell_impl, model_class.__name__), cell_impl=cell_impl)
+        models[cell_impl].initialize()
+    models["fused"].set_weights(models["basic"].get_weights())
+    max_error = float(np.max(np.abs(models["basic"].predict(test_set) - models["fused"].predict(test_set))))
+
+    steps_per_second = {}
+    for cell_impl, model in models.items():
+        feed_dict = model._feed_dict(dynamic_features, labels)
+        model._train_step(feed_dict)
+        start = time.time()
+        for _ in range(steps):
+            model._train_step(feed_dict)
+        steps_per_second[cell_impl] = steps / (time.time() - start)
+        print("{}\tcell_impl={}\tbatch_size={}\t{:.1f} steps/s".format(model_class.__name__, cell_impl, batch_size,
+                                                                     steps_per_second[cell_impl]),
+              time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
+        model.close()
+    print("{}\tmax |basic - fused| = {:.2e}\t{}".format(model_class.__name__, max_error,
+                                                      "OK" if max_error <= atol else "MISMATCH"))
+    return steps_per_second, max_error
+
+
+def compare_numpy_inference(batch_size=256, time_steps=5, num_features=92, lstm_size=128, file="attention_lstm.npz"):
+    """
+    导出 AttentionLSTMModel 的权重，比较 NumpyAttentionLSTM 与图中 _pred、_w_z 的差异和预测用时
+    :return: _pred 的最大绝对误差，_w_z 的最大绝对误差
+    """
+    dynamic_features, labels = random_batch(batch_size, time_steps, num_features)
+    model = AttentionLSTMModel(time_steps=time_steps, num_features=num_features, lstm_size=lstm_size, n_output=1,
+                               dropout=1.0, name="export_AttentionLSTM")
+    model.initialize()
+    engine = model.export_weights(file)
+    feed_dict = model._feed_dict(dynamic_features, labels)
+    start = time.time()
+    pred, w_z = model._sess.run([model._pred, model._w_z], feed_dict=feed_dict)
+    tf_seconds = time.time() - start
+    model.close()
+
+    engine = NumpyAttentionLSTM.load(file)
+    start = time.time()
+    numpy_pred, numpy_w_z = engine.forward(dynamic_features[:, :, 1:93])
+    numpy_seconds = time.time() - start
+    pred_error = float(np.max(np.abs(pred - numpy_pred)))
+    w_z_error = float(np.max(np.abs(w_z - numpy_w_z)))
+    print("tensorflow {:.4f}s\tnumpy {:.4f}s\tmax |pred| error {:.2e}\tmax |w_z| error {:.2e}".format(
+        tf_seconds, numpy_seconds, pred_error, w_z_error))
+    return pred_error, w_z_error
+
+
+if __name__ == '__main__':
+    tf.logging.set_verbosity(tf.logging.ERROR)
+    for model_class in [AttentionLSTMModel, SelfAttentionLSTMModel]:
+        activation_memory(model_class, [16, 64, 256, 1024, 4096])
+        compare_cell_impl(model_class)
+    compare_numpy_inference()
@@ -1,48 +1,137 @@
+import json
+import os
+import queue
+import threading
 import numpy as np
 import pandas as pd
+from feature_store import default_store
 
 
 class DataSet(object):
-    def __init__(self, dynamic_features, labels):
+    def __init__(self, dynamic_features, labels, time_steps=None, index_batching=False, index=None):
+        """
+        :param dynamic_features: padding好的数组，RaggedVisits（取batch时才padding到time_steps），
+                                 或 CompactFeatures（取batch时才展开成float32）
+        :param labels: 同 dynamic_features
+        :param time_steps: RaggedVisits padding到的入院次数
+        :param index_batching: 为True时每个epoch只打乱下标，batch用np.take取到重复使用的buffer中，不再整体拷贝数据
+                               （RaggedVisits 和 CompactFeatures 总是使用这种方式）
+        :param index: 只使用这些样本（如 kfold_indices 给出的一折），不拷贝 dynamic_features/labels
+        """
         self._dynamic_features = dynamic_features
         self._labels = labels
-        self._num_examples = labels.shape[0]
+        self._num_examples = len(labels) if index is None else len(index)
+        self._ragged = isinstance(dynamic_features, RaggedVisits)
+        if self._ragged:
+            self._time_steps = time_steps if time_steps is not None else dynamic_features.shape[1]
+        self._index_batching = False
+        self._subset = index is not None
+        if index_batching or self._subset or self._ragged or isinstance(dynamic_features, CompactFeatures):
+            self.use_index_batching()
+        if self._subset:
+            self._index = np.asarray(index)
+            # _gather 用 mode='clip' 取batch，越界或为负的下标会被截到边界，这里先检查
+            if self._index.ndim != 1 or (self._index.size > 0 and not np.issubdtype(self._index.dtype, np.integer)):
+                raise ValueError("index must be a 1-D integer array")
+            if self._index.size > 0 and (self._index.min() < 0 or self._index.max() >= len(labels)):
+                raise IndexError("index out of range [0, {})".format(len(labels)))
         self._epoch_completed = 0
         self._batch_completed = 0
         self._index_in_epoch = 0
 
+    def use_index_batching(self):
+        # 切换之后 dynamic_features/labels 不再被重新赋值，可以在后台线程取batch的同时读取
+        if not self._index_batching:
+            self._index_batching = True
+            self._index = np.arange(self._num_examples)
+            self._buffers = {}
+
     def next_batch(self, batch_size):
         if batch_size > self._num_examples or batch_size <=0:
-            batch_size = self._labels.shape[0]
+            batch_size = self._num_examples
         if self._batch_completed ==0:
             self._shuffle()
         self._batch_completed += 1
         start = self._index_in_epoch
         if start + batch_size >= self._num_examples:
             self._epoch_completed += 1
-            dynamic_rest_part = self._dynamic_features[start:self._num_examples]
-            label_test_part = self._labels[start:self._num_examples]
+            dynamic_rest_part, label_test_part = self._slice(start, self._num_examples)
             self._shuffle()
             self._index_in_epoch = 0
             return dynamic_rest_part, label_test_part
         else:
             self._index_in_epoch += batch_size
             end = self._index_in_epoch
-            return self._dynamic_features[start:end],self._labels[start:end]
+            return self._slice(start, end)
+
+    def _slice(self, start, end):
+        if self._index_batching:
+            index = self._index[start:end]
+            return self._gather(self._dynamic_features, index, "dynamic_features"), \
+                self._gather(self._labels, index, "labels")
+        return self._dynamic_features[start:end], self._labels[start:end]
+
+    def _gather(self, values, index, name):
+        if isinstance(values, RaggedVisits):
+            return values.pad(self._time_steps, index)
+        if isinstance(values, CompactFeatures):
+            return values.expand(index)
+        # 返回的batch是buffer的视图，下一次next_batch时会被覆盖
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape[0] < index.shape[0]:
+            buffer = np.empty(shape=(index.shape[0],) + values.shape[1:], dtype=values.dtype)
+            self._buffers[name] = buffer
+        # mode='clip' 时 np.take 直接写入 out，不再经过中间buffer；index 的范围已在 __init__ 中检查
+        return np.take(values, index, axis=0, out=buffer[0:index.shape[0]], mode='clip')
 
     def _shuffle(self):
         index = np.arange(self._num_examples)
         np.random.shuffle(index)
+        if self._index_batching:
+            self._index = self._index[index]
+            return
         self._dynamic_features = self._dynamic_features[index]
         self._labels = self._labels[index]
 
+    def chunks(self, chunk_size):
+        """
+        按原始顺序（与 dynamic_features/labels 相同）每次取出 chunk_size 个样本，不展开整个数据集
+        :return: 生成 (dynamic_features, labels)
+        """
+        index = np.sort(self._index) if self._subset else None
+        for start in range(0, self._num_examples, chunk_size):
+            end = min(start + chunk_size, self._num_examples)
+            chunk = np.arange(start, end) if index is None else index[start:end]
+            yield self._take_rows(self._dynamic_features, chunk), self._take_rows(self._labels, chunk)
+
+    def _take_rows(self, values, index):
+        if isinstance(values, RaggedVisits):
+            return values.pad(self._time_steps, index)
+        return take_rows(values, index)
+
+    def _take_all(self, values):
+        # index_batching 模式下返回原始顺序的数据，只使用部分样本时每次按下标取出
+        index = np.sort(self._index) if self._subset else None
+        if isinstance(values, RaggedVisits):
+            return values.pad(self._time_steps, index)
+        if isinstance(values, CompactFeatures):
+            return values.expand(index)
+        if index is not None:
+            return np.take(values, index, axis=0)
+        return values
+
     @property
     def dynamic_features(self):
+        return self._take_all(self._dynamic_features)
+
+    @property
+    def stored_dynamic_features(self):
+        # 不展开、不按下标取出的原始存储（数组、RaggedVisits 或 CompactFeatures）
         return self._dynamic_features
 
     @property
     def labels(self):
-        return self._labels
+        return self._take_all(self._labels)
 
     @property
     def num_examples(self):
@@ -61,56 +150,551 @@ class DataSet(object):
         self._epoch_completed = value
 
 
-def read_data(name):
+class BucketedDataSet(DataSet):
+    """
+        按真实入院次数分桶取batch: 每个epoch在桶内打乱后按长度顺序切分成batch，再打乱batch的顺序，
+        使同一batch中病人的入院次数接近，dynamic_rnn 只需要运行到batch内最长的序列
+    """
+    def __init__(self, dynamic_features, labels, time_steps=None, lengths=None, bucket_width=1):
+        """
+        :param lengths: 每个病人的真实入院次数，None 时由 RaggedVisits 或全零的padding得到
+        :param bucket_width: 入院次数相差在 bucket_width 之内的病人放在同一个桶中
+        """
+        super().__init__(dynamic_features, labels, time_steps, index_batching=True)
+        if lengths is None:
+            if self._ragged:
+                lengths = dynamic_features.lengths
+            else:
+                mask = np.sign(np.max(np.abs(dynamic_features), 2))
+                lengths = np.sum(mask, 1)
+        self._lengths = np.asarray(lengths, dtype=np.int64)
+        if self._ragged:
+            self._lengths = np.minimum(self._lengths, self._time_steps)
+        self._buckets = self._lengths // bucket_width
+        self._batches = []
+        self._real_visits = 0
+        self._padded_visits = 0
+        self._full_padded_visits = 0
+
+    def next_batch(self, batch_size):
+        if batch_size > self._num_examples or batch_size <= 0:
+            batch_size = self._num_examples
+        if self._batch_completed == 0:
+            self._plan_batches(batch_size)
+        self._batch_completed += 1
+        index = self._batches[self._index_in_epoch]
+        self._index_in_epoch += 1
+        self._count_padding(index, batch_size)
+        batch = self._gather(self._dynamic_features, index, "dynamic_features"), \
+            self._gather(self._labels, index, "labels")
+        if self._index_in_epoch >= len(self._batches):
+            self._epoch_completed += 1
+            self._plan_batches(batch_size)
+        return batch
+
+    def _plan_batches(self, batch_size):
+        # 先在桶内打乱（随机的key），再按桶排序，相邻的病人组成一个batch
+        order = np.lexsort((np.random.random(self._num_examples), self._buckets))
+        self._batches = [order[start:start + batch_size] for start in range(0, self._num_examples, batch_size)]
+        np.random.shuffle(self._batches)
+        self._index_in_epoch = 0
+
+    def _count_padding(self, index, batch_size):
+        lengths = self._lengths[index]
+        self._real_visits += int(np.sum(lengths))
+        self._padded_visits += lengths.shape[0] * int(np.max(lengths))
+        # 不分桶时最坏情况下每个batch都要运行到全体病人中最长的序列
+        self._full_padded_visits += lengths.shape[0] * int(np.max(self._lengths))
+
+    def padding_statistics(self):
+        """
+        :return: real_visits 已取batch中的真实入院记录数，padded_visits 按batch内最长序列计算的记录数，
+                 efficiency = real_visits / padded_visits，full_padding_efficiency 为padding到最长序列时的比例
+        """
+        return {"real_visits": self._real_visits,
+                "padded_visits": self._padded_visits,
+                "efficiency": self._real_visits / max(self._padded_visits, 1),
+                "full_padding_efficiency": self._real_visits / max(self._full_padded_visits, 1)}
+
+    @property
+    def lengths(self):
+        return self._lengths
+
+
+def write_shards(dynamic_features, labels, directory, shard_size=10000):
+    """
+    把数据按病人切分成多个npy分片写到 directory 中，供 StreamingDataSet 读取
+    :param dynamic_features: 可以是内存映射的数组，每次只读入一个分片
+    :return: 分片个数
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    shards = []
+    for start in range(0, len(labels), shard_size):
+        end = min(start + shard_size, len(labels))
+        features_file = "shard_{:05d}_features.npy".format(len(shards))
+        labels_file = "shard_{:05d}_labels.npy".format(len(shards))
+        np.save(os.path.join(directory, features_file), np.asarray(dynamic_features[start:end]))
+        np.save(os.path.join(directory, labels_file), np.asarray(labels[start:end]))
+        shards.append({"dynamic_features": features_file, "labels": labels_file, "num_examples": end - start})
+    with open(os.path.join(directory, "shards.json"), 'w') as f:
+        json.dump({"shards": shards}, f, indent=2)
+    return len(shards)
+
+
+class StreamingDataSet(object):
+    """
+        数据保存在磁盘上的多个分片中（见 write_shards），每个epoch打乱分片顺序，每次读入 window_shards 个分片并在窗口内打乱，
+        内存中最多保留一个窗口加一个batch的数据。next_batch / epoch_completed 与 DataSet 相同。
+        只用于训练集，没有 chunks，不能作为 predict 的测试集
+    """
+    def __init__(self, directory, window_shards=2, eval_size=2048):
+        """
+        :param directory: write_shards 写入的目录
+        :param window_shards: 一次读入并打乱的分片个数
+        :param eval_size: dynamic_features/labels 返回的随机样本大小，供训练循环计算loss
+        """
+        self._directory = directory
+        with open(os.path.join(directory, "shards.json"), 'r') as f:
+            self._shards = json.load(f)["shards"]
+        self._window_shards = window_shards
+        self._num_examples = sum(shard["num_examples"] for shard in self._shards)
+        self._epoch_completed = 0
+        self._batch_completed = 0
+        self._shard_order = []
+        self._remaining = 0
+        self._buffer_features = None
+        self._buffer_labels = None
+        self._eval_size = min(eval_size, self._num_examples)
+        self._eval_features = None
+        self._eval_labels = None
+
+    def next_batch(self, batch_size):
+        if batch_size > self._num_examples or batch_size <= 0:
+            batch_size = self._num_examples
+        if self._batch_completed == 0:
+            self._new_epoch()
+        self._batch_completed += 1
+        if self._remaining <= batch_size:
+            self._fill(self._remaining)
+            batch = self._buffer_features, self._buffer_labels
+            self._epoch_completed += 1
+            self._new_epoch()
+            return batch
+        self._fill(batch_size)
+        batch = self._buffer_features[0:batch_size], self._buffer_labels[0:batch_size]
+        self._buffer_features = self._buffer_features[batch_size:]
+        self._buffer_labels = self._buffer_labels[batch_size:]
+        self._remaining -= batch_size
+        return batch
+
+    def _new_epoch(self):
+        self._shard_order = list(np.random.permutation(len(self._shards)))
+        self._remaining = self._num_examples
+        self._buffer_features = None
+        self._buffer_labels = None
+
+    def _fill(self, size):
+        # 缓冲区中的数据不够一个batch时读入下一个窗口
+        while (self._buffer_labels is None or self._buffer_labels.shape[0] < size) and self._shard_order:
+            window = self._shard_order[0:self._window_shards]
+            self._shard_order = self._shard_order[self._window_shards:]
+            features = np.concatenate([self._load(self._shards[i]["dynamic_features"]) for i in window])
+            labels = np.concatenate([self._load(self._shards[i]["labels"]) for i in window])
+            index = np.random.permutation(labels.shape[0])
+            features = features[index]
+            labels = labels[index]
+            if self._buffer_labels is not None:
+                features = np.concatenate((self._buffer_features, features))
+                labels = np.concatenate((self._buffer_labels, labels))
+            self._buffer_features = features
+            self._buffer_labels = labels
+
+    def _load(self, file, mmap_mode=None):
+        return np.load(os.path.join(self._directory, file), mmap_mode=mmap_mode)
+
+    def _load_eval_sample(self):
+        # 从各个分片中按下标读取固定的随机样本，只读入需要的行
+        index = np.sort(np.random.choice(self._num_examples, self._eval_size, replace=False))
+        features = []
+        labels = []
+        start = 0
+        for shard in self._shards:
+            end = start + shard["num_examples"]
+            shard_index = index[(index >= start) & (index < end)] - start
+            if shard_index.shape[0] > 0:
+                features.append(self._load(shard["dynamic_features"], 'r')[shard_index])
+                labels.append(self._load(shard["labels"], 'r')[shard_index])
+            start = end
+        self._eval_features = np.concatenate(features)
+        self._eval_labels = np.concatenate(labels)
+
+    @property
+    def dynamic_features(self):
+        if self._eval_features is None:
+            self._load_eval_sample()
+        return self._eval_features
+
+    @property
+    def labels(self):
+        if self._eval_labels is None:
+            self._load_eval_sample()
+        return self._eval_labels
+
+    @property
+    def num_examples(self):
+        return self._num_examples
+
+    @property
+    def epoch_completed(self):
+        return self._epoch_completed
+
+    @property
+    def batch_completed(self):
+        return self._batch_completed
+
+    @epoch_completed.setter
+    def epoch_completed(self, value):
+        self._epoch_completed = value
+
+    def use_index_batching(self):
+        # 分片数据本身不会被重新赋值，BatchPrefetcher 可以直接使用
+        pass
+
+
+class BatchPrefetcher(object):
+    """
+        在后台线程中提前准备好 n_prefetch 个batch（包括特征切片等 transform），与训练并行。
+        epoch_completed 对应最近一次取出的batch，和直接使用 DataSet.next_batch 时一致
+    """
+    def __init__(self, data_set, batch_size, epochs, transform=None, n_prefetch=4):
+        """
+        :param data_set: DataSet
+        :param batch_size: batch大小
+        :param epochs: data_set.epoch_completed 达到 epochs 之后不再准备新的batch
+        :param transform: transform(dynamic_features, labels)，返回值原样交给训练循环，None 时返回 (dynamic_features, labels)
+        :param n_prefetch: 队列长度，为0时不使用后台线程
+        """
+        self._data_set = data_set
+        self._batch_size = batch_size
+        self._epochs = epochs
+        self._transform = transform
+        self._n_prefetch = n_prefetch
+        self._epoch_completed = data_set.epoch_completed
+        self._queue = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def next_batch(self):
+        if self._n_prefetch <= 0:
+            batch, self._epoch_completed = self._prepare()
+            return batch
+        if self._thread is None:
+            self._start()
+        batch, epoch_completed = self._queue.get()
+        if isinstance(batch, Exception):
+            raise batch
+        self._epoch_completed = epoch_completed
+        return batch
+
+    def _prepare(self):
+        dynamic_features, labels = self._data_set.next_batch(self._batch_size)
+        # index_batching 模式下batch是会被覆盖的buffer，需要拷贝
+        dynamic_features = np.array(dynamic_features)
+        labels = np.array(labels)
+        if self._transform is not None:
+            return self._transform(dynamic_features, labels), self._data_set.epoch_completed
+        return (dynamic_features, labels), self._data_set.epoch_completed
+
+    def _start(self):
+        # 训练循环在取batch的同时会读取 data_set.dynamic_features，需要保证它不被后台线程打乱
+        self._data_set.use_index_batching()
+        self._queue = queue.Queue(maxsize=self._n_prefetch)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def _work(self):
+        try:
+            while not self._stop.is_set() and self._data_set.epoch_completed < self._epochs:
+                self._put(self._prepare())
+        except Exception as e:
+            self._put((e, self._epoch_completed))
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def epoch_completed(self):
+        return self._epoch_completed
+
+
+class CompactFeatures(object):
+    """
+        二值化的特征块以 uint8（或 np.packbits 按位压缩）保存，时间列单独以 float32 保存，
+        只有在取batch时才展开成 float32 的 [time, indicators...]，列的位置与原数组相同
+    """
+    def __init__(self, indicators, num_indicators, time=None, packed=False):
+        self._indicators = indicators
+        self._num_indicators = num_indicators
+        self._time = time
+        self._packed = packed
+
+    @classmethod
+    def from_dense(cls, dynamic_features, time_column=0, packed=False):
+        """
+        :param dynamic_features: (..., features)，除时间列外都是0/1
+        :param time_column: 时间列的位置（只支持第0列或没有时间列），None 表示没有时间列
+        :param packed: 为True时用 np.packbits 按位压缩
+        """
+        if time_column is None:
+            time = None
+            indicators = np.asarray(dynamic_features)
+        elif time_column == 0:
+            time = np.asarray(dynamic_features[..., 0], dtype=np.float32)
+            indicators = np.asarray(dynamic_features[..., 1:])
+        else:
+            raise ValueError("time_column must be 0 or None")
+        if np.any((indicators != 0) & (indicators != 1)):
+            raise ValueError("indicator columns must be binary")
+        num_indicators = indicators.shape[-1]
+        indicators = indicators.astype(np.uint8)
+        if packed:
+            indicators = np.packbits(indicators, axis=-1)
+        return cls(indicators, num_indicators, time, packed)
+
+    def take(self, index):
+        # 选出一部分病人，仍然是压缩的形式
+        time = None if self._time is None else np.take(self._time, index, axis=0)
+        return CompactFeatures(np.take(self._indicators, index, axis=0), self._num_indicators, time, self._packed)
+
+    def expand(self, index=None):
+        indicators = self._indicators if index is None else np.take(self._indicators, index, axis=0)
+        if self._packed:
+            indicators = np.unpackbits(indicators, axis=-1, count=self._num_indicators)
+        if self._time is None:
+            return indicators.astype(np.float32)
+        expanded = np.empty(shape=indicators.shape[:-1] + (self._num_indicators + 1,), dtype=np.float32)
+        expanded[..., 0] = self._time if index is None else np.take(self._time, index, axis=0)
+        expanded[..., 1:] = indicators
+        return expanded
+
+    def __len__(self):
+        return self._indicators.shape[0]
+
+    @property
+    def shape(self):
+        return self._indicators.shape[:-1] + (self._num_indicators + (0 if self._time is None else 1),)
+
+    @property
+    def nbytes(self):
+        return self._indicators.nbytes + (0 if self._time is None else self._time.nbytes)
+
+
+def take_rows(values, index):
+    # 按下标取出一部分样本的稠密数组，CompactFeatures 只展开这些样本
+    if isinstance(values, CompactFeatures):
+        return values.expand(index)
+    return np.take(values, index, axis=0)
+
+
+class RaggedVisits(object):
+    """
+        按病人保存不定长的入院记录: 所有入院记录拼接成一个 (visits × features) 的数组，
+        offsets/lengths 给出每个病人在其中的起始位置和入院次数
+    """
+    def __init__(self, visits, lengths, offsets=None):
+        self._visits = visits
+        self._lengths = np.asarray(lengths, dtype=np.int64)
+        if offsets is None:
+            offsets = np.concatenate(([0], np.cumsum(self._lengths)[:-1]))
+        self._offsets = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_padded(cls, padded, lengths=None):
+        # 没有给出lengths时和模型里的_length()一样，由全零的padding得到入院次数
+        if lengths is None:
+            mask = np.sign(np.max(np.abs(padded), 2))
+            lengths = np.sum(mask, 1).astype(np.int64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        visit_mask = np.arange(padded.shape[1]) < lengths.reshape(-1, 1)
+        return cls(padded[visit_mask], lengths)
+
+    @classmethod
+    def load(cls, file):
+        arrays = np.load(file)
+        return cls(arrays['visits'], arrays['lengths'], arrays['offsets'])
+
+    def save(self, file):
+        np.savez(file, visits=self._visits, lengths=self._lengths, offsets=self._offsets)
+
+    def patient(self, index):
+        # 返回的是 visits 的视图，不发生拷贝
+        start = self._offsets[index]
+        return self._visits[start:start + self._lengths[index]]
+
+    def __getitem__(self, index):
+        return self.patient(index)
+
+    def __len__(self):
+        return self._lengths.shape[0]
+
+    def take(self, index):
+        # 选出一部分病人，共用同一个 visits 数组
+        return RaggedVisits(self._visits, self._lengths[index], self._offsets[index])
+
+    def columns(self, index):
+        # 只保留部分特征列，index 为切片时 visits 仍是视图
+        return RaggedVisits(self._visits[:, index], self._lengths, self._offsets)
+
+    def pad(self, time_steps=None, index=None):
+        """
+        padding 成 (patients × time_steps × features) 的数组，超过 time_steps 的入院记录截掉后面的部分
+        :param time_steps: None 时取最大入院次数
+        :param index: 只 padding 这些病人，None 时为全部病人
+        """
+        if index is None:
+            index = np.arange(self._lengths.shape[0])
+        lengths = self._lengths[index]
+        offsets = self._offsets[index]
+        if time_steps is None:
+            time_steps = int(np.max(lengths)) if lengths.shape[0] > 0 else 0
+        lengths = np.minimum(lengths, time_steps)
+        padded = np.zeros(shape=(lengths.shape[0], time_steps) + self._visits.shape[1:], dtype=self._visits.dtype)
+        rows = np.repeat(np.arange(lengths.shape[0]), lengths)
+        cols = np.arange(rows.shape[0]) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        padded[rows, cols] = self._visits[np.repeat(offsets, lengths) + cols]
+        return padded
+
+    @property
+    def visits(self):
+        return self._visits
+
+    @property
+    def lengths(self):
+        return self._lengths
+
+    @property
+    def offsets(self):
+        return self._offsets
+
+    @property
+    def shape(self):
+        return (self._lengths.shape[0], int(np.max(self._lengths)) if self._lengths.shape[0] > 0 else 0) \
+            + self._visits.shape[1:]
+
+
+def read_data(name, dynamic_features=None, labels=None):
+    # dynamic_features/labels 可以直接传入 RaggedVisits，否则读取padding到42次的npy
+    if dynamic_features is None:
+        dynamic_features = default_store().get("allPatientFeatures1")
+    if labels is None:
+        labels = default_store().get("allPatientLabels1")
     if name == "LogisticRegression":
         # dynamic_features = np.load("logistic_features.npy")
         # labels = np.load("logistic_labels.npy").reshape([-1,1])
-        dynamic_features = np.load("allPatientFeatures1.npy")[0:2100,0:5,:].reshape([-1,200])
-        labels = np.load("allPatientLabels1.npy")[0:2100, :, -1].reshape([-1, 42, 1])[:,0:5,:].reshape([-1,1])
+        if isinstance(dynamic_features, RaggedVisits):
+            dynamic_features = dynamic_features.pad(5, slice(0, 2100))
+            labels = labels.pad(5, slice(0, 2100))
+        dynamic_features = dynamic_features[0:2100,0:5,:].reshape([-1,dynamic_features.shape[2]])
+        labels = labels[0:2100, 0:5, -1].reshape([-1,1])
+    elif isinstance(dynamic_features, RaggedVisits):
+        return DataSet(dynamic_features.take(slice(0, 2100)),
+                       labels.take(slice(0, 2100)).columns(slice(-1, None)), time_steps=5)
     else:
-        dynamic_features = np.load("allPatientFeatures1.npy")
         dynamic_features = dynamic_features[0:2100,0:5,:]
-        labels = np.load("allPatientLabels1.npy")[0:2100,:,-1].reshape([-1,42,1])
+        labels = labels[0:2100,:,-1].reshape([-1,labels.shape[1],1])
         labels = labels[:,0:5,:]
     return DataSet(dynamic_features,labels)
 
 
-# 从全部病人入院记录中平均选择5次记录（特征和标签都是加上最后一次）
-def pick_5_visit():
-    dynamic_fetaures = np.load("allPatientFeatures_merge.npy")[0:2100,:,0:]
-    labels = np.load("allPatientLabels_merge_1.npy")[0:2100, :, :]
-    mask = np.sign(np.max(np.abs(dynamic_fetaures), 2))
-    length = np.sum(mask, 1)
-    new_features = np.zeros(shape=(0, 5, dynamic_fetaures.shape[2]))
-    new_labels = np.zeros(shape=(0, 5, labels.shape[2]))
-    new_stages = np.zeros(shape=(0,5,4))
-    for patient in range(dynamic_fetaures.shape[0]):
-        if length[patient]<6:
-            one_patient_feature = dynamic_fetaures[patient,0:5,:]
-            one_patient_label = labels[patient,0:5,:]
+def visit_index(length, k=5, strategy="bisect"):
+    """
+    一次算出每个病人选取的入院记录下标 (patients × k)，入院次数不超过k的病人取前k次（不足的部分为padding）
+    :param length: 每个病人的入院次数
+    :param k: 每个病人选取的入院次数
+    :param strategy: "bisect" 首末两次加二分点（原来的5次选取方式，只支持k=5），"even" 等间隔，"first" 前k次，"last" 最后k次
+    :return: index (patients × k), valid (patients × k) 下标是否为真实的入院记录
+    """
+    length = np.asarray(length, dtype=np.int64).reshape(-1, 1)
+    steps = np.arange(k).reshape(1, -1)
+    if strategy == "bisect":
+        if k != 5:
+            raise ValueError("strategy 'bisect' only supports k=5")
+        t4 = length - 1
+        t2 = length // 2
+        index = np.hstack((np.zeros_like(length), t2 // 2, t2, (t2 + t4) // 2, t4))
+    elif strategy == "even":
+        index = steps * (length - 1) // max(k - 1, 1)
+    elif strategy == "first":
+        index = np.broadcast_to(steps, (length.shape[0], k))
+    elif strategy == "last":
+        index = length - k + steps
+    else:
+        raise ValueError("unknown strategy: {}".format(strategy))
+    index = np.where(length <= k, steps, index)
+    return index, index < length
+
+
+def _gather_visits(values, index, valid, dtype):
+    # values 为padding好的数组或 RaggedVisits，padding 部分填0
+    if isinstance(values, RaggedVisits):
+        flat_index = values.offsets[0:index.shape[0]].reshape(-1, 1) + np.where(valid, index, 0)
+        gathered = values.visits[flat_index].astype(dtype)
+    else:
+        rows = np.arange(index.shape[0]).reshape(-1, 1)
+        gathered = values[rows, np.minimum(index, values.shape[1] - 1)].astype(dtype)
+    gathered[~valid] = 0
+    return gathered
+
 
+def pick_k_visit(dynamic_fetaures, labels, k=5, strategy="bisect", length=None, dtype=np.float64):
+    """
+    :param dynamic_fetaures: (patients × visits × features) 数组或 RaggedVisits
+    :param labels: (patients × visits × labels) 数组或 RaggedVisits
+    :param length: 每个病人的入院次数，None 时由 RaggedVisits 或全零的padding得到
+    :return: new_features (patients × k × features), new_labels (patients × k × labels)
+    """
+    if length is None:
+        if isinstance(dynamic_fetaures, RaggedVisits):
+            length = dynamic_fetaures.lengths
         else:
-            t0 = 0
-            t4 = length[patient] - 1
-            t2 = int(length[patient] / 2)
-            t1 = int((t0 + t2) / 2)
-            t3 = int((t2 + t4) / 2)
-            t = [t0, t1, t2, t3, t4]
-            one_patient_feature = np.zeros(shape=(0, dynamic_fetaures.shape[2]))
-            one_patient_label = np.zeros(shape=(0, labels.shape[2]))
-            for T in range(5):
-                one_visit_feature = dynamic_fetaures[patient, t[T], :].reshape(-1,dynamic_fetaures.shape[2])
-                one_patient_feature = np.concatenate((one_patient_feature, one_visit_feature))
-                one_visit_label = labels[patient, t[T], :].reshape(-1,labels.shape[2])
-                one_patient_label = np.concatenate((one_patient_label, one_visit_label))
-            print(one_patient_label)
-            print(one_patient_feature)
-        one_patient_fetaure = one_patient_feature.reshape(-1, 5, dynamic_fetaures.shape[2])
-        new_features = np.concatenate((new_features, one_patient_fetaure))
-        one_patient_label = one_patient_label.reshape([-1, 5, labels.shape[2]])
-        new_labels = np.concatenate((new_labels, one_patient_label))
-    np.save("pick_5_visit_features_merge_1.npy", new_features)
-    np.save("pick_5_visit_labels_merge_1.npy", new_labels)
+            mask = np.sign(np.max(np.abs(dynamic_fetaures), 2))
+            length = np.sum(mask, 1)
+    index, valid = visit_index(length, k, strategy)
+    return _gather_visits(dynamic_fetaures, index, valid, dtype), _gather_visits(labels, index, valid, dtype)
+
+
+# 从全部病人入院记录中平均选择5次记录（特征和标签都是加上最后一次）
+def pick_5_visit(dynamic_fetaures=None, labels=None, k=5, strategy="bisect"):
+    # 直接传入数组时源文件未知，不记录 source
+    features_source = "allPatientFeatures_merge.npy" if dynamic_fetaures is None else None
+    labels_source = "allPatientLabels_merge_1.npy" if labels is None else None
+    if dynamic_fetaures is None:
+        dynamic_fetaures = default_store().get("allPatientFeatures_merge")
+    if labels is None:
+        labels = default_store().get("allPatientLabels_merge_1")
+    if isinstance(dynamic_fetaures, RaggedVisits):
+        dynamic_fetaures = dynamic_fetaures.take(slice(0, 2100))
+        labels = labels.take(slice(0, 2100))
+    else:
+        dynamic_fetaures = dynamic_fetaures[0:2100,:,0:]
+        labels = labels[0:2100, :, :]
+    new_features, new_labels = pick_k_visit(dynamic_fetaures, labels, k, strategy)
+    default_store().put("pick_{}_visit_features_merge_1".format(k), new_features, source=features_source)
+    default_store().put("pick_{}_visit_labels_merge_1".format(k), new_labels, horizon=HORIZONS,
+                        source=labels_source)
 
 
 # 将特征去除心功能 和 时间差
@@ -125,30 +709,36 @@ def get_195_features():
     np.save("pick_5_visit_features_195.npy", features_concentrate)
 
 
-def get_pick_data(name):
+# 标签的最后四列依次为 3个月、6个月、1年、2年 是否死亡
+HORIZONS = {"2y": -1, "1y": -2, "6m": -3, "3m": -4}
+
+
+def get_pick_data(name, horizon=None, compact=False):
+    """
+    :param name: 模型名，"LogisticRegression" 时每次入院记录为一个样本
+    :param horizon: 标签列，HORIZONS 中的名字或列号；"all" 时返回全部四个时间窗口的标签（按 HORIZONS 的顺序）；
+                    None 时 LogisticRegression 为3个月，其它模型为1年
+    :param compact: 为True时特征以 CompactFeatures（uint8按位压缩）保存，取batch时才展开
+    """
+    store = default_store()
+    if horizon == "all":
+        columns = list(HORIZONS.values())
+    elif horizon is None:
+        columns = [-4] if name == 'LogisticRegression' else [-2]
+    else:
+        columns = [HORIZONS.get(horizon, horizon)]
     if name == 'LogisticRegression':
-        dynamic_features = np.load("pick_5_visit_features_merge_1.npy")[0:2100,:,1:93].reshape(-1,92)
-        # 2年
-        # labels = np.load("pick_5_visit_labels_merge_1.npy")[0:2100,:,-1].reshape(-1,1)
-        # 1年
-        # labels = np.load("pick_5_visit_labels_merge_1.npy")[0:2100, :, -3].reshape(-1, 1)
-        # 6个月
-        # labels = np.load("pick_5_visit_labels_merge_1.npy")[0:2100, :, -3].reshape(-1, 1)
-        # 3个月
-        labels = np.load("pick_5_visit_labels_merge_1.npy")[0:2100, :, -4].reshape(-1, 1)
+        dynamic_features = store.get("pick_5_visit_features_merge_1", np.s_[0:2100,:,1:93]).reshape(-1,92)
+        labels = store.get("pick_5_visit_labels_merge_1", np.s_[0:2100, :, columns]).reshape(-1, len(columns))
     else:
-        # 2年
-        dynamic_features = np.load("pick_5_visit_features_merge_1.npy")[0:2100,:,0:93]
-        # labels = np.load("pick_5_visit_labels_merge_1.npy")[0:2100,:,-1].reshape(-1,dynamic_fetaures.shape[1],1)
-        # 1年
-        # labels = np.load("pick_5_visit_labels_merge_1.npy")[0:2100, :, -3].reshape(-1, dynamic_features.shape[1], 1)
-        # 6个月
-        # labels = np.load("pick_5_visit_labels_merge.npy")[0:2100, :, -3]
-        # 3个月
-        labels = np.load("pick_5_visit_labels_merge_1.npy")[0:2100, :, -2].reshape(-1,dynamic_features.shape[1],1)
+        dynamic_features = store.get("pick_5_visit_features_merge_1", np.s_[0:2100,:,0:93])
+        labels = store.get("pick_5_visit_labels_merge_1", np.s_[0:2100, :, columns])
         # length = np.reshape(mask,[-1,dynamic_fetaures.shape[1]])
         print(len(np.where(labels.reshape(-1,1) == 1)[0]))
 
+    if compact:
+        time_column = None if name == 'LogisticRegression' else 0
+        dynamic_features = CompactFeatures.from_dense(dynamic_features, time_column, packed=True)
     return DataSet(dynamic_features,labels)
 
 
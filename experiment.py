@@ -1,9 +1,13 @@
+import multiprocessing
 import os
 import jenkspy
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import sklearn
 import time
 import xlwt
+from concurrent.futures import ProcessPoolExecutor
 from lifelines import CoxPHFitter
 from imblearn.over_sampling import SMOTE
 import numpy as np
@@ -12,12 +16,25 @@ from lifelines.utils import k_fold_cross_validation, concordance_index
 from sklearn.cluster import KMeans
 from random_survival_forest import RandomSurvivalForest
 from sklearn.metrics import accuracy_score, roc_auc_score, f1_score, precision_score, recall_score, roc_curve
-from data import get_pick_data, DataSet
-from models import BidirectionalLSTMModel, AttentionLSTMModel, LogisticRegression, SelfAttentionLSTMModel
+from data import get_pick_data, DataSet, HORIZONS, take_rows
+from feature_store import default_store
+from result_cache import default_cache
+from report import write_report, group_feature_frequency
+from artifacts import default_writer
+from models import BidirectionalLSTMModel, AttentionLSTMModel, LogisticRegression, SelfAttentionLSTMModel, \
+    shared_model, set_session_threads, graph_params
 
 
 class ExperimentSetup(object):
     kfold = 5  # 5折交叉验证
+    stratified = False  # 是否按事件分层划分每一折
+    reuse_graph = False  # 为True时同一进程中结构相同的模型只建一次图，各折、各次重复之间只重新初始化变量
+    intra_op_threads = 0  # session 的线程数，0 表示由tensorflow决定
+    inter_op_threads = 0
+    n_workers = 1  # 大于1时各折在进程池中并行训练
+    use_cache = False  # 为True时模型、参数、折和数据都相同的折直接使用 result_cache 中上次的结果
+    compact_features = False  # 为True时特征以 CompactFeatures 保存，每折只展开用到的样本
+    report_format = "csv"  # evaluate 的输出格式："csv"、"npz"、"parquet"，或原来的 "xls"（最多65536行）
     # batch_size = 16
     # hidden_size = 128
     output_n_epochs = 1
@@ -78,72 +95,216 @@ global_rnn_setup = ExperimentSetup(0.001, 0.08, 0.001, 0.001)
 self_rnn_setup = ExperimentSetup(0.01, 0.08, 0.001, 0.001)
 
 
-def split_data_set(dynamic_features, labels):
-    time_steps = dynamic_features.shape[1]
-    num_features = dynamic_features.shape[2]
-    train_dynamic_features = {}
-    train_labels = {}
-    test_dynamic_features = {}
-    test_labels = {}
-    num = int(dynamic_features.shape[0] / 5)
-    for i in range(5):
-        test_dynamic_features[i] = dynamic_features[i * num:(i + 1) * num, :, :].reshape(-1, time_steps, num_features)
-        test_labels[i] = labels[i * num:(i + 1) * num, :, :].reshape(-1, time_steps, 1)
-    train_dynamic_features[0] = dynamic_features[num:5*num, :, :]
-    train_labels[0] = labels[num:5*num, :, :]
-
-    train_dynamic_features[1] = np.vstack((dynamic_features[0:num, :, :], dynamic_features[2*num:5*num, :, :]))
-    train_labels[1] = np.vstack((labels[0:num, :, :], labels[2*num:5*num, :, :]))
-
-    train_dynamic_features[2] = np.vstack((dynamic_features[0:2*num, :, :], dynamic_features[3*num:5*num, :, :]))
-    train_labels[2] = np.vstack((labels[0:2*num, :, :], labels[3*num:5*num, :, :]))
-
-    train_dynamic_features[3] = np.vstack((dynamic_features[0:3*num, :, :], dynamic_features[4*num:5*num, :, :]))
-    train_labels[3] = np.vstack((labels[0:3*num, :, :], labels[4*num:5*num, :, :]))
+def build_model(model_class, reuse_graph=None, **params):
+    # reuse_graph 时从 shared_model 取已经建好的模型，为None时取 ExperimentSetup.reuse_graph
+    set_session_threads(ExperimentSetup.intra_op_threads, ExperimentSetup.inter_op_threads)
+    if reuse_graph is None:
+        reuse_graph = ExperimentSetup.reuse_graph
+    if reuse_graph:
+        return shared_model(model_class, **params)
+    return model_class(**params)
+
+
+# 进程池中每个worker缓存的实验对象，同一个worker上的各折复用数据和模型
+_worker_experiments = {}
+
+
+def _init_worker(settings, threads, counter, n_cores):
+    # spawn 出来的进程不继承主进程中修改过的 ExperimentSetup，这里重新设置
+    for name, value in settings.items():
+        setattr(ExperimentSetup, name, value)
+    ExperimentSetup.n_workers = 1
+    ExperimentSetup.intra_op_threads = threads
+    ExperimentSetup.inter_op_threads = 1
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    # 每个worker固定在自己的一组核上
+    cores = [core % n_cores for core in range(index * threads, (index + 1) * threads)]
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+
+def _fit_fold_in_worker(experiment_class, horizon, setup, train_index, test_index):
+    # setup 不同的实验（如超参数试验）不共用实验对象
+    key = (experiment_class, horizon, setup.all)
+    if key not in _worker_experiments:
+        _worker_experiments[key] = experiment_class(horizon, setup)
+    result = _worker_experiments[key].fit_fold(train_index, test_index)
+    # 主进程只 flush 自己的 ArtifactWriter，返回结果之前先写完本折的checkpoint
+    default_writer().flush()
+    return result
+
+
+def worker_pool(n_workers=None):
+    """
+    训练用的进程池，每个worker有自己的TF session，可用的核平均分给各个worker
+    :param n_workers: 默认为 ExperimentSetup.n_workers
+    """
+    n_workers = n_workers or ExperimentSetup.n_workers
+    n_cores = os.cpu_count()
+    context = multiprocessing.get_context("spawn")
+    settings = {name: getattr(ExperimentSetup, name) for name in ("kfold", "stratified", "output_n_epochs",
+                                                                  "use_cache", "report_format", "compact_features",
+                                                                  "reuse_graph")}
+    return ProcessPoolExecutor(n_workers, mp_context=context, initializer=_init_worker,
+                               initargs=(settings, max(1, n_cores // n_workers), context.Value("i", 0), n_cores))
 
-    train_dynamic_features[4] = dynamic_features[0:4*num, :, :]
-    train_labels[4] = labels[0:4*num, :, :]
 
-    return train_dynamic_features, test_dynamic_features, train_labels, test_labels
+def fold_results(experiment, folds, pool=None):
+    """
+    按折的顺序返回每一折的 (prediction, label)。没有进程池且 n_workers 为1时在本进程中依次训练（逐折返回）
+    """
+    if pool is None and ExperimentSetup.n_workers <= 1:
+        return (experiment.fit_fold(train_index, test_index) for train_index, test_index in folds)
+    own_pool = pool is None
+    if own_pool:
+        pool = worker_pool()
+    futures = submit_folds(experiment, folds, pool)
+    results = [future.result() for future in futures]
+    if own_pool:
+        pool.shutdown()
+    return results
+
+
+def cached_fold(model, setup, data_set, train_index, test_index, fit, horizon=None):
+    """
+    use_cache 时先查 result_cache，没有命中才调用 fit(train_index, test_index) 训练，并把结果和checkpoint存入缓存。
+    命中时把缓存的checkpoint读入 model，之后的 attention 等调用与训练之后相同
+    :return: (prediction, label)
+    """
+    if not ExperimentSetup.use_cache:
+        return fit(train_index, test_index)
+    cache = default_cache()
+    key = cache.key(type(model).__name__, model.name, graph_params(model), repr(horizon), setup.all,
+                    ExperimentSetup.output_n_epochs, train_index, test_index, data_set.stored_dynamic_features,
+                    data_set.labels)
+    result = cache.get(key)
+    checkpoint = cache.checkpoint(key)
+    # 没有checkpoint的条目无法恢复模型，重新训练
+    if result is not None and os.path.exists(checkpoint + ".index"):
+        print("result cache hit:", key)
+        model.load(checkpoint)
+        return result
+    prediction, labels = fit(train_index, test_index)
+    cache.put(key, prediction, labels, model)
+    return prediction, labels
+
+
+def submit_folds(experiment, folds, pool):
+    return [pool.submit(_fit_fold_in_worker, type(experiment), experiment.horizon, experiment._setup,
+                        train_index, test_index)
+            for train_index, test_index in folds]
+
+
+def run_repeats(experiment_class, repeats=5, horizon=None, n_workers=None):
+    """
+    把 repeats 次重复实验的所有折一起提交到进程池，每次重复的结果按折的顺序汇总，与依次运行 do_experiments 相同
+    """
+    experiments = []
+    for i in range(repeats):
+        experiment = experiment_class(horizon)
+        # 各次重复在同一秒内建立时文件名相同
+        experiment.rename(" repeat{}".format(i))
+        experiments.append(experiment)
+    with worker_pool(n_workers) as pool:
+        jobs = [(experiment, experiment.folds()) for experiment in experiments]
+        jobs = [(experiment, folds, submit_folds(experiment, folds, pool)) for experiment, folds in jobs]
+        for experiment, folds, futures in jobs:
+            experiment.summarize(folds, (future.result() for future in futures))
+    default_writer().flush()
+
+
+def kfold_indices(num_examples, kfold=5, events=None, groups=None, shuffle=False, seed=None):
+    """
+    k折交叉验证的下标，不拷贝数据。不分层、不打乱时与原来按顺序切成 kfold 份相同，余下的样本依次分到前几折
+    :param num_examples: 样本个数
+    :param kfold: 折数
+    :param events: 每个样本的标签，给出时按是否发生事件分层，使每折中事件的比例接近
+    :param groups: 每个样本所属的病人，同一病人的样本总在同一折中
+    :param shuffle: 是否打乱分配
+    :param seed: 打乱时的随机种子
+    :return: [(train_index, test_index)]，长度为 kfold
+    """
+    if groups is None:
+        groups = np.arange(num_examples)
+    _, unit_of_row = np.unique(groups, return_inverse=True)
+    unit_of_row = unit_of_row.reshape(-1)
+    num_units = int(np.max(unit_of_row)) + 1
+    random_state = np.random.RandomState(seed)
+    unit_fold = np.zeros(num_units, dtype=np.int64)
+    if events is None:
+        order = random_state.permutation(num_units) if shuffle else np.arange(num_units)
+        num = num_units // kfold
+        if num > 0:
+            unit_fold[order[0:num * kfold]] = np.arange(num * kfold) // num
+        unit_fold[order[num * kfold:]] = np.arange(num_units - num * kfold)
+    else:
+        events = np.asarray(events).reshape(num_examples, -1).max(axis=1)
+        unit_events = np.zeros(num_units)
+        np.maximum.at(unit_events, unit_of_row, events)
+        for value in np.unique(unit_events):
+            members = np.where(unit_events == value)[0]
+            if shuffle:
+                members = random_state.permutation(members)
+            unit_fold[members] = np.arange(members.shape[0]) % kfold
+    row_fold = unit_fold[unit_of_row]
+    return [(np.where(row_fold != i)[0], np.where(row_fold == i)[0]) for i in range(kfold)]
 
 
-def split_logistic_data(dynamic_features, labels):
+def split_data_set(dynamic_features, labels):
+    # 按 kfold_indices 拷贝出每一折的数据，只在需要完整数组时使用
     train_dynamic_features = {}
     train_labels = {}
     test_dynamic_features = {}
     test_labels = {}
-    num = int(dynamic_features.shape[0] / 5)
-
-    for i in range(5):
-        test_dynamic_features[i] = dynamic_features[num*i:num*(i+1), :]
-        test_labels[i] = labels[num*i:num*(i+1), :]
-
-    train_dynamic_features[0] = dynamic_features[num:5*num, :]
-    train_labels[0] = labels[num:5*num, :]
-
-    train_dynamic_features[1] = np.vstack((dynamic_features[2*num:5*num, :], dynamic_features[0:num, :]))
-    train_labels[1] = np.vstack((labels[2*num:5*num, :], labels[0:num, :]))
-
-    train_dynamic_features[2] = np.vstack((dynamic_features[3*num:5*num, :], dynamic_features[0:2*num, :]))
-    train_labels[2] = np.vstack((labels[3*num:5*num, :], labels[0:2*num, :]))
-
-    train_dynamic_features[3] = np.vstack((dynamic_features[4*num:5*num, :], dynamic_features[0:3*num, :]))
-    train_labels[3] = np.vstack((labels[4*num:5*num, :], labels[0:3*num, :]))
+    for i, (train_index, test_index) in enumerate(kfold_indices(dynamic_features.shape[0], ExperimentSetup.kfold)):
+        train_dynamic_features[i] = dynamic_features[train_index]
+        train_labels[i] = labels[train_index]
+        test_dynamic_features[i] = dynamic_features[test_index]
+        test_labels[i] = labels[test_index]
+    return train_dynamic_features, test_dynamic_features, train_labels, test_labels
 
-    train_dynamic_features[4] = dynamic_features[0:4*num, :]
-    train_labels[4] = labels[0:4*num]
 
-    return train_dynamic_features, test_dynamic_features, train_labels, test_labels
+def split_logistic_data(dynamic_features, labels):
+    return split_data_set(dynamic_features, labels)
 
 
-def evaluate(test_index, y_label, y_score, file_name):
+def evaluate(test_index, y_label, y_score, file_name, samples=None):
     """
 
     :param test_index: sample index of the test_set
     :param y_label:  the label of test_set
     :param y_score: the prediction of test_set
     :param file_name: path of the output
+    :param samples: 每次入院记录的特征（与 LogisticRegression 的样本顺序相同），用于统计每组中各特征出现的频率，
+                    为None时按原来的方式通过 get_pick_data 读取
     """
+    y_label = y_label.reshape([-1, 1])
+    y_score = y_score.reshape([-1, 1])
+    auc = roc_auc_score(y_label, y_score)
+    fpr, tpr, thresholds, threshold = plot_roc(y_label, y_score, file_name)
+    # 画图和写文件在 ArtifactWriter 中进行，do_experiments 结束前 flush
+    y_pred_label = (y_score >= threshold) * 1
+    metrics = {"acc": accuracy_score(y_label, y_pred_label),
+               "auc": auc,
+               "recall": recall_score(y_label, y_pred_label),
+               "precision": precision_score(y_label, y_pred_label),
+               "f1-score": f1_score(y_label, y_pred_label),
+               "threshold": threshold}
+    if samples is None:
+        samples = get_pick_data("LogisticRegression").dynamic_features
+    if ExperimentSetup.report_format == "xls":
+        default_writer().submit(write_xls_report, test_index, y_label, y_score, y_pred_label, fpr, tpr, thresholds,
+                                metrics, file_name, samples)
+    else:
+        default_writer().submit(write_report, file_name, test_index, y_label, y_score, y_pred_label, fpr, tpr,
+                                thresholds, metrics, ExperimentSetup.report_format, samples)
+
+
+def write_xls_report(test_index, y_label, y_score, y_pred_label, fpr, tpr, thresholds, metrics, file_name,
+                     all_samples):
+    # 原来逐个单元格写入的xls格式，最多 65536 行
     wb = xlwt.Workbook(file_name + ".xls")
     table = wb.add_sheet('Sheet1')
     table_title = ["test_index", "label", "prob", "pre", " ", "fpr", "tpr", "thresholds", " ", "fp", "tp", "fn", "tn",
@@ -151,91 +312,110 @@ def evaluate(test_index, y_label, y_score, file_name):
                    "acc", "auc", "recall", "precision", "f1-score", "threshold"]
     for i in range(len(table_title)):
         table.write(0, i, table_title[i])
-    y_label = y_label.reshape([-1, 1])
-    y_score = y_score.reshape([-1, 1])
-    auc = roc_auc_score(y_label, y_score)
-    threshold = plot_roc(y_label, y_score, table, table_title, file_name)
-    y_pred_label = (y_score >= threshold) * 1
-    acc = accuracy_score(y_label, y_pred_label)
-    recall = recall_score(y_label, y_pred_label)
-    precision = precision_score(y_label, y_pred_label)
-    f1 = f1_score(y_label, y_pred_label)
+    for i in range(len(fpr)):
+        table.write(i + 1, table_title.index("tpr"), tpr[i])
+        table.write(i + 1, table_title.index("fpr"), fpr[i])
+        table.write(i + 1, table_title.index("thresholds"), float(thresholds[i]))
+    table.write(2, table_title.index("threshold"), float(metrics["threshold"]))
 
     # write metrics
-    table.write(1, table_title.index("auc"), float(auc))
-    table.write(1, table_title.index("acc"), float(acc))
-    table.write(1, table_title.index("recall"), float(recall))
-    table.write(1, table_title.index("precision"), float(precision))
-    table.write(1, table_title.index("f1-score"), float(f1))
-
-    # collect samples of FP,TP,FN,TP and write the result
-    fp_samples = []
-    fn_samples = []
-    tp_samples = []
-    tn_samples = []
+    table.write(1, table_title.index("auc"), float(metrics["auc"]))
+    table.write(1, table_title.index("acc"), float(metrics["acc"]))
+    table.write(1, table_title.index("recall"), float(metrics["recall"]))
+    table.write(1, table_title.index("precision"), float(metrics["precision"]))
+    table.write(1, table_title.index("f1-score"), float(metrics["f1-score"]))
+
+    # write the result of FP,TP,FN,TP
     fp_count = 1
     tp_count = 1
     tn_count = 1
     fn_count = 1
-    all_samples = get_pick_data("LogisticRegression").dynamic_features
     for j in range(len(y_label)):
         if y_label[j] == 0 and y_pred_label[j] == 1:  # FP
             write_result(j, test_index, y_label, y_score, y_pred_label, table,
-                         table_title, all_samples, fp_samples, "fp", fp_count)
+                         table_title, "fp", fp_count)
             fp_count += 1
         if y_label[j] == 0 and y_pred_label[j] == 0:  # TN
-            write_result(j, test_index, y_label, y_score,y_pred_label, table,
-                         table_title, all_samples,tn_samples,"tn",tn_count)
+            write_result(j, test_index, y_label, y_score, y_pred_label, table,
+                         table_title, "tn", tn_count)
             tn_count += 1
         if y_label[j] == 1 and y_pred_label[j] == 0:   # FN
             write_result(j, test_index, y_label, y_score, y_pred_label, table,
-                         table_title, all_samples, fn_samples, "fn", fn_count)
+                         table_title, "fn", fn_count)
             fn_count += 1
         if y_label[j] == 1 and y_pred_label[j] == 1:  # tp
             write_result(j, test_index, y_label, y_score, y_pred_label, table,
-                         table_title, all_samples, tp_samples, "tp", tp_count)
+                         table_title, "tp", tp_count)
             tp_count += 1
     # write frequency statistic
-    # write_frequency(fp_samples,table,table_title,"fp")
-    # write_frequency(fn_samples,table,table_title,"fn")
-    # write_frequency(tp_samples,table,table_title,"tp")
-    # write_frequency(tn_samples,table,table_title,"tn")
+    frequency = group_feature_frequency(all_samples, test_index, y_label, y_pred_label)
+    for group_name in ["fp", "fn", "tp", "tn"]:
+        write_frequency(frequency, table, table_title, group_name)
 
     wb.save(file_name + ".xls")
 
 
-def write_result(j, index, y_label, y_score, y_pred_label, table, table_title, samples_set, samples, group_name, count):
+def evaluate_horizons(test_index, y_label, y_score, file_name, horizons=None, samples=None):
+    """
+    多个时间窗口一起训练时，用同一组prediction分别计算每个时间窗口的指标
+    :param y_label: (..., n_horizons)
+    :param y_score: (..., n_horizons)
+    :param horizons: 每一列对应的时间窗口名，默认按 HORIZONS 的顺序
+    :param samples: 见 evaluate
+    """
+    if horizons is None:
+        horizons = list(HORIZONS.keys())
+    y_label = y_label.reshape([-1, y_label.shape[-1]])
+    y_score = y_score.reshape([-1, y_score.shape[-1]])
+    for k in range(y_label.shape[1]):
+        evaluate(test_index, y_label[:, k], y_score[:, k], file_name + " " + horizons[k], samples)
+
+
+def write_result(j, index, y_label, y_score, y_pred_label, table, table_title, group_name, count):
     table.write(j+1, table_title.index("test_index"), int(index[j]))
     table.write(j+1, table_title.index("label"), int(y_label[j]))
     table.write(j+1, table_title.index("prob"), float(y_score[j]))
     table.write(j+1, table_title.index("pre"), int(y_pred_label[j]))
-    samples.extend(samples_set[index[j]])
     table.write(count, table_title.index(group_name), int(index[j]))
 
 
-def plot_roc(test_labels, test_predictions, table, table_title, file_name):
+def write_frequency(frequency, table, table_title, group_name):
+    # 该组中出现过的特征按出现比例从高到低写入 <组>_words、<组>_freq 两列
+    frequency = frequency[frequency[group_name + "_count"] > 0].sort_values(group_name + "_rate", ascending=False,
+                                                                                kind="mergesort")
+    for i, (feature, rate) in enumerate(zip(frequency["feature"], frequency[group_name + "_rate"])):
+        table.write(i + 1, table_title.index(group_name + "_words"), int(feature))
+        table.write(i + 1, table_title.index(group_name + "_freq"), float(rate))
+
+
+def plot_roc(test_labels, test_predictions, file_name):
+    """
+    计算ROC曲线，图片交给 ArtifactWriter 在后台画出并保存
+    :return: fpr, tpr, thresholds, 使 tpr-fpr 最大的threshold
+    """
     fpr, tpr, thresholds = roc_curve(test_labels, test_predictions, pos_label=1)
     threshold = thresholds[np.argmax(tpr - fpr)]
-    for i in range(len(fpr)):
-        table.write(i + 1, table_title.index("tpr"), tpr[i])
-        table.write(i + 1, table_title.index("fpr"), fpr[i])
-        table.write(i + 1, table_title.index("thresholds"), float(thresholds[i]))
-    table.write(2, table_title.index("threshold"), float(threshold))
+    default_writer().submit(save_roc, fpr, tpr, file_name)
+    return fpr, tpr, thresholds, threshold
+
+
+def save_roc(fpr, tpr, file_name):
+    # 不使用 pyplot 的当前图，可以在后台线程中调用
     auc = "%.3f" % sklearn.metrics.auc(fpr, tpr)
     title = 'ROC Curve, AUC = ' + str(auc)
     with plt.style.context('ggplot'):
-        fig, ax = plt.subplots()
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
         ax.plot(fpr, tpr, "#000099", label='ROC curve')
         ax.plot([0, 1], [0, 1], 'k--', label='Baseline')
-        plt.xlim([0.0, 1.0])
-        plt.ylim([0.0, 1.05])
-        plt.xlabel('False Positive Rate')
-        plt.ylabel('True Positive Rate')
-        plt.legend(loc='lower right')
-        plt.title(title)
-        plt.savefig(file_name + '.png', format='png')
-        plt.close()
-    return threshold
+        ax.set_xlim([0.0, 1.0])
+        ax.set_ylim([0.0, 1.05])
+        ax.set_xlabel('False Positive Rate')
+        ax.set_ylabel('True Positive Rate')
+        ax.legend(loc='lower right')
+        ax.set_title(title)
+        fig.savefig(file_name + '.png', format='png')
 
 
 # TODO: 此方法需要重新修改
@@ -246,6 +426,10 @@ def imbalance_preprocess(train_dynamic, train_y, name):
     :param train_y:
     :return:
     """
+    if train_y.shape[-1] > 1:
+        # 多个时间窗口的标签无法一起过采样
+        print(name, "multi-horizon labels, skip SMOTE")
+        return train_dynamic, train_y
     if name == 'LogisticRegression':
         method = SMOTE(kind="regular",random_state=40)
         print(name)
@@ -264,27 +448,40 @@ def imbalance_preprocess(train_dynamic, train_y, name):
 
 
 class LogisticRegressionExperiment(object):
-    def __init__(self):
-        self._data_set = get_pick_data("LogisticRegression")
-        self._num_features = self._data_set.dynamic_features.shape[1]
+    setup = lr_setup
+
+    def __init__(self, horizon=None, setup=None, reuse_graph=None):
+        """
+        :param setup: ExperimentSetup，默认为类属性 setup
+        :param reuse_graph: 是否使用 shared_model 中的模型，默认为 ExperimentSetup.reuse_graph
+        """
+        self._horizon = horizon
+        self._setup = setup if setup is not None else self.setup
+        self._reuse_graph = ExperimentSetup.reuse_graph if reuse_graph is None else reuse_graph
+        self._data_set = get_pick_data("LogisticRegression", horizon, ExperimentSetup.compact_features)
+        # 数组或 CompactFeatures，各折按下标取出，不展开整个数据集
+        self._dynamic_features = self._data_set.stored_dynamic_features
+        self._labels = self._data_set.labels
+        self._num_features = self._dynamic_features.shape[1]
         self._time_steps = 1
-        self._n_output = 1
+        self._n_output = self._labels.shape[1]
         self._model_format()
         self._check_path()
 
     def _model_format(self):
-        learning_rate, max_loss, max_pace, ridge,batch_size,hidden_size,epoch,dropout = lr_setup.all
-        self._model = LogisticRegression(num_features=self._num_features,
-                                         time_steps=self._time_steps,
-                                         n_output=self._n_output,
-                                         batch_size=batch_size,
-                                         epochs=epoch,
-                                         output_n_epoch=ExperimentSetup.output_n_epochs,
-                                         learning_rate=learning_rate,
-                                         max_loss=max_loss,
-                                         dropout=dropout,
-                                         max_pace=max_pace,
-                                         ridge=ridge)
+        learning_rate, max_loss, max_pace, ridge,batch_size,hidden_size,epoch,dropout = self._setup.all
+        self._model = build_model(LogisticRegression, self._reuse_graph,
+                                  num_features=self._num_features,
+                                  time_steps=self._time_steps,
+                                  n_output=self._n_output,
+                                  batch_size=batch_size,
+                                  epochs=epoch,
+                                  output_n_epoch=ExperimentSetup.output_n_epochs,
+                                  learning_rate=learning_rate,
+                                  max_loss=max_loss,
+                                  dropout=dropout,
+                                  max_pace=max_pace,
+                                  ridge=ridge)
 
     def _check_path(self):
         if not os.path.exists("result_9_16_0"):
@@ -292,55 +489,129 @@ class LogisticRegressionExperiment(object):
         self._filename = "result_9_16_0" + "/" + self._model.name + " " + \
                          time.strftime("%Y-%m-%d-%H-%M-%S", time.localtime())
 
-    def do_experiments(self):
-        n_output = 1
-        dynamic_features = self._data_set.dynamic_features
-        labels = self._data_set.labels
-        # tol_test_index = np.zeros(shape=0, dtype=np.int32)
+    def rename(self, suffix):
+        self._filename += suffix
+
+    def _samples(self):
+        # evaluate 中按入院记录的下标取特征，直接使用内存中的数据
+        return self._data_set.dynamic_features
+
+    @property
+    def model(self):
+        return self._model
+
+    @property
+    def horizon(self):
+        return self._horizon
+
+    def _train_set(self, dynamic_features, labels, train_index):
+        if self._n_output > 1:
+            # 多个时间窗口不做SMOTE，直接按下标使用原数据
+            return DataSet(dynamic_features, labels, index=train_index)
+        # 只展开训练集做SMOTE
+        train_dynamic_res, train_labels_res = imbalance_preprocess(take_rows(dynamic_features, train_index),
+                                                                   labels[train_index],
+                                                                   'LogisticRegression')
+        return DataSet(train_dynamic_res, train_labels_res, index_batching=True)
+
+    def folds(self):
+        labels = self._labels
+        # 每个病人有5次入院记录，同一病人的记录放在同一折中
+        return kfold_indices(labels.shape[0], ExperimentSetup.kfold,
+                             events=labels if ExperimentSetup.stratified else None,
+                             groups=np.arange(labels.shape[0]) // 5)
+
+    def validation_split(self, train_index):
+        """
+        从一折的训练集中再分出一份验证集，选择超参数时在验证集上评价，不使用测试集
+        :return: (train_index, validation_index)，同一病人的记录在同一边
+        """
+        labels = self._labels[train_index]
+        train, validation = kfold_indices(train_index.shape[0], ExperimentSetup.kfold,
+                                          events=labels if ExperimentSetup.stratified else None,
+                                          groups=train_index // 5, shuffle=True, seed=0)[0]
+        return train_index[train], train_index[validation]
+
+    def fit_fold(self, train_index, test_index):
+        return cached_fold(self._model, self._setup, self._data_set, train_index, test_index, self._fit_fold,
+                           self._horizon)
+
+    def _fit_fold(self, train_index, test_index):
+        # 训练一折，返回测试集的 prediction 和 label
+        dynamic_features = self._dynamic_features
+        labels = self._labels
+        train_set = self._train_set(dynamic_features, labels, train_index)
+        test_set = DataSet(dynamic_features, labels, index=test_index)
+        self._model.fit(train_set, test_set)
+        return self._model.predict(test_set), test_set.labels
+
+    def do_experiments(self, pool=None):
+        folds = self.folds()
+        self.summarize(folds, fold_results(self, folds, pool))
+        # 等待checkpoint、ROC图和结果文件全部写完
+        default_writer().flush()
+
+    def summarize(self, folds, results):
+        """
+        :param folds: folds() 的结果
+        :param results: 按折的顺序给出的 (prediction, label)
+        """
+        n_output = self._n_output
+        tol_test_index = np.zeros(shape=0, dtype=np.int64)
         tol_pred = np.zeros(shape=(0, n_output))
         tol_label = np.zeros(shape=(0, n_output), dtype=np.int32)
-        train_dynamic_features, test_dynamic_features, train_labels, test_labels = \
-            split_logistic_data(dynamic_features,labels)
-        for i in range(5):
-            train_dynamic_res, train_labels_res = imbalance_preprocess(train_dynamic_features[i], train_labels[i],
-                                                                       'LogisticRegression')
-            train_set = DataSet(train_dynamic_res, train_labels_res)
-            test_set = DataSet(test_dynamic_features[i].reshape(-1,92), test_labels[i].reshape(-1,1))
-            self._model.fit(train_set, test_set)
-            y_score = self._model.predict(test_set)
+        for i, ((train_index, test_index), (y_score, test_labels)) in enumerate(zip(folds, results)):
             tol_pred = np.vstack((tol_pred, y_score))
-            tol_label = np.vstack((tol_label, test_labels[i]))
-            print("Cross validation: {} of {}".format(i, 5),
+            tol_label = np.vstack((tol_label, test_labels))
+            tol_test_index = np.concatenate((tol_test_index, test_index))
+            print("Cross validation: {} of {}".format(i, ExperimentSetup.kfold),
                   time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
 
-        tol_test_index = np.arange(labels.shape[0] * labels.shape[1])
-        evaluate(tol_test_index, tol_label, tol_pred, self._filename)
-        self._model.close()
+        if n_output > 1:
+            evaluate_horizons(tol_test_index, tol_label, tol_pred, self._filename, samples=self._samples())
+        else:
+            evaluate(tol_test_index, tol_label, tol_pred, self._filename, self._samples())
+        if not self._reuse_graph:
+            self._model.close()
 
 
 class BidirectionalLSTMExperiments(object):
-    def __init__(self):
-        self._data_set = get_pick_data("BidirectionalLSTM")
-        self._num_features = self._data_set.dynamic_features.shape[2]-1
-        self._time_steps = self._data_set.dynamic_features.shape[1]
-        self._n_output = 1
+    setup = bi_lstm_setup
+
+    def __init__(self, horizon=None, setup=None, reuse_graph=None):
+        """
+        :param horizon: 见 get_pick_data，"all" 时用一个 n_output=4 的模型同时训练全部时间窗口
+        :param setup: ExperimentSetup，默认为类属性 setup
+        :param reuse_graph: 是否使用 shared_model 中的模型，默认为 ExperimentSetup.reuse_graph
+        """
+        self._horizon = horizon
+        self._setup = setup if setup is not None else self.setup
+        self._reuse_graph = ExperimentSetup.reuse_graph if reuse_graph is None else reuse_graph
+        self._data_set = get_pick_data("BidirectionalLSTM", horizon, ExperimentSetup.compact_features)
+        # 数组或 CompactFeatures，各折按下标取出，不展开整个数据集
+        self._dynamic_features = self._data_set.stored_dynamic_features
+        self._labels = self._data_set.labels
+        self._num_features = self._dynamic_features.shape[2]-1
+        self._time_steps = self._dynamic_features.shape[1]
+        self._n_output = self._labels.shape[2]
         self._model_format()
         self._check_path()
 
     def _model_format(self):
-        learning_rate, max_loss, max_pace, ridge,batch_size,hidden_size,epochs,dropout = bi_lstm_setup.all
-        self._model = BidirectionalLSTMModel(time_steps=self._time_steps,
-                                             num_features=self._num_features,
-                                             lstm_size=hidden_size,
-                                             n_output=self._n_output,
-                                             batch_size=batch_size,
-                                             epochs=epochs,
-                                             output_n_epoch=ExperimentSetup.output_n_epochs,
-                                             learning_rate=learning_rate,
-                                             max_loss=max_loss,
-                                             dropout=dropout,
-                                             max_pace=max_pace,
-                                             ridge=ridge)
+        learning_rate, max_loss, max_pace, ridge,batch_size,hidden_size,epochs,dropout = self._setup.all
+        self._model = build_model(BidirectionalLSTMModel, self._reuse_graph,
+                                  time_steps=self._time_steps,
+                                  num_features=self._num_features,
+                                  lstm_size=hidden_size,
+                                  n_output=self._n_output,
+                                  batch_size=batch_size,
+                                  epochs=epochs,
+                                  output_n_epoch=ExperimentSetup.output_n_epochs,
+                                  learning_rate=learning_rate,
+                                  max_loss=max_loss,
+                                  dropout=dropout,
+                                  max_pace=max_pace,
+                                  ridge=ridge)
 
     def _check_path(self):
         if not os.path.exists("result_9_16_0"):
@@ -348,49 +619,114 @@ class BidirectionalLSTMExperiments(object):
         self._filename = "result_9_16_0" + "/" + self._model.name + " " + time.strftime( "%Y-%m-%d-%H-%M-%S",
                                                                                          time.localtime())
 
-    def do_experiments(self):
-        n_output=1
+    def rename(self, suffix):
+        self._filename += suffix
+
+    def _samples(self):
+        # 与 LogisticRegression 的样本相同：每次入院记录一行，去掉第0列的时间
         dynamic_features = self._data_set.dynamic_features
-        labels = self._data_set.labels
-        # tol_test_index = np.zeros(shape=0, dtype=np.int32)
-        tol_pred = np.zeros(shape=(0, dynamic_features.shape[1],n_output))
-        tol_label = np.zeros(shape=(0, dynamic_features.shape[1],n_output), dtype=np.int32)
-        train_dynamic_features, test_dynamic_features, train_labels, test_labels = split_data_set(dynamic_features,
-                                                                                                  labels)
-        for i in range(5):
-            train_dynamic_res, train_labels_res = imbalance_preprocess(train_dynamic_features[i],train_labels[i],'lstm')
-            train_set = DataSet(train_dynamic_res, train_labels_res)
-            # train_set = DataSet(train_dynamic_features[i],train_labels[i])
-            test_set = DataSet(test_dynamic_features[i],test_labels[i])
-            self._model.fit(train_set, test_set)
-            y_score = self._model.predict(test_set)
+        return dynamic_features[:, :, 1:].reshape(-1, dynamic_features.shape[2] - 1)
+
+    @property
+    def model(self):
+        return self._model
+
+    @property
+    def horizon(self):
+        return self._horizon
+
+    def _train_set(self, dynamic_features, labels, train_index):
+        if self._n_output > 1:
+            # 多个时间窗口不做SMOTE，直接按下标使用原数据
+            return DataSet(dynamic_features, labels, index=train_index)
+        # 只展开训练集做SMOTE
+        train_dynamic_res, train_labels_res = imbalance_preprocess(take_rows(dynamic_features, train_index),
+                                                                   labels[train_index],
+                                                                   'lstm')
+        return DataSet(train_dynamic_res, train_labels_res, index_batching=True)
+
+    def folds(self):
+        labels = self._labels
+        return kfold_indices(labels.shape[0], ExperimentSetup.kfold,
+                             events=labels if ExperimentSetup.stratified else None)
+
+    def validation_split(self, train_index):
+        """
+        从一折的训练集中再分出一份验证集，选择超参数时在验证集上评价，不使用测试集
+        :return: (train_index, validation_index)
+        """
+        labels = self._labels[train_index]
+        train, validation = kfold_indices(train_index.shape[0], ExperimentSetup.kfold,
+                                          events=labels if ExperimentSetup.stratified else None,
+                                          shuffle=True, seed=0)[0]
+        return train_index[train], train_index[validation]
+
+    def fit_fold(self, train_index, test_index):
+        return cached_fold(self._model, self._setup, self._data_set, train_index, test_index, self._fit_fold,
+                           self._horizon)
+
+    def _fit_fold(self, train_index, test_index):
+        # 训练一折，返回测试集的 prediction 和 label
+        dynamic_features = self._dynamic_features
+        labels = self._labels
+        train_set = self._train_set(dynamic_features, labels, train_index)
+        test_set = DataSet(dynamic_features, labels, index=test_index)
+        self._model.fit(train_set, test_set)
+        return self._model.predict(test_set), test_set.labels
+
+    def do_experiments(self, pool=None):
+        folds = self.folds()
+        self.summarize(folds, fold_results(self, folds, pool))
+        # 等待checkpoint、ROC图和结果文件全部写完
+        default_writer().flush()
+
+    def summarize(self, folds, results):
+        """
+        :param folds: folds() 的结果
+        :param results: 按折的顺序给出的 (prediction, label)
+        """
+        n_output = self._n_output
+        time_steps = self._time_steps
+        tol_test_index = np.zeros(shape=0, dtype=np.int64)
+        tol_pred = np.zeros(shape=(0, time_steps, n_output))
+        tol_label = np.zeros(shape=(0, time_steps, n_output), dtype=np.int32)
+        for i, ((train_index, test_index), (y_score, test_labels)) in enumerate(zip(folds, results)):
             tol_pred = np.vstack((tol_pred, y_score))
-            tol_label = np.vstack((tol_label, test_labels[i]))
-            print("Cross validation: {} of {}".format(i, 5),
+            tol_label = np.vstack((tol_label, test_labels))
+            # 每次入院记录的下标，与 LogisticRegression 的样本下标一致
+            tol_test_index = np.concatenate((tol_test_index,
+                                             (test_index.reshape(-1, 1) * time_steps + np.arange(time_steps)).reshape(-1)))
+            print("Cross validation: {} of {}".format(i, ExperimentSetup.kfold),
                   time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
-        tol_test_index = np.arange(labels.shape[0]*labels.shape[1])
-        evaluate(tol_test_index, tol_label, tol_pred, self._filename)
-        self._model.close()
+        if n_output > 1:
+            evaluate_horizons(tol_test_index, tol_label, tol_pred, self._filename, samples=self._samples())
+        else:
+            evaluate(tol_test_index, tol_label, tol_pred, self._filename, self._samples())
+        if not self._reuse_graph:
+            self._model.close()
 
 
 class AttentionBiLSTMExperiments(BidirectionalLSTMExperiments):
-    def __init__(self):
-        super().__init__()
+    setup = global_rnn_setup
+
+    def __init__(self, horizon=None, setup=None, reuse_graph=None):
+        super().__init__(horizon, setup, reuse_graph)
 
     def _model_format(self):
-        learning_rate, max_loss, max_pace, ridge,batch_size,hidden_size,epochs,dropout = global_rnn_setup.all
-        self._model = AttentionLSTMModel(num_features=self._num_features,
-                                         time_steps=self._time_steps,
-                                         lstm_size=hidden_size,
-                                         n_output=self._n_output,
-                                         batch_size=batch_size,
-                                         epochs=epochs,
-                                         output_n_epoch=ExperimentSetup.output_n_epochs,
-                                         learning_rate=learning_rate,
-                                         max_loss=max_loss,
-                                         max_pace=max_pace,
-                                         dropout=dropout,
-                                         ridge=ridge)
+        learning_rate, max_loss, max_pace, ridge,batch_size,hidden_size,epochs,dropout = self._setup.all
+        self._model = build_model(AttentionLSTMModel, self._reuse_graph,
+                                  num_features=self._num_features,
+                                  time_steps=self._time_steps,
+                                  lstm_size=hidden_size,
+                                  n_output=self._n_output,
+                                  batch_size=batch_size,
+                                  epochs=epochs,
+                                  output_n_epoch=ExperimentSetup.output_n_epochs,
+                                  learning_rate=learning_rate,
+                                  max_loss=max_loss,
+                                  max_pace=max_pace,
+                                  dropout=dropout,
+                                  ridge=ridge)
 
 # 得到prediction中的attention weight
     def attention_analysis(self):
@@ -399,22 +735,35 @@ class AttentionBiLSTMExperiments(BidirectionalLSTMExperiments):
                   "save_net10-17-19-04-12.ckpt", "save_net10-17-19-04-51.ckpt",
                   "save_net10-17-19-05-31.ckpt"]
         # n_output = 1
-        dynamic_features = self._data_set.dynamic_features
-        labels = self._data_set.labels
-        train_dynamic_features, test_dynamic_features, train_labels, test_labels = split_data_set(dynamic_features,
-                                                                                                  labels)
-        for j in range(5):
-            test_set = DataSet(test_dynamic_features[j], test_labels[j])
+        dynamic_features = self._dynamic_features
+        labels = self._labels
+        for j, (train_index, test_index) in enumerate(kfold_indices(labels.shape[0], ExperimentSetup.kfold)):
+            test_set = DataSet(dynamic_features, labels, index=test_index)
             prob, attention_weight = self._model.attention_analysis(test_set.dynamic_features, models[j])
             attention_signals_tol = np.concatenate((attention_signals_tol, attention_weight))
         np.save("allAttentionWeight_1.npy",attention_signals_tol)
 
+    def save_attention_weights(self, file):
+        # 每折训练之后直接取测试集的 attention 权重，按折的顺序拼接保存，供 get_average_weight 使用
+        dynamic_features = self._dynamic_features
+        labels = self._labels
+        attention_weights = []
+        for train_index, test_index in self.folds():
+            self._fit_fold(train_index, test_index)
+            test_set = DataSet(dynamic_features, labels, index=test_index)
+            attention_weights.append(self._model.attention(test_set.dynamic_features))
+        np.save(file, np.concatenate(attention_weights))
+        if not self._reuse_graph:
+            self._model.close()
+
 # 得到每一个特征的类别
-    def cluster_by_attention_weight(self):
+    @staticmethod
+    def cluster_by_attention_weight():
         attention_weight = np.load("average_weight.npy")
-        attention_weight_array = attention_weight.reshape([-1, self._num_features])
+        num_features = attention_weight.shape[-1]
+        attention_weight_array = attention_weight.reshape([-1, num_features])
         all_feature_breaks = []
-        for nums in range(self._num_features):
+        for nums in range(num_features):
             one_feature_breaks = jenkspy.jenks_breaks(attention_weight_array[:,nums],nb_class=5)
             print(one_feature_breaks)
             all_feature_breaks.append(one_feature_breaks)
@@ -492,7 +841,7 @@ class AttentionBiLSTMExperiments(BidirectionalLSTMExperiments):
     def get_kmeans_stages():
         attention_weight = np.load("average_weight.npy")
         attention_stage = np.load("kmeans_stages_4.npy")
-        labels = np.load("pick_5_visit_labels_merge_1.npy")[0:2100, :, -1].reshape(-1, 5, 1)
+        labels = default_store().get("pick_5_visit_labels_merge_1", np.s_[0:2100, :, -1]).reshape(-1, 5, 1)
         all_patient_stage = np.zeros(shape=(0,5),dtype=np.int32)
         patient_in_stage0 = np.zeros(shape=(0, 92), dtype=np.int32)
         patient_in_stage1 = np.zeros(shape=(0, 92), dtype=np.int32)
@@ -572,30 +921,35 @@ class AttentionBiLSTMExperiments(BidirectionalLSTMExperiments):
 
 
 class SelfAttentionBiLSTMExperiments(BidirectionalLSTMExperiments):
-    def __init__(self):
-        super().__init__()
+    setup = self_rnn_setup
+
+    def __init__(self, horizon=None, setup=None, reuse_graph=None):
+        super().__init__(horizon, setup, reuse_graph)
 
     def _model_format(self):
-        learning_rate, max_loss, max_pace, ridge,batch_size,hidden_size,epochs,dropout = self_rnn_setup.all
-        self._model = SelfAttentionLSTMModel(num_features=self._num_features,
-                                             time_steps=self._time_steps,
-                                             lstm_size=hidden_size,
-                                             n_output=self._n_output,
-                                             batch_size=batch_size,
-                                             epochs=epochs,
-                                             output_n_epoch=ExperimentSetup.output_n_epochs,
-                                             learning_rate=learning_rate,
-                                             max_loss=max_loss,
-                                             max_pace=max_pace,
-                                             dropout=dropout,
-                                             ridge=ridge)
+        learning_rate, max_loss, max_pace, ridge,batch_size,hidden_size,epochs,dropout = self._setup.all
+        self._model = build_model(SelfAttentionLSTMModel, self._reuse_graph,
+                                  num_features=self._num_features,
+                                  time_steps=self._time_steps,
+                                  lstm_size=hidden_size,
+                                  n_output=self._n_output,
+                                  batch_size=batch_size,
+                                  epochs=epochs,
+                                  output_n_epoch=ExperimentSetup.output_n_epochs,
+                                  learning_rate=learning_rate,
+                                  max_loss=max_loss,
+                                  max_pace=max_pace,
+                                  dropout=dropout,
+                                  ridge=ridge)
 
 
 #  (数据需要重新整理成不相关的独立变量 所以应该使用没有二值化的数据)cox regression model(已将完成)
-def cox_regression_experiment():
-    dynamic_features = np.load('pick_5_visit_features_merge_1.npy')[0:2100,:,:-2]
+def cox_regression_experiment(horizon="3m"):
+    store = default_store()
+    dynamic_features = store.get('pick_5_visit_features_merge_1', np.s_[0:2100,:,:-2])
     dynamic_features.astype(np.int32)
-    labels = np.load('pick_5_visit_labels_merge_1.npy')[:,:,-4].reshape(-1,dynamic_features.shape[1],1)
+    labels = store.get('pick_5_visit_labels_merge_1',
+                       np.s_[:,:,HORIZONS.get(horizon, horizon)]).reshape(-1,dynamic_features.shape[1],1)
     data = np.concatenate((dynamic_features,labels),axis=2).reshape(-1,94)
     data_set = pd.DataFrame(data)
     col_list = list(data_set.columns.values)
@@ -618,23 +972,31 @@ def cox_regression_experiment():
 def rsf_experiment():
     time_line = range(0,4000,1)
     rsf = RandomSurvivalForest(n_estimators=10, timeline=time_line)
-    dynamic_features = np.load("pick_5_visit_features_merge_1.npy")[0:2100,:,1:93]
-    time = np.load("pick_5_visit_features_merge_1.npy")[0:2100,:,0].reshape(-1,5,1)
-    event = np.load("pick_5_visit_labels_merge_1.npy")[0:2100,:,-1].reshape(-1,5,1)
+    store = default_store()
+    dynamic_features = store.get("pick_5_visit_features_merge_1", np.s_[0:2100,:,1:93])
+    time = store.get("pick_5_visit_features_merge_1", np.s_[0:2100,:,0]).reshape(-1,5,1)
+    event = store.get("pick_5_visit_labels_merge_1", np.s_[0:2100,:,-1]).reshape(-1,5,1)
     labels = np.concatenate((time, event),axis=2)
-    train_features, test_features, train_labels, test_labels = split_data_set(dynamic_features, labels)
     c_index = {}
 
-    for j in range(5):
-        rsf.fit(pd.DataFrame(train_features[j].reshape(-1, 92)), pd.DataFrame(train_labels[j].reshape(-1, 2)))
+    for j, (train_index, test_index) in enumerate(kfold_indices(labels.shape[0], ExperimentSetup.kfold)):
+        rsf.fit(pd.DataFrame(dynamic_features[train_index].reshape(-1, 92)),
+                pd.DataFrame(labels[train_index].reshape(-1, 2)))
         train_c_index = rsf.oob_score
         print("train_c_index:{:.2f}".format(train_c_index))
-        y_pred = rsf.predict(test_features[j].reshape(-1, 92))
-        c_index[j] = concordance_index(test_labels[j][:,:, 0].reshape(-1), y_pred, test_labels[j][:,:, 1].reshape(-1))
+        y_pred = rsf.predict(dynamic_features[test_index].reshape(-1, 92))
+        test_labels = labels[test_index]
+        c_index[j] = concordance_index(test_labels[:,:, 0].reshape(-1), y_pred, test_labels[:,:, 1].reshape(-1))
         print("c_index:{:.2f}".format(c_index[j]))
     print(c_index)
 
 
+def save_attention_weight_repeats(repeats=5):
+    # 重复训练 repeats 次，分别保存为 allAttentionWeight_1.npy ... allAttentionWeight_5.npy
+    for i in range(repeats):
+        AttentionBiLSTMExperiments().save_attention_weights("allAttentionWeight_{}.npy".format(i + 1))
+
+
 def get_average_weight():
     weight1 = np.load("allAttentionWeight_1.npy")
     weight2 = np.load("allAttentionWeight_2.npy")
@@ -651,9 +1013,15 @@ if __name__ == "__main__":
     # get_average_weight()
     # cox_regression_experiment()
     # rsf_experiment()
-    for i in range(5):
-        # LogisticRegressionExperiment().do_experiments()
-        # BidirectionalLSTMExperiments().do_experiments()
-        AttentionBiLSTMExperiments().do_experiments()
-        # AttentionBiLSTMExperiments().get_stages()
-        # SelfAttentionBiLSTMExperiments().do_experiments()
\ No newline at end of file
+    # ExperimentSetup.reuse_graph = True
+    # ExperimentSetup.compact_features = True
+    # ExperimentSetup.n_workers = 8
+    if ExperimentSetup.n_workers > 1:
+        run_repeats(AttentionBiLSTMExperiments, 5)
+    else:
+        for i in range(5):
+            # LogisticRegressionExperiment().do_experiments()
+            # BidirectionalLSTMExperiments().do_experiments()
+            AttentionBiLSTMExperiments().do_experiments()
+            # AttentionBiLSTMExperiments().get_stages()
+            # SelfAttentionBiLSTMExperiments().do_experiments()
\ No newline at end of file
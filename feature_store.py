@@ -0,0 +1,178 @@
+import contextlib
+import hashlib
+import json
+import os
+import time
+import numpy as np
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+
+def file_hash(file, chunk_size=1 << 20):
+    # 源csv的sha1，用来判断特征是否由同一份数据生成
+    sha1 = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    进程间的互斥锁，持有锁的进程退出时由操作系统释放
+    :param path: 锁文件，不存在时创建
+    """
+    with open(path, 'a+') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class FeatureStore(object):
+    """
+        以内存映射方式打开特征/标签数组，manifest 中记录每个数组的 shape、dtype、标签列(horizon)、源文件的hash、
+        数组文件的hash 和版本号。版本号只在数组内容改变时增加。
+        同一进程内每个数组只打开一次，get 返回的切片是视图，不发生拷贝；第一次打开时检查源文件是否已经改变。
+        多个进程可以同时 put：manifest 在文件锁中重新读取、合并后写到临时文件再改名，读到的总是完整的文件
+    """
+    manifest_name = "feature_store.json"
+
+    def __init__(self, root="."):
+        self._root = root
+        self._manifest_file = os.path.join(root, self.manifest_name)
+        self._manifest = self._load_manifest()
+        self._arrays = {}
+        self._hashes = {}
+
+    def put(self, name, array, horizon=None, source=None):
+        """
+        把数组保存为 name + ".npy"（文件名不变，Pipeline 和直接 np.load 的代码都可以使用）并更新 manifest
+        :param name: 数组名，如 "pick_5_visit_features_merge_1"
+        :param array: 要保存的数组
+        :param horizon: 数组中的标签列，如 HORIZONS（-1(2年), -2(1年), -3(6个月), -4(3个月)）
+        :param source: 生成该数组的源文件路径（csv，或者上游数组的npy）
+        :return: 版本号
+        """
+        file = name + ".npy"
+        # 先写临时文件再改名，已经以内存映射打开的旧文件不受影响
+        tmp = os.path.join(self._root, "{}.{}.tmp.npy".format(file, os.getpid()))
+        np.save(tmp, array)
+        os.replace(tmp, os.path.join(self._root, file))
+        return self._update(name, file, horizon, source)
+
+    def register(self, name, file, horizon=None, source=None):
+        # 把已经存在的npy文件登记到 manifest 中
+        return self._update(name, file, horizon, source)
+
+    def _update(self, name, file, horizon, source):
+        path = os.path.join(self._root, file)
+        array = np.load(path, mmap_mode='r')
+        array_hash = self._file_hash(path)
+        with file_lock(self._manifest_file + ".lock"):
+            # 合并其它进程在此期间写入的条目
+            self._manifest = self._load_manifest()
+            entry = self._manifest.get(name, {})
+            version = entry.get("version", 0)
+            if entry.get("file") != file or entry.get("hash") != array_hash:
+                version += 1
+            self._manifest[name] = {"file": file,
+                                    "version": version,
+                                    "hash": array_hash,
+                                    "shape": list(array.shape),
+                                    "dtype": str(array.dtype),
+                                    "horizon": horizon,
+                                    "source": source,
+                                    "source_hash": self._file_hash(source)
+                                    if source is not None and os.path.exists(source) else None,
+                                    "created": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())}
+            self._save_manifest()
+        self._arrays.pop(name, None)
+        return version
+
+    def get(self, name, index=None):
+        """
+        :param name: 数组名，没有登记时直接打开 name + ".npy"
+        :param index: 切片，如 np.s_[0:2100, :, 1:93]
+        :return: 内存映射数组（或其视图）
+        """
+        if name not in self._arrays:
+            if name not in self._manifest:
+                # 可能是其它进程之后登记的
+                self._manifest = self._load_manifest()
+            if name in self._manifest:
+                file = self._manifest[name]["file"]
+                if self.is_stale(name):
+                    print("feature store: {} is stale, {} or its upstream changed, regenerate it".format(
+                        name, self._manifest[name]["source"]))
+            else:
+                file = name + ".npy"
+            self._arrays[name] = np.load(os.path.join(self._root, file), mmap_mode='r')
+        array = self._arrays[name]
+        if index is None:
+            return array
+        return array[index]
+
+    def manifest(self, name):
+        return self._manifest.get(name)
+
+    def is_stale(self, name):
+        """
+        源文件改变之后对应的数组需要重新生成。源文件是另一个登记过的数组时，该数组过期也算过期
+        """
+        entry = self._manifest.get(name)
+        if entry is None or entry.get("source") is None or not os.path.exists(entry["source"]):
+            return False
+        if self._file_hash(entry["source"]) != entry.get("source_hash"):
+            return True
+        for upstream, upstream_entry in self._manifest.items():
+            if upstream != name and os.path.normpath(os.path.join(self._root, upstream_entry["file"])) == \
+                    os.path.normpath(entry["source"]):
+                return self.is_stale(upstream)
+        return False
+
+    def _file_hash(self, file):
+        # 同一进程中没有改变的文件只计算一次hash
+        stat = os.stat(file)
+        key = (os.path.abspath(file), stat.st_mtime, stat.st_size)
+        if key not in self._hashes:
+            self._hashes[key] = file_hash(file)
+        return self._hashes[key]
+
+    def _load_manifest(self):
+        if not os.path.exists(self._manifest_file):
+            return {}
+        with open(self._manifest_file, 'r') as f:
+            return json.load(f)
+
+    def _save_manifest(self):
+        # 在 file_lock 中调用，先写临时文件再改名
+        tmp = "{}.{}.tmp".format(self._manifest_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self._manifest, f, indent=2, ensure_ascii=False)
+        os.replace(tmp, self._manifest_file)
+
+
+_default_store = None
+
+
+def default_store():
+    # 每个进程共用一个 FeatureStore，数据只加载一次
+    global _default_store
+    if _default_store is None:
+        _default_store = FeatureStore()
+    return _default_store
@@ -0,0 +1,230 @@
+import numpy as np
+
+
+def sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def softmax(x, axis=-1):
+    e = np.exp(x - np.max(x, axis=axis, keepdims=True))
+    return e / np.sum(e, axis=axis, keepdims=True)
+
+
+def lstm_step(inputs, h, c, kernel, bias, forget_bias=1.0):
+    """
+    BasicLSTMCell / LSTMBlockFusedCell 的一步，门的顺序为 i, j, f, o
+    :param inputs: n_samples×num_features
+    :param h: n_samples×lstm_size
+    :param c: n_samples×lstm_size
+    :return: 新的 h, c
+    """
+    i, j, f, o = np.split(np.dot(np.concatenate((inputs, h), axis=1), kernel) + bias, 4, axis=1)
+    c = c * sigmoid(f + forget_bias) + sigmoid(i) * np.tanh(j)
+    h = np.tanh(c) * sigmoid(o)
+    return h, c
+
+
+class NumpyAttentionLSTM(object):
+    """
+        AttentionLSTMModel 的前向传播，只依赖 numpy，不需要 import tensorflow 和重建整个图
+        权重由 AttentionLSTMModel.export_weights 导出，保存在一个 npz 文件中
+        不使用 dropout，与图在预测时（keep_prob 为1.0）的结果相同
+    """
+    def __init__(self, attention_weight, kernel, bias, output_weight, output_bias):
+        """
+        :param attention_weight: num_features×num_features
+        :param kernel: {"forward": (num_features+lstm_size)×4lstm_size, "backward": 同上}
+        :param bias: {"forward": 4lstm_size, "backward": 4lstm_size}
+        :param output_weight: 2lstm_size×n_output
+        :param output_bias: n_output
+        """
+        self._attention_weight = np.asarray(attention_weight, dtype=np.float32)
+        self._kernel = {direction: np.asarray(kernel[direction], dtype=np.float32) for direction in kernel}
+        self._bias = {direction: np.asarray(bias[direction], dtype=np.float32) for direction in bias}
+        self._output_weight = np.asarray(output_weight, dtype=np.float32)
+        self._output_bias = np.asarray(output_bias, dtype=np.float32)
+        self._lstm_size = self._bias["forward"].shape[0] // 4
+
+    @classmethod
+    def load(cls, file):
+        weights = np.load(file)
+        return cls(weights["attention_weight"],
+                   {"forward": weights["forward_kernel"], "backward": weights["backward_kernel"]},
+                   {"forward": weights["forward_bias"], "backward": weights["backward_bias"]},
+                   weights["output_weight"],
+                   weights["output_bias"])
+
+    def save(self, file):
+        np.savez(file,
+                 attention_weight=self._attention_weight,
+                 forward_kernel=self._kernel["forward"],
+                 forward_bias=self._bias["forward"],
+                 backward_kernel=self._kernel["backward"],
+                 backward_bias=self._bias["backward"],
+                 output_weight=self._output_weight,
+                 output_bias=self._output_bias)
+
+    @staticmethod
+    def length(x):
+        # 与 BasicLSTMModel._length 相同：有任一非零特征的时间步记为一次就诊
+        mask = np.sign(np.max(np.abs(x), axis=2))
+        return mask, np.sum(mask, axis=1).astype(np.int32)
+
+    def attention(self, x):
+        """
+        :param x: n_samples×time_steps×num_features，即 dynamic_features[:, :, 1:93]
+        :return: attention 权重 _w_z
+        """
+        return softmax(np.dot(x, self._attention_weight), axis=2)
+
+    def _rnn(self, z, length, direction):
+        # 与 dynamic_rnn 相同：超过 length 的时间步输出为0，状态保持不变
+        n_samples, time_steps = z.shape[0], z.shape[1]
+        h = np.zeros((n_samples, self._lstm_size), dtype=np.float32)
+        c = np.zeros((n_samples, self._lstm_size), dtype=np.float32)
+        outputs = np.zeros((n_samples, time_steps, self._lstm_size), dtype=np.float32)
+        for step in range(time_steps):
+            active = (step < length)[:, np.newaxis]
+            h_new, c_new = lstm_step(z[:, step], h, c, self._kernel[direction], self._bias[direction])
+            h = np.where(active, h_new, h)
+            c = np.where(active, c_new, c)
+            outputs[:, step] = np.where(active, h_new, 0)
+        return outputs
+
+    def hidden(self, z, length):
+        """
+        双向LSTM，返回 n_samples×time_steps×2lstm_size
+        反向与 bidirectional_dynamic_rnn 相同，只翻转每个病人的前 length 个时间步
+        """
+        return np.concatenate((self._rnn(z, length, "forward"), self.backward(z, length)), axis=2)
+
+    def backward(self, z, length):
+        # 反向LSTM的输出，n_samples×time_steps×lstm_size
+        reverse = self._reverse_index(length, z.shape[1])
+        rows = np.arange(z.shape[0])[:, np.newaxis]
+        return self._rnn(z[rows, reverse], length, "backward")[rows, reverse]
+
+    def forward_step(self, z, h, c):
+        """
+        前向LSTM走一步，用于新增一次就诊时的增量计算
+        :param z: n_samples×num_features，新就诊的 attention 输出
+        :return: 新的 h, c
+        """
+        return lstm_step(np.asarray(z, dtype=np.float32), h, c, self._kernel["forward"], self._bias["forward"])
+
+    def output(self, hidden, mask):
+        # hidden: n_samples×time_steps×2lstm_size，mask: n_samples×time_steps
+        return np.tanh(np.dot(hidden, self._output_weight) + self._output_bias) * mask[:, :, np.newaxis]
+
+    @staticmethod
+    def _reverse_index(length, time_steps):
+        steps = np.arange(time_steps)[np.newaxis, :]
+        length = length[:, np.newaxis]
+        return np.where(steps < length, length - 1 - steps, steps)
+
+    def forward(self, x):
+        """
+        :param x: n_samples×time_steps×num_features，即 dynamic_features[:, :, 1:93]
+        :return: 与图中 _pred 相同的预测 n_samples×time_steps×n_output，attention 权重 _w_z
+        """
+        x = np.asarray(x, dtype=np.float32)
+        mask, length = self.length(x)
+        w_z = self.attention(x)
+        return self.output(self.hidden(x * w_z, length), mask), w_z
+
+    def predict(self, dynamic_features):
+        # dynamic_features 与 AttentionLSTMModel._feed_dict 相同：第0列为时间，1:93 为特征
+        pred, _ = self.forward(dynamic_features[:, :, 1:93])
+        return pred
+
+    @property
+    def lstm_size(self):
+        return self._lstm_size
+
+    @property
+    def num_features(self):
+        return self._attention_weight.shape[0]
+
+    @property
+    def n_output(self):
+        return self._output_weight.shape[1]
+
+
+class IncrementalScorer(object):
+    """
+        病人每新增一次就诊，只让前向LSTM从缓存的状态走一步，再重新计算较短的反向LSTM，
+        结果与把整个病史重新 padding 后调用 NumpyAttentionLSTM.forward 相同
+    """
+    def __init__(self, engine):
+        """
+        :param engine: NumpyAttentionLSTM
+        """
+        self._engine = engine
+        self._patients = {}
+
+    def append_visits(self, patients, visits):
+        """
+        :param patients: 病人id的列表，不能重复
+        :param visits: 每个病人新增的一次就诊，与 dynamic_features 的一行相同：第0列为时间，1:93 为特征
+        :return: 每个病人所有就诊的预测，[就诊次数×n_output] 的列表
+        """
+        if len(set(patients)) != len(patients):
+            raise ValueError("each patient can only append one visit per call")
+        x = np.asarray(visits, dtype=np.float32)[:, 1:93]
+        if np.any(np.max(np.abs(x), axis=1) == 0):
+            # 全为0的就诊在完整计算中会被当作padding
+            raise ValueError("visit without any feature")
+        w_z = self._engine.attention(x[:, np.newaxis])[:, 0]
+        z = x * w_z
+        states = [self._patients.setdefault(patient, self._new_state()) for patient in patients]
+        h, c = self._engine.forward_step(z,
+                                         np.stack([state["h"] for state in states]),
+                                         np.stack([state["c"] for state in states]))
+        for i, state in enumerate(states):
+            state["h"], state["c"] = h[i], c[i]
+            state["z"].append(z[i])
+            state["w_z"].append(w_z[i])
+            state["forward"].append(h[i])
+        return self._score(states)
+
+    def append_visit(self, patient, visit):
+        return self.append_visits([patient], np.asarray(visit)[np.newaxis])[0]
+
+    def score(self, patients):
+        # 不新增就诊，返回缓存的病人当前的预测
+        return self._score([self._patients[patient] for patient in patients])
+
+    def attention(self, patient):
+        # 该病人每次就诊的 attention 权重 _w_z，就诊次数×num_features
+        return np.array(self._patients[patient]["w_z"])
+
+    def reset(self, patient):
+        self._patients.pop(patient, None)
+
+    def _new_state(self):
+        lstm_size = self._engine.lstm_size
+        return {"h": np.zeros(lstm_size, dtype=np.float32),
+                "c": np.zeros(lstm_size, dtype=np.float32),
+                "z": [],
+                "w_z": [],
+                "forward": []}
+
+    def _score(self, states):
+        # 把缓存的 z 和前向输出 padding 到最长的病史，只重新计算反向LSTM
+        length = np.array([len(state["z"]) for state in states], dtype=np.int32)
+        time_steps = length.max()
+        mask = (np.arange(time_steps)[np.newaxis, :] < length[:, np.newaxis]).astype(np.float32)
+        z = np.zeros((len(states), time_steps, self._engine.num_features), dtype=np.float32)
+        forward = np.zeros((len(states), time_steps, self._engine.lstm_size), dtype=np.float32)
+        for i, state in enumerate(states):
+            z[i, :length[i]] = state["z"]
+            forward[i, :length[i]] = state["forward"]
+        hidden = np.concatenate((forward, self._engine.backward(z, length)), axis=2)
+        pred = self._engine.output(hidden, mask)
+        return [pred[i, :length[i]] for i in range(len(states))]
+
+    def __len__(self):
+        return len(self._patients)
+
+    def __contains__(self, patient):
+        return patient in self._patients
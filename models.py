@@ -1,11 +1,130 @@
 import tensorflow as tf
 from sklearn.metrics import roc_auc_score, accuracy_score
+import os
 import time
+import uuid
 from sklearn.base import BaseEstimator
+import numpy as np
+from data import BatchPrefetcher, StreamingDataSet
+from inference import NumpyAttentionLSTM, IncrementalScorer
+from artifacts import default_writer
+
+
+# 只在 fit 的python循环中使用、可以在复用的模型上直接修改的参数
+TRAINING_PARAMS = ("batch_size", "epochs", "output_n_epoch", "max_loss", "max_pace")
+
+# 决定图结构、但不在 ExperimentSetup 中的参数，结果缓存的key中需要包含
+GRAPH_PARAMS = ("time_steps", "num_features", "n_output", "lstm_size", "cell_impl")
+
+# 0 表示由tensorflow决定线程数
+_session_threads = {"intra_op": 0, "inter_op": 0}
+_shared_models = {}
+
+
+def set_session_threads(intra_op=0, inter_op=0):
+    """
+    设置之后创建的session的线程数，一台机器上同时运行多个训练进程时给每个进程分配一部分核
+    :param intra_op: 单个op内部并行的线程数
+    :param inter_op: op之间并行的线程数
+    """
+    _session_threads["intra_op"] = intra_op
+    _session_threads["inter_op"] = inter_op
+
+
+def session_config():
+    return tf.ConfigProto(intra_op_parallelism_threads=_session_threads["intra_op"],
+                          inter_op_parallelism_threads=_session_threads["inter_op"])
+
+
+def write_checkpoint(values, path):
+    """
+    把 sess.run 取出的变量值写成与 tf.train.Saver 相同格式的checkpoint，可以直接用模型的 restore 读取
+    在单独的图中完成，不占用训练中的session，可以在 ArtifactWriter 的线程中调用
+    :param values: {变量名: 值}，见 BasicLSTMModel._snapshot
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        variables = {name: tf.Variable(value, name="v{}".format(i)) for i, (name, value) in enumerate(values.items())}
+        saver = tf.train.Saver(variables)
+        with tf.Session(graph=graph, config=session_config()) as sess:
+            sess.run(tf.variables_initializer(list(variables.values())))
+            # 不写目录中共用的 checkpoint 状态文件，并行的各折不会互相覆盖；restore 时直接给出路径
+            return saver.save(sess, path, write_meta_graph=False, write_state=False)
+
+
+def graph_params(model):
+    # 模型的 GRAPH_PARAMS，没有的参数（如 LogisticRegression 的 lstm_size）不包括在内
+    return tuple((name, getattr(model, "_" + name)) for name in GRAPH_PARAMS if hasattr(model, "_" + name))
+
+
+def shared_model(model_class, **params):
+    """
+    每个进程中结构相同的模型只建一次图和session，在不同的折、重复实验和超参数试验之间复用，
+    fit 开始时只重新初始化变量。TRAINING_PARAMS 中的参数直接修改，其余参数不同时建新的模型
+    :param model_class: 如 AttentionLSTMModel
+    :param params: 构造函数的参数，必须用关键字给出
+    """
+    key = (model_class, tuple(sorted((name, repr(value)) for name, value in params.items()
+                                     if name not in TRAINING_PARAMS)),
+           tuple(sorted(_session_threads.items())))
+    model = _shared_models.get(key)
+    if model is None:
+        model = model_class(**params)
+        _shared_models[key] = model
+    else:
+        model.update_training_params(**{name: value for name, value in params.items() if name in TRAINING_PARAMS})
+    return model
+
+
+def close_shared_models():
+    for model in _shared_models.values():
+        model.close()
+    _shared_models.clear()
+
+
+def run_in_chunks(sess, loss, pred, feed_dict, data_set, chunk_size):
+    """
+    分块计算整个数据集的loss和prediction，每块只调用一次sess.run同时取出两者，数据也按块取出（DataSet.chunks）
+    loss 是各块loss按样本数加权的平均。样本之间相关的loss（如 AttentionLSTMModel 的 partial likelihood，
+    风险集只在同一块内累加）只有在整个数据集不超过 chunk_size 时才等于整体的值，否则只是近似
+    :param feed_dict: feed_dict(dynamic_features, labels) 返回一块数据的feed_dict
+    :return: 按样本数加权平均的loss，拼接好的prediction
+    """
+    if isinstance(data_set, StreamingDataSet):
+        # StreamingDataSet 的 dynamic_features/labels 只是随机的评价样本，与逐块的预测对不上
+        raise ValueError("StreamingDataSet can only be used for training, predict on a DataSet")
+    total_loss = 0.0
+    total_count = 0
+    preds = []
+    for dynamic_features, labels in data_set.chunks(chunk_size):
+        chunk_loss, chunk_pred = sess.run([loss, pred], feed_dict=feed_dict(dynamic_features, labels))
+        total_loss += chunk_loss * len(labels)
+        total_count += len(labels)
+        preds.append(chunk_pred)
+    return total_loss / max(total_count, 1), np.concatenate(preds)
+
+
+def horizon_auc(labels, y_score):
+    """
+    最后一维的每个时间窗口分别计算auc再取平均，不同时间窗口的预测不放在一起排序。
+    只有一类标签的时间窗口无法计算auc，不参与平均
+    :param labels: (..., n_output)
+    :param y_score: 同 labels
+    :return: 各时间窗口auc的平均，都无法计算时为nan
+    """
+    n_output = labels.shape[-1]
+    labels = labels.reshape([-1, n_output])
+    y_score = y_score.reshape([-1, n_output])
+    aucs = [roc_auc_score(labels[:, i], y_score[:, i]) for i in range(n_output) if len(np.unique(labels[:, i])) == 2]
+    return float(np.mean(aucs)) if aucs else float('nan')
 
 
 # 单向LSTM
 class BasicLSTMModel(BaseEstimator):
+    n_prefetch = 4  # 后台准备好的batch个数，为0时在训练循环中同步取batch
+    streaming_evaluation = False  # 为True时训练loss取自本轮已经计算过的minibatch，不再在整个训练集上重新计算
+    eval_chunk_size = 1024  # 预测时每次sess.run的样本数
+
     def __init__(self, time_steps, num_features, n_output, lstm_size, batch_size=64, epochs=1000, output_n_epoch=10,
                  learning_rate=0.01, max_loss=0.5, max_pace=0.01, ridge=0.0, dropout=0.8,
                  optimizer=tf.train.AdamOptimizer, name='BasicLSTMMode'):
@@ -23,21 +142,24 @@ class BasicLSTMModel(BaseEstimator):
         self._dropout = dropout
         self._optimizer = optimizer
         self._name = name
+        self._history = []
         print("lstm_size=", lstm_size, "learning_rate=", learning_rate, "max_loss=", max_loss, "name=", name)
 
-        with tf.variable_scope(self._name):
+        self._graph = tf.Graph()
+        with self._graph.as_default(), tf.variable_scope(self._name):
             self._x = tf.placeholder(tf.float32, [None, time_steps, num_features], name="input")
             self._y = tf.placeholder(tf.float32, [None, time_steps, n_output], name="label")  # 注意区别： 输出是三维tensor
-            self._t = tf.placeholder(tf.float32, [None, time_steps, n_output], 'time')
-            self._sess = tf.Session()
+            self._t = tf.placeholder(tf.float32, [None, time_steps, 1], 'time')
+            # 训练时 _train_step 传入 dropout，预测时为默认的1.0，同一输入的结果不变
+            self._keep_prob = tf.placeholder_with_default(1.0, [], name='keep_prob')
+            self._sess = tf.Session(graph=self._graph, config=session_config())
             self._hidden_layer()
             # （m,time_steps,hidden_size）->(m,time_steps,1)
             self._w_trans = tf.Variable(tf.truncated_normal([2 * self._lstm_size, self._n_output], stddev=1.0),
                                         name='output_weight')
-            self._v = tf.tile(tf.reshape(self._w_trans, [-1, 2 * self._lstm_size, self._n_output]),
-                              [tf.shape(self._x)[0], 1, 1])
             bias = tf.Variable(tf.random_normal([n_output]), name='output_bias')
-            self._output = tf.matmul(self._hidden, self._v) + bias
+            # (m,time_steps,2lstm_size)×(2lstm_size,n_output)，不再把 output_weight 复制 batch_size 份
+            self._output = tf.tensordot(self._hidden, self._w_trans, axes=[[2], [0]]) + bias
             self._pred = tf.nn.tanh(self._output)
             self._loss = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=self._y, logits=self._pred), name='loss')
             # self._loss = tf.add(self._loss_1, loss, name='loss')
@@ -47,10 +169,12 @@ class BasicLSTMModel(BaseEstimator):
                     self._loss += tf.contrib.layers.l2_regularizer(ridge)(trainable_variables)
 
             self._train_op = optimizer(learning_rate).minimize(self._loss)
+            self._save = tf.train.Saver()
+            self._init_op = tf.global_variables_initializer()
 
     def _hidden_layer(self):
         lstm = tf.contrib.rnn.BasicLSTMCell(self._lstm_size)
-        lstm_dropout = tf.contrib.rnn.DropoutWrapper(lstm, output_keep_prob=self._dropout)
+        lstm_dropout = tf.contrib.rnn.DropoutWrapper(lstm, output_keep_prob=self._keep_prob)
         init_state = lstm.zero_state(tf.shape(self._x)[0], tf.float32)
         mask, length = self._length()
         self._hidden, _ = tf.nn.dynamic_rnn(lstm_dropout,
@@ -64,79 +188,207 @@ class BasicLSTMModel(BaseEstimator):
         length = tf.cast(length, tf.int32)
         return mask, length
 
+    def _feed_dict(self, dynamic_features, labels):
+        # 第0列为时间，1:93 为特征，与 predict 一致
+        return {self._x: dynamic_features[:, :, 1:93], self._y: labels}
+
+    def initialize(self):
+        self._sess.run(self._init_op)
+
+    def train_step_statistics(self, dynamic_features, labels):
+        """
+        运行一次训练并统计用时和显存/内存占用
+        :return: 用时(秒)，这一步所有op输出的内存总量(字节)
+        """
+        run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        run_metadata = tf.RunMetadata()
+        start = time.time()
+        feed_dict = self._feed_dict(dynamic_features, labels)
+        feed_dict[self._keep_prob] = self._dropout
+        self._sess.run(self._train_op, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+        elapsed = time.time() - start
+        activation_bytes = sum(output.tensor_description.allocation_description.requested_bytes
+                               for device in run_metadata.step_stats.dev_stats
+                               for node in device.node_stats
+                               for output in node.output)
+        return elapsed, activation_bytes
+
+    def get_weights(self):
+        # 按创建顺序返回所有可训练变量的值，basic 与 fused 两种 cell_impl 的变量顺序和形状一致
+        return self._sess.run(self._trainable_variables())
+
+    def set_weights(self, weights):
+        variables = self._trainable_variables()
+        if len(variables) != len(weights):
+            raise ValueError("expected {} weights, got {}".format(len(variables), len(weights)))
+        for variable, value in zip(variables, weights):
+            variable.load(value, self._sess)
+
     def fit(self, data_set, test_set):
-        self._sess.run(tf.global_variables_initializer())
+        self.initialize()
+        self._history = []
         data_set.epoch_completed = 0
 
-        for c in tf.trainable_variables(self._name):
+        for c in self._trainable_variables():
             print(c.name)
 
         print("acc\tauc\tepoch\tloss\tloss_diff\tcount")
         logged = set()
         loss = 0
         count = 0
-        while data_set.epoch_completed < self._epochs:
-            dynamic_features, labels = data_set.next_batch(self._batch_size)
-            self._sess.run(self._train_op, feed_dict={self._x: dynamic_features,
-                                                      self._y: labels})
-            if data_set.epoch_completed % self._output_n_epoch == 0 and data_set.epoch_completed not in logged:
-                logged.add(data_set.epoch_completed)
-                loss_prev = loss
-                loss = self._sess.run(self._loss, feed_dict={self._x: data_set.dynamic_features,
-                                                             self._y: data_set.labels})
-                loss_diff = loss_prev - loss
-                y_score = self.predict(test_set)
-                y_score = y_score.reshape([-1, 1])
-                test_labels = test_set.labels
-                test_labels = test_labels.reshape([-1, 1])
-                auc = roc_auc_score(test_labels, y_score)
-                y_score_pred = [0 for j in range(len(y_score))]
-                for i in range(len(y_score)):
-                    if y_score[i] >= 0.5:
-                        y_score_pred[i] = 1
-                    else:
-                        y_score_pred[i] = 0
-                acc = accuracy_score(test_labels, y_score_pred)
-                print("{}\t{}\t{}\t{}\t{}\t{}".format(acc, auc, data_set.epoch_completed, loss, loss_diff, count),
-                      time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
-
-                # 设置训练停止条件
-                if loss > self._max_loss:
-                    count = 0
-                else:
-                    if loss_diff > self._max_pace:
+        batches = BatchPrefetcher(data_set, self._batch_size, self._epochs, self._feed_dict, self.n_prefetch)
+        running_loss = 0.0
+        running_count = 0
+        try:
+            while batches.epoch_completed < self._epochs:
+                feed_dict = batches.next_batch()
+                batch_loss = self._train_step(feed_dict)
+                if batch_loss is not None:
+                    running_loss += batch_loss * len(feed_dict[self._y])
+                    running_count += len(feed_dict[self._y])
+                if batches.epoch_completed % self._output_n_epoch == 0 and batches.epoch_completed not in logged:
+                    logged.add(batches.epoch_completed)
+                    loss_prev = loss
+                    loss = self._train_loss(data_set, running_loss, running_count)
+                    running_loss = 0.0
+                    running_count = 0
+                    loss_diff = loss_prev - loss
+                    y_score = self.predict(test_set)
+                    test_labels = test_set.labels
+                    auc = horizon_auc(test_labels, y_score)
+                    y_score = y_score.reshape([-1, 1])
+                    test_labels = test_labels.reshape([-1, 1])
+                    y_score_pred = [0 for j in range(len(y_score))]
+                    for i in range(len(y_score)):
+                        if y_score[i] >= 0.5:
+                            y_score_pred[i] = 1
+                        else:
+                            y_score_pred[i] = 0
+                    acc = accuracy_score(test_labels, y_score_pred)
+                    print("{}\t{}\t{}\t{}\t{}\t{}".format(acc, auc, batches.epoch_completed, loss, loss_diff, count),
+                          time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
+                    self._history.append((batches.epoch_completed, float(loss), float(auc)))
+
+                    # 设置训练停止条件
+                    if loss > self._max_loss:
                         count = 0
                     else:
-                        count += 1
-                if count > 9:
-                    break
+                        if loss_diff > self._max_pace:
+                            count = 0
+                        else:
+                            count += 1
+                    if count > 9:
+                        break
+        finally:
+            batches.close()
+
+    def _predict_feed_dict(self, dynamic_features, labels):
+        return {self._x: dynamic_features[:, :, 1:93],
+                self._y: labels,
+                self._t: dynamic_features[:, :, 0].reshape(-1, dynamic_features.shape[1], 1)}
+
+    def _train_step(self, feed_dict):
+        # streaming_evaluation 时同一次sess.run顺便取出这个batch的loss；只有训练时使用 dropout
+        feed_dict = dict(feed_dict)
+        feed_dict[self._keep_prob] = self._dropout
+        if self.streaming_evaluation:
+            _, loss = self._sess.run([self._train_op, self._loss], feed_dict=feed_dict)
+            return loss
+        self._sess.run(self._train_op, feed_dict=feed_dict)
+        return None
+
+    def _train_loss(self, data_set, running_loss, running_count):
+        if self.streaming_evaluation:
+            return running_loss / max(running_count, 1)
+        return self._sess.run(self._loss, feed_dict=self._feed_dict(data_set.dynamic_features, data_set.labels))
 
     def predict(self, test_set):
-        loss = self._sess.run(self._loss, feed_dict={self._x: test_set.dynamic_features[:,:,1:93],
-                                                     self._y: test_set.labels,
-                                                     self._t: test_set.dynamic_features[:,:,0].reshape(-1,5,1)})
+        loss, pred = run_in_chunks(self._sess, self._loss, self._pred, self._predict_feed_dict, test_set,
+                                   self.eval_chunk_size)
         print("test_loss-----" + str(loss))
-        return self._sess.run(self._pred, feed_dict={self._x: test_set.dynamic_features[:,:,1:93],
-                                                     self._t: test_set.dynamic_features[:,:,0].reshape(-1,5,1)})
+        return pred
+
+    def score(self, dynamic_features):
+        # 只计算预测，不需要标签，dynamic_features 第0列为时间，1:93 为特征
+        return self._sess.run(self._pred, feed_dict={self._x: dynamic_features[:, :, 1:93]})
+
+    def restore(self, model):
+        # 读取 fit 保存的checkpoint，如 "save_net10-17-19-02-53.ckpt"
+        self._save.restore(self._sess, self._name + "model/" + model)
+
+    def save(self, path):
+        # 把当前的权重保存到 path，返回checkpoint的路径
+        return self._save.save(self._sess, path)
+
+    def load(self, path):
+        # 读取 save 保存的checkpoint
+        self._save.restore(self._sess, path)
+
+    def save_async(self, path):
+        # 先把权重取到内存中，写盘交给 ArtifactWriter，下一折可以马上重新初始化变量开始训练
+        default_writer().submit(write_checkpoint, self._snapshot(), path)
+        return path
+
+    def _checkpoint_path(self):
+        # 并行的各折、各次重复可能在同一秒内结束，文件名中加上进程号和随机串
+        return self._name + "model/save_net" + time.strftime("%m-%d-%H-%M-%S", time.localtime()) + \
+            "-{}-{}.ckpt".format(os.getpid(), uuid.uuid4().hex[:8])
+
+    def _snapshot(self):
+        # 与 tf.train.Saver() 保存的变量和名字相同
+        variables = self._graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+        return self._sess.run({variable.op.name: variable for variable in variables})
 
     @property
     def name(self):
         return self._name
 
+    @property
+    def history(self):
+        # 最近一次 fit 中每次输出时的 (epoch, loss, 测试集auc)，auc 为各时间窗口auc的平均（见 horizon_auc）
+        return self._history
+
+    @property
+    def time_steps(self):
+        return self._time_steps
+
+    def update_training_params(self, **params):
+        # 只修改不影响图结构的参数，如 batch_size、epochs、max_loss、max_pace、output_n_epoch
+        for key, value in params.items():
+            if key not in TRAINING_PARAMS:
+                raise ValueError("{} is part of the graph, build a new model instead".format(key))
+            setattr(self, "_" + key, value)
+
+    def _trainable_variables(self, scope=""):
+        return self._graph.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, self._name + "/" + scope)
+
     def close(self):
         self._sess.close()
-        tf.reset_default_graph()
 
 
 # 双向LSTM
 class BidirectionalLSTMModel(BasicLSTMModel):
     def __init__(self, time_steps, num_features, n_output, lstm_size, batch_size=64, epochs=1000, output_n_epoch=10,
                  learning_rate=0.01, max_loss=0.5, max_pace=0.01, ridge=0.0, dropout=0.8,
-                 optimizer=tf.train.AdamOptimizer, name="Bi-LSTM"):
+                 optimizer=tf.train.AdamOptimizer, name="Bi-LSTM", cell_impl="basic"):
+        self._cell_impl = cell_impl
         super().__init__(time_steps, num_features, n_output, lstm_size, batch_size, epochs, output_n_epoch,
                          learning_rate, max_loss, max_pace, ridge, dropout, optimizer, name)
 
     def _hidden_layer(self):
+        self._hidden = self._bidirectional_rnn(self._x, output_keep_prob=self._keep_prob)
+
+    def _bidirectional_rnn(self, inputs, input_keep_prob=1.0, output_keep_prob=1.0):
+        """
+        双向LSTM，返回 n_samples×time_steps×2lstm_size
+        cell_impl="basic": BasicLSTMCell + DropoutWrapper，每个时间步一组op
+        cell_impl="fused": LSTMBlockFusedCell 一个kernel处理整个序列，dropout 在cell外面，权重的形状与 basic 相同
+        """
+        mask, length = self._length()
+        if self._cell_impl == "fused":
+            return self._fused_bidirectional_rnn(inputs, length, input_keep_prob, output_keep_prob)
+        if self._cell_impl != "basic":
+            raise ValueError("unknown cell_impl: {}".format(self._cell_impl))
         self._lstm = {}
         self._lstm_dropout = {}
         self._init_state = {}
@@ -145,23 +397,42 @@ class BidirectionalLSTMModel(BasicLSTMModel):
             self._init_state[direction] = self._lstm[direction].zero_state(tf.shape(self._x)[0], tf.float32)
         for direction in ["forward", "backward"]:
             self._lstm_dropout[direction] = tf.contrib.rnn.DropoutWrapper(self._lstm[direction],
-                                                                          output_keep_prob=self._dropout)
-        mask, length = self._length()
-        self._hidden, _ = tf.nn.bidirectional_dynamic_rnn(self._lstm_dropout["forward"],
-                                                          self._lstm_dropout["backward"],
-                                                          self._x,
-                                                          sequence_length=length,
-                                                          initial_state_fw=self._init_state["forward"],
-                                                          initial_state_bw=self._init_state["backward"])
-
-        self._hidden = tf.concat(self._hidden, axis=2)  # n_samples×time_steps×2lstm_size→n_samples×2lstm_size
+                                                                          input_keep_prob=input_keep_prob,
+                                                                          output_keep_prob=output_keep_prob)
+        hidden, _ = tf.nn.bidirectional_dynamic_rnn(self._lstm_dropout["forward"],
+                                                    self._lstm_dropout["backward"],
+                                                    inputs,
+                                                    sequence_length=length,
+                                                    initial_state_fw=self._init_state["forward"],
+                                                    initial_state_bw=self._init_state["backward"])
+        return tf.concat(hidden, axis=2)
+
+    def _fused_bidirectional_rnn(self, inputs, length, input_keep_prob, output_keep_prob):
+        # keep_prob 为 placeholder 时总是加上 dropout，预测时它为1.0
+        if isinstance(input_keep_prob, tf.Tensor) or input_keep_prob < 1.0:
+            inputs = tf.nn.dropout(inputs, keep_prob=input_keep_prob)
+        # LSTMBlockFusedCell 的输入是 time_steps×n_samples×num_features
+        inputs = tf.transpose(inputs, [1, 0, 2])
+        self._lstm = {}
+        with tf.variable_scope("bidirectional_rnn"):
+            for direction, scope in [("forward", "fw"), ("backward", "bw")]:
+                self._lstm[direction] = tf.contrib.rnn.LSTMBlockFusedCell(self._lstm_size, name=scope)
+            hidden_fw, _ = self._lstm["forward"](inputs, dtype=tf.float32, sequence_length=length)
+            # 反向：先按每个病人的真实长度翻转，运行之后再翻转回来
+            reversed_inputs = tf.reverse_sequence(inputs, length, seq_axis=0, batch_axis=1)
+            hidden_bw, _ = self._lstm["backward"](reversed_inputs, dtype=tf.float32, sequence_length=length)
+            hidden_bw = tf.reverse_sequence(hidden_bw, length, seq_axis=0, batch_axis=1)
+        hidden = tf.transpose(tf.concat([hidden_fw, hidden_bw], axis=2), [1, 0, 2])
+        if isinstance(output_keep_prob, tf.Tensor) or output_keep_prob < 1.0:
+            hidden = tf.nn.dropout(hidden, keep_prob=output_keep_prob)
+        return hidden
 
 
 # 添加global attention机制的LSTM
 class AttentionLSTMModel(BidirectionalLSTMModel):
     def __init__(self, time_steps=5, num_features=94, lstm_size=128, n_output=1, batch_size=64, epochs=1000,
                  output_n_epoch=10, learning_rate=0.01, max_loss=0.5, max_pace=0.01, ridge=0.0, dropout=0.8,
-                 optimizer=tf.train.AdamOptimizer, name="AttentionLSTM"):
+                 optimizer=tf.train.AdamOptimizer, name="AttentionLSTM", cell_impl="basic"):
         self._time_steps = time_steps
         self._num_features = num_features
         self._lstm_size = lstm_size
@@ -176,23 +447,27 @@ class AttentionLSTMModel(BidirectionalLSTMModel):
         self._dropout = dropout
         self._optimizer = optimizer
         self._name = name
+        self._history = []
+        self._cell_impl = cell_impl
         print("learning_rate=", learning_rate, "max_loss=", max_loss, "max_pace=", max_pace, "name=", name)
 
-        with tf.variable_scope(self._name):
+        self._graph = tf.Graph()
+        with self._graph.as_default(), tf.variable_scope(self._name):
             self._x = tf.placeholder(dtype=tf.float32, shape=[None, time_steps, num_features], name='input')
             self._y = tf.placeholder(dtype=tf.float32, shape=[None, time_steps, n_output], name='label')
-            self._t = tf.placeholder(dtype=tf.float32, shape=[None, time_steps, n_output], name='time')
-            self._sess = tf.Session()
+            self._t = tf.placeholder(dtype=tf.float32, shape=[None, time_steps, 1], name='time')
+            # 训练时 _train_step 传入 dropout，预测时为默认的1.0，同一输入的结果不变
+            self._keep_prob = tf.placeholder_with_default(1.0, [], name='keep_prob')
+            self._sess = tf.Session(graph=self._graph, config=session_config())
             self._w = tf.Variable(tf.truncated_normal([num_features, num_features], stddev=0.1),
                                   name='attention_weight')
             self._global_attention_mechanism()
             self._hidden_layer()
             self._w_trans = tf.Variable(tf.truncated_normal([2 * self._lstm_size, self._n_output], stddev=1.0),
                                         name='output_weight')
-            self._v = tf.tile(tf.reshape(self._w_trans, [-1, 2 * self._lstm_size, self._n_output]),
-                              [tf.shape(self._x)[0], 1, 1])
-            bias = tf.Variable(tf.random_normal([n_output]))
-            self._output = tf.matmul(self._hidden, self._v) + bias
+            self._bias = tf.Variable(tf.random_normal([n_output]))
+            # (m,time_steps,2lstm_size)×(2lstm_size,n_output)，不再把 output_weight 复制 batch_size 份
+            self._output = tf.tensordot(self._hidden, self._w_trans, axes=[[2], [0]]) + self._bias
             mask, _ = self._length()
             mask = tf.reshape(mask, [-1, self._time_steps, 1])
             # 将激活函修改成tanh
@@ -210,117 +485,147 @@ class AttentionLSTMModel(BidirectionalLSTMModel):
 
             self._train_op = optimizer(learning_rate).minimize(self._loss)
             self._save = tf.train.Saver()
+            self._init_op = tf.global_variables_initializer()
 
     def _global_attention_mechanism(self):
         """
             global attention : return self._z 
         """
-        # attention_weight tensor
-        w_x = tf.tile(tf.reshape(self._w, [-1, self._num_features, self._num_features]), [tf.shape(self._x)[0], 1, 1])
-        # a11...a1m in the graph
-        w_a = tf.matmul(self._x, w_x)
+        # a11...a1m in the graph: (m,time_steps,num_features)×(num_features,num_features)，不复制 attention_weight
+        w_a = tf.tensordot(self._x, self._w, axes=[[2], [0]])
         # softmax in the graph
         self._w_z = tf.nn.softmax(w_a, 2)
         # get the attention output
         self._z = tf.multiply(self._x, self._w_z)
 
     def _hidden_layer(self):
-        self._lstm = {}
-        self._init_state = {}
-        for direction in ['forward', 'backward']:
-            self._lstm[direction] = tf.contrib.rnn.BasicLSTMCell(self._lstm_size)
-            self._init_state[direction] = self._lstm[direction].zero_state(tf.shape(self._x)[0], tf.float32)
-        for direction in ["forward", "backward"]:
-            self._lstm[direction] = tf.contrib.rnn.DropoutWrapper(self._lstm[direction],
-                                                                  output_keep_prob=self._dropout)
-        mask, length = self._length()
-        self._hidden, _ = tf.nn.bidirectional_dynamic_rnn(self._lstm["forward"],
-                                                          self._lstm["backward"],
-                                                          self._z,
-                                                          sequence_length=length,
-                                                          initial_state_fw=self._init_state['forward'],
-                                                          initial_state_bw=self._init_state['backward'])
-        self._hidden = tf.concat(self._hidden, axis=2)
+        self._hidden = self._bidirectional_rnn(self._z, output_keep_prob=self._keep_prob)
+
+    def _feed_dict(self, dynamic_features, labels):
+        return {self._x: dynamic_features[:, :, 1:93],
+                self._y: labels,
+                self._t: dynamic_features[:, :, 0].reshape(-1, dynamic_features.shape[1], 1)}
 
     def fit(self, data_set, test_set):
-        self._sess.run(tf.global_variables_initializer())
+        self.initialize()
+        self._history = []
         data_set.epoch_completed = 0
 
-        for c in tf.trainable_variables(self._name):
+        for c in self._trainable_variables():
             print(c.name)
 
         print("acc\tauc\tepoch\tloss\tloss_diff\tcount")
         logged = set()
         loss = 0
         count = 0
-        while data_set.epoch_completed < self._epochs:
-            dynamic_features, labels = data_set.next_batch(self._batch_size)
-            self._sess.run(self._train_op,
-                           feed_dict={self._x: dynamic_features[:, :, 1:93],
-                                      self._y: labels,
-                                      self._t: dynamic_features[:, :, 0].reshape(-1, dynamic_features.shape[1], 1)})
-            if data_set.epoch_completed % self._output_n_epoch == 0 and data_set.epoch_completed not in logged:
-                logged.add(data_set.epoch_completed)
-                loss_prev = loss
-                loss = self._sess.run(self._loss,
-                                      feed_dict={self._x: data_set.dynamic_features[:,:,1:93].reshape(-1,5,92),
-                                                 self._y: data_set.labels,
-                                                 self._t: data_set.dynamic_features[:,:,0].reshape(-1,5,1)})
-                loss_diff = loss_prev - loss
-                y_score = self.predict(test_set)
-                y_score = y_score.reshape([-1, 1])
-                test_labels = test_set.labels
-                test_labels = test_labels.reshape([-1, 1])
-                auc = roc_auc_score(test_labels, y_score)
-                y_score_pred = [0 for j in range(len(y_score))]
-                for i in range(len(y_score)):
-                    if y_score[i] >= 0.5:
-                        y_score_pred[i] = 1
-                    else:
-                        y_score_pred[i] = 0
-                acc = accuracy_score(test_labels, y_score_pred)
-                print("{}\t{}\t{}\t{}\t{}\t{}".format(acc, auc, data_set.epoch_completed, loss, loss_diff, count),
-                      time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
-
-                # 设置训练停止条件
-                if loss > self._max_loss:
-                    count = 0
-                else:
-                    if loss_diff > self._max_pace:
+        batches = BatchPrefetcher(data_set, self._batch_size, self._epochs, self._feed_dict, self.n_prefetch)
+        running_loss = 0.0
+        running_count = 0
+        try:
+            while batches.epoch_completed < self._epochs:
+                feed_dict = batches.next_batch()
+                batch_loss = self._train_step(feed_dict)
+                if batch_loss is not None:
+                    running_loss += batch_loss * len(feed_dict[self._y])
+                    running_count += len(feed_dict[self._y])
+                if batches.epoch_completed % self._output_n_epoch == 0 and batches.epoch_completed not in logged:
+                    logged.add(batches.epoch_completed)
+                    loss_prev = loss
+                    loss = self._train_loss(data_set, running_loss, running_count)
+                    running_loss = 0.0
+                    running_count = 0
+                    loss_diff = loss_prev - loss
+                    y_score = self.predict(test_set)
+                    test_labels = test_set.labels
+                    auc = horizon_auc(test_labels, y_score)
+                    y_score = y_score.reshape([-1, 1])
+                    test_labels = test_labels.reshape([-1, 1])
+                    y_score_pred = [0 for j in range(len(y_score))]
+                    for i in range(len(y_score)):
+                        if y_score[i] >= 0.5:
+                            y_score_pred[i] = 1
+                        else:
+                            y_score_pred[i] = 0
+                    acc = accuracy_score(test_labels, y_score_pred)
+                    print("{}\t{}\t{}\t{}\t{}\t{}".format(acc, auc, batches.epoch_completed, loss, loss_diff, count),
+                          time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
+                    self._history.append((batches.epoch_completed, float(loss), float(auc)))
+
+                    # 设置训练停止条件
+                    if loss > self._max_loss:
                         count = 0
                     else:
-                        count += 1
-                if count > 9:
-                    break
-        save_path = self._save.save(self._sess, self._name + "model/save_net" +
-                                    time.strftime("%m-%d-%H-%M-%S", time.localtime()) + ".ckpt")
+                        if loss_diff > self._max_pace:
+                            count = 0
+                        else:
+                            count += 1
+                    if count > 9:
+                        break
+        finally:
+            batches.close()
+        save_path = self.save_async(self._checkpoint_path())
         print("Save to path: ", save_path)
 
     def attention_analysis(self, test_dynamic, model):
         #   输入test_set, 读取模型并返回attention的weight
-        saver = tf.train.Saver()
-        saver.restore(self._sess, self._name + "model/" + model)
+        self._save.restore(self._sess, self._name + "model/" + model)
         prob = self._sess.run(self._pred, feed_dict={self._x: test_dynamic[:, :, :]})
         attention_signals = self._sess.run(self._w_z, feed_dict={self._x: test_dynamic[:, :, :]})
         return prob, attention_signals.reshape([-1, self._time_steps, self._num_features])
 
-    # add the neg-partial-likelihood loss function
+    def attention(self, dynamic_features):
+        # 当前权重下的 attention 权重 _w_z，dynamic_features 第0列为时间，1:93 为特征
+        return self._sess.run(self._w_z, feed_dict={self._x: dynamic_features[:, :, 1:93]})
+
+    def export_weights(self, file, model=None):
+        """
+        导出 attention_weight、双向LSTM、output_weight 和 bias 到一个npz文件，供 inference.NumpyAttentionLSTM 使用
+        :param file: 导出的文件名
+        :param model: 要读取的checkpoint，如 "save_net10-17-19-02-53.ckpt"，为None时导出当前session中的权重
+        :return: NumpyAttentionLSTM
+        """
+        if model is not None:
+            self._save.restore(self._sess, self._name + "model/" + model)
+        # 前向、反向的 kernel 和 bias，basic 与 fused 两种 cell_impl 的创建顺序相同
+        fw_kernel, fw_bias, bw_kernel, bw_bias = self._sess.run(
+            self._trainable_variables("bidirectional_rnn/"))
+        attention_weight, output_weight, output_bias = self._sess.run([self._w, self._w_trans, self._bias])
+        engine = NumpyAttentionLSTM(attention_weight,
+                                    {"forward": fw_kernel, "backward": bw_kernel},
+                                    {"forward": fw_bias, "backward": bw_bias},
+                                    output_weight,
+                                    output_bias)
+        engine.save(file)
+        return engine
+
+    def incremental_scorer(self, file, model=None):
+        # 新增就诊时增量计算风险，见 inference.IncrementalScorer
+        return IncrementalScorer(self.export_weights(file, model))
+
+    # add the neg-partial-likelihood loss function, n_output>1 时每个时间窗口分别计算后相加
+    # 风险集是同一次 sess.run 中的样本，predict 分块时打印的 test_loss 见 run_in_chunks
     def log_likelihood(self):
-        risk = tf.reshape(self._pred, [-1])
-        E = tf.reshape(self._y,[-1])
-        sort_idx = tf.argsort(E,direction='DESCENDING')
-        E = tf.gather(E,sort_idx)
-        risk = tf.gather(risk,sort_idx)
-        hazard_ratio = tf.exp(risk)
-        log_risk = tf.log(tf.cumsum(hazard_ratio))
-        uncensored_likelihood = risk - log_risk
-        censored_likelihood = tf.multiply(uncensored_likelihood, E)
-        # num_observed_events = tf.reduce_sum(E)
-        neg_likelihood = -tf.reduce_sum(censored_likelihood) * 0.000005
+        neg_likelihood = 0
+        for horizon in range(self._n_output):
+            risk = tf.reshape(self._pred[:, :, horizon], [-1])
+            E = tf.reshape(self._y[:, :, horizon], [-1])
+            sort_idx = tf.argsort(E,direction='DESCENDING')
+            E = tf.gather(E,sort_idx)
+            risk = tf.gather(risk,sort_idx)
+            hazard_ratio = tf.exp(risk)
+            log_risk = tf.log(tf.cumsum(hazard_ratio))
+            uncensored_likelihood = risk - log_risk
+            censored_likelihood = tf.multiply(uncensored_likelihood, E)
+            # num_observed_events = tf.reduce_sum(E)
+            neg_likelihood += -tf.reduce_sum(censored_likelihood) * 0.000005
         return neg_likelihood
 
 
 class LogisticRegression(object):
+    n_prefetch = 4
+    streaming_evaluation = False
+    eval_chunk_size = 4096
+
     def __init__(self, time_steps, num_features, n_output, batch_size=64, epochs=1000, output_n_epoch=10,
                  learning_rate=0.01, max_loss=0.5, max_pace=0.01, ridge=0.0, dropout=0.8,
                  optimizer=tf.train.AdamOptimizer, name="LogisticRegression"):
@@ -337,12 +642,14 @@ class LogisticRegression(object):
         self._dropout = dropout
         self._optimizer = optimizer
         self._name = name
+        self._history = []
         print("learning_rate=", learning_rate, "max_loss=", max_loss,
               "max_loss=", max_loss, "max_pace=", max_pace, "name=", name)
-        with tf.variable_scope(self._name):
+        self._graph = tf.Graph()
+        with self._graph.as_default(), tf.variable_scope(self._name):
             self._x = tf.placeholder(tf.float32, [None, num_features], name="input")
-            self._y = tf.placeholder(tf.float32, [None, 1], name="label")
-            self._sess = tf.Session()
+            self._y = tf.placeholder(tf.float32, [None, n_output], name="label")
+            self._sess = tf.Session(graph=self._graph, config=session_config())
             self._hidden_layer()
             self._output = tf.contrib.layers.fully_connected(self._hidden, n_output,
                                                              activation_fn=tf.identity)
@@ -350,70 +657,126 @@ class LogisticRegression(object):
             self._loss = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=self._y, logits=self._pred),
                                         name="loss")
             self._train_op = optimizer(learning_rate).minimize(self._loss)
+            self._save = tf.train.Saver()
+            self._init_op = tf.global_variables_initializer()
 
     def _hidden_layer(self):
         self._hidden = self._x
 
+    def _feed_dict(self, dynamic_features, labels):
+        return {self._x: dynamic_features, self._y: labels}
+
+    def initialize(self):
+        self._sess.run(self._init_op)
+
     def fit(self, data_set, test_set):
-        self._sess.run(tf.global_variables_initializer())
+        self.initialize()
+        self._history = []
         data_set.epoch_completed = 0
-        for c in tf.trainable_variables(self._name):
+        for c in self._trainable_variables():
             print(c.name)
 
         print("acc\tauc\tepoch\tloss\tloss_diff\tcount")
         logged = set()
         loss = 0
         count = 0
-        while data_set.epoch_completed < self._epochs:
-            dynamic_features, labels = data_set.next_batch(self._batch_size)
-            self._sess.run(self._train_op, feed_dict={self._x: dynamic_features,
-                                                      self._y: labels})
-            if data_set.epoch_completed % self._output_n_epoch == 0 and data_set.epoch_completed not in logged:
-                logged.add(data_set.epoch_completed)
-                loss_prev = loss
-                loss = self._sess.run(self._loss, feed_dict={self._x: data_set.dynamic_features,
-                                                             self._y: data_set.labels})
-                loss_diff = loss_prev - loss
-                y_score = self.predict(test_set)  # 此处计算和打印auc仅供调参时观察auc变化用，可删除，与最终输出并无关系
-                auc = roc_auc_score(test_set.labels, y_score)
-                y_score_pred = [0 for j in range(len(y_score))]
-                for i in range(len(y_score)):
-                    if y_score[i] >= 0.5:
-                        y_score_pred[i] = 1
-                    else:
-                        y_score_pred[i] = 0
-                acc = accuracy_score(test_set.labels, y_score_pred)
-                print("{}\t{}\t{}\t{}\t{}\t{}".format(acc, auc, data_set.epoch_completed, loss, loss_diff, count),
-                      time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
-
-                # 训练停止条件
-                if loss > self._max_loss:
-                    count = 0
-                else:
-                    if loss_diff > self._max_pace:
+        batches = BatchPrefetcher(data_set, self._batch_size, self._epochs, self._feed_dict, self.n_prefetch)
+        running_loss = 0.0
+        running_count = 0
+        try:
+            while batches.epoch_completed < self._epochs:
+                feed_dict = batches.next_batch()
+                batch_loss = self._train_step(feed_dict)
+                if batch_loss is not None:
+                    running_loss += batch_loss * len(feed_dict[self._y])
+                    running_count += len(feed_dict[self._y])
+                if batches.epoch_completed % self._output_n_epoch == 0 and batches.epoch_completed not in logged:
+                    logged.add(batches.epoch_completed)
+                    loss_prev = loss
+                    loss = self._train_loss(data_set, running_loss, running_count)
+                    running_loss = 0.0
+                    running_count = 0
+                    loss_diff = loss_prev - loss
+                    y_score = self.predict(test_set)  # 此处计算和打印auc仅供调参时观察auc变化用，可删除，与最终输出并无关系
+                    test_labels = test_set.labels
+                    auc = horizon_auc(test_labels, y_score)
+                    y_score = y_score.reshape([-1, 1])
+                    test_labels = test_labels.reshape([-1, 1])
+                    y_score_pred = [0 for j in range(len(y_score))]
+                    for i in range(len(y_score)):
+                        if y_score[i] >= 0.5:
+                            y_score_pred[i] = 1
+                        else:
+                            y_score_pred[i] = 0
+                    acc = accuracy_score(test_labels, y_score_pred)
+                    print("{}\t{}\t{}\t{}\t{}\t{}".format(acc, auc, batches.epoch_completed, loss, loss_diff, count),
+                          time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
+                    self._history.append((batches.epoch_completed, float(loss), float(auc)))
+
+                    # 训练停止条件
+                    if loss > self._max_loss:
                         count = 0
                     else:
-                        count += 1
-                if count > 9:
-                    break
+                        if loss_diff > self._max_pace:
+                            count = 0
+                        else:
+                            count += 1
+                    if count > 9:
+                        break
+        finally:
+            batches.close()
+
+    def _train_step(self, feed_dict):
+        if self.streaming_evaluation:
+            _, loss = self._sess.run([self._train_op, self._loss], feed_dict=feed_dict)
+            return loss
+        self._sess.run(self._train_op, feed_dict=feed_dict)
+        return None
+
+    def _train_loss(self, data_set, running_loss, running_count):
+        if self.streaming_evaluation:
+            return running_loss / max(running_count, 1)
+        return self._sess.run(self._loss, feed_dict=self._feed_dict(data_set.dynamic_features, data_set.labels))
 
     def predict(self, test_set):
-        return self._sess.run(self._pred, feed_dict={self._x: test_set.dynamic_features,
-                                                     self._y: test_set.labels})
+        _, pred = run_in_chunks(self._sess, self._loss, self._pred, self._feed_dict, test_set, self.eval_chunk_size)
+        return pred
+
+    def save(self, path):
+        # 把当前的权重保存到 path，返回checkpoint的路径
+        return self._save.save(self._sess, path)
+
+    def load(self, path):
+        # 读取 save 保存的checkpoint
+        self._save.restore(self._sess, path)
 
     @property
     def name(self):
         return self._name
 
+    @property
+    def history(self):
+        # 最近一次 fit 中每次输出时的 (epoch, loss, 测试集auc)，auc 为各时间窗口auc的平均（见 horizon_auc）
+        return self._history
+
+    def update_training_params(self, **params):
+        # 只修改不影响图结构的参数，如 batch_size、epochs、max_loss、max_pace、output_n_epoch
+        for key, value in params.items():
+            if key not in TRAINING_PARAMS:
+                raise ValueError("{} is part of the graph, build a new model instead".format(key))
+            setattr(self, "_" + key, value)
+
+    def _trainable_variables(self, scope=""):
+        return self._graph.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, self._name + "/" + scope)
+
     def close(self):
         self._sess.close()
-        tf.reset_default_graph()
 
 
 class SelfAttentionLSTMModel(BidirectionalLSTMModel):
     def __init__(self, time_steps, num_features, lstm_size, n_output, batch_size=64, epochs=1000, output_n_epoch=10,
                  learning_rate=0.01, max_loss=0.5, max_pace=0.01, ridge=0.0, dropout=0.8,
-                 optimizer=tf.train.AdamOptimizer, name="LocalAttentionLSTM"):
+                 optimizer=tf.train.AdamOptimizer, name="LocalAttentionLSTM", cell_impl="basic"):
         self._time_steps = time_steps
         self._num_features = num_features
         self._lstm_size = lstm_size
@@ -428,20 +791,24 @@ class SelfAttentionLSTMModel(BidirectionalLSTMModel):
         self._dropout = dropout
         self._optimizer = optimizer
         self._name = name
+        self._history = []
+        self._cell_impl = cell_impl
         print("learning_rate=", learning_rate, "max_loss=", max_loss, "max_pace=", max_pace, "name=", name)
 
-        with tf.variable_scope(self._name):
+        self._graph = tf.Graph()
+        with self._graph.as_default(), tf.variable_scope(self._name):
             self._x = tf.placeholder(tf.float32, [None, time_steps, num_features], 'input')
             self._y = tf.placeholder(tf.float32, [None, time_steps, n_output], 'label')
-            self._sess = tf.Session()
+            # 训练时 _train_step 传入 dropout，预测时为默认的1.0，同一输入的结果不变
+            self._keep_prob = tf.placeholder_with_default(1.0, [], name='keep_prob')
+            self._sess = tf.Session(graph=self._graph, config=session_config())
             self._self_attention_mechanism()
             self._hidden_layer()
             self._w_trans = tf.Variable(tf.truncated_normal([2 * self._lstm_size, self._n_output], stddev=0.1),
                                         name='output_weight')
-            self._v = tf.tile(tf.reshape(self._w_trans, [-1, 2 * self._lstm_size, self._n_output]),
-                              [tf.shape(self._x)[0], 1, 1])
             bias = tf.Variable(tf.random_normal([n_output]))
-            self._output = tf.matmul(self._hidden, self._v) + bias
+            # (m,time_steps,2lstm_size)×(2lstm_size,n_output)，不再把 output_weight 复制 batch_size 份
+            self._output = tf.tensordot(self._hidden, self._w_trans, axes=[[2], [0]]) + bias
             self._pred = tf.nn.tanh(self._output)
             self._loss = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=self._y, logits=self._pred),
                                         name="loss")
@@ -452,6 +819,10 @@ class SelfAttentionLSTMModel(BidirectionalLSTMModel):
 
             self._train_op = optimizer(learning_rate).minimize(self._loss)
             self._save = tf.train.Saver()
+            self._init_op = tf.global_variables_initializer()
+
+    def _predict_feed_dict(self, dynamic_features, labels):
+        return self._feed_dict(dynamic_features, labels)
 
     def _self_attention_mechanism(self):
         """
@@ -462,82 +833,73 @@ class SelfAttentionLSTMModel(BidirectionalLSTMModel):
         self._k = tf.Variable(tf.truncated_normal([self._num_features, dims], stddev=0.1), name='self_attention_k')
         self._v = tf.Variable(tf.truncated_normal([self._num_features, dims], stddev=0.1), name='self_attention_v')
         self._w0 = tf.Variable(tf.truncated_normal([dims, self._num_features], stddev=0.1), name='self_attention_w0')
-        q_trans = tf.tile(tf.reshape(self._q, [-1, self._num_features, dims]), [tf.shape(self._x)[0], 1, 1])
-        k_trans = tf.tile(tf.reshape(self._k, [-1, self._num_features, dims]), [tf.shape(self._x)[0], 1, 1])
-        v_trans = tf.tile(tf.reshape(self._v, [-1, self._num_features, dims]), [tf.shape(self._x)[0], 1, 1])
-        w0 = tf.tile(tf.reshape(self._w0, [-1, dims, self._num_features]), [tf.shape(self._x)[0], 1, 1])
-        q = tf.matmul(self._x, q_trans)
-        k = tf.matmul(self._x, k_trans)
-        v = tf.matmul(self._x, v_trans)
+        # 权重直接与最后一维做 tensordot，不复制 batch_size 份
+        q = tf.tensordot(self._x, self._q, axes=[[2], [0]])
+        k = tf.tensordot(self._x, self._k, axes=[[2], [0]])
+        v = tf.tensordot(self._x, self._v, axes=[[2], [0]])
         self._m = tf.nn.softmax(tf.matmul(tf.matmul(q, tf.transpose(k, [0, 2, 1])), v), 2)
-        self._z = tf.matmul(self._m, w0)
+        self._z = tf.tensordot(self._m, self._w0, axes=[[2], [0]])
 
     def _hidden_layer(self):
-        self._lstm = {}
-        self._init_state = {}
-        for direction in ['forward', 'backward']:
-            self._lstm[direction] = tf.contrib.rnn.BasicLSTMCell(self._lstm_size)
-            self._init_state[direction] = self._lstm[direction].zero_state(tf.shape(self._x)[0], tf.float32)
-        for direction in ["forward", "backward"]:
-            self._lstm[direction] = tf.contrib.rnn.DropoutWrapper(self._lstm[direction],
-                                                                  input_keep_prob=self._dropout,
-                                                                  output_keep_prob=self._dropout)
-        mask, length = self._length()
-        self._hidden, _ = tf.nn.bidirectional_dynamic_rnn(self._lstm['forward'],
-                                                          self._lstm['backward'],
-                                                          self._z,
-                                                          sequence_length=length,
-                                                          initial_state_fw=self._init_state['forward'],
-                                                          initial_state_bw=self._init_state['backward'])
-        self._hidden = tf.concat(self._hidden, axis=2)
+        self._hidden = self._bidirectional_rnn(self._z, input_keep_prob=self._keep_prob,
+                                               output_keep_prob=self._keep_prob)
 
     def fit(self, data_set, test_set):
-        self._sess.run(tf.global_variables_initializer())
+        self.initialize()
+        self._history = []
         data_set.epoch_completed = 0
 
-        for c in tf.trainable_variables(self._name):
+        for c in self._trainable_variables():
             print(c.name)
 
         print("acc\tauc\tepoch\tloss\tloss_diff\tcount")
         logged = set()
         loss = 0
         count = 0
-        while data_set.epoch_completed < self._epochs:
-            dynamic_features, labels = data_set.next_batch(self._batch_size)
-            self._sess.run(self._train_op, feed_dict={self._x: dynamic_features,
-                                                      self._y: labels})
-            if data_set.epoch_completed % self._output_n_epoch == 0 and data_set.epoch_completed not in logged:
-                logged.add(data_set.epoch_completed)
-                loss_prev = loss
-                loss = self._sess.run(self._loss, feed_dict={self._x: data_set.dynamic_features,
-                                                             self._y: data_set.labels})
-                loss_diff = loss_prev - loss
-                y_score = self.predict(test_set)
-                y_score = y_score.reshape([-1, 1])
-                test_labels = test_set.labels
-                test_labels = test_labels.reshape([-1, 1])
-                auc = roc_auc_score(test_labels, y_score)
-                y_score_pred = [0 for j in range(len(y_score))]
-                for i in range(len(y_score)):
-                    if y_score[i] >= 0.5:
-                        y_score_pred[i] = 1
-                    else:
-                        y_score_pred[i] = 0
-                acc = accuracy_score(test_labels, y_score_pred)
-                print("{}\t{}\t{}\t{}\t{}\t{}".format(acc, auc, data_set.epoch_completed, loss, loss_diff, count),
-                      time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
-
-                # 设置训练停止条件
-                if loss > self._max_loss:
-                    count = 0
-                else:
-                    if loss_diff > self._max_pace:
+        batches = BatchPrefetcher(data_set, self._batch_size, self._epochs, self._feed_dict, self.n_prefetch)
+        running_loss = 0.0
+        running_count = 0
+        try:
+            while batches.epoch_completed < self._epochs:
+                feed_dict = batches.next_batch()
+                batch_loss = self._train_step(feed_dict)
+                if batch_loss is not None:
+                    running_loss += batch_loss * len(feed_dict[self._y])
+                    running_count += len(feed_dict[self._y])
+                if batches.epoch_completed % self._output_n_epoch == 0 and batches.epoch_completed not in logged:
+                    logged.add(batches.epoch_completed)
+                    loss_prev = loss
+                    loss = self._train_loss(data_set, running_loss, running_count)
+                    running_loss = 0.0
+                    running_count = 0
+                    loss_diff = loss_prev - loss
+                    y_score = self.predict(test_set)
+                    test_labels = test_set.labels
+                    auc = horizon_auc(test_labels, y_score)
+                    y_score = y_score.reshape([-1, 1])
+                    test_labels = test_labels.reshape([-1, 1])
+                    y_score_pred = [0 for j in range(len(y_score))]
+                    for i in range(len(y_score)):
+                        if y_score[i] >= 0.5:
+                            y_score_pred[i] = 1
+                        else:
+                            y_score_pred[i] = 0
+                    acc = accuracy_score(test_labels, y_score_pred)
+                    print("{}\t{}\t{}\t{}\t{}\t{}".format(acc, auc, batches.epoch_completed, loss, loss_diff, count),
+                          time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
+                    self._history.append((batches.epoch_completed, float(loss), float(auc)))
+
+                    # 设置训练停止条件
+                    if loss > self._max_loss:
                         count = 0
                     else:
-                        count += 1
-                if count > 9:
-                    break
-        save_path = self._save.save(self._sess, self._name + "model/save_net" +
-                                    time.strftime("%m-%d-%H-%M-%S", time.localtime())
-                                    + ".ckpt")
+                        if loss_diff > self._max_pace:
+                            count = 0
+                        else:
+                            count += 1
+                    if count > 9:
+                        break
+        finally:
+            batches.close()
+        save_path = self.save_async(self._checkpoint_path())
         print("Save to path: ", save_path)
@@ -0,0 +1,228 @@
+import importlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from feature_store import file_hash
+
+FEATURES_CSV = 'E:\\survival analysis\\resources\\合并特征值之后的特征.csv'
+LABELS_CSV = 'E:\\survival analysis\\resources\\预处理后的长期纵向数据_标签.csv'
+
+
+class Stage(object):
+    """
+        流水线中的一步：target 为 "模块:函数"（可以是 "模块:类.方法"），在子进程中才 import，
+        inputs / outputs 为读写的文件
+    """
+    def __init__(self, name, target, inputs, outputs):
+        self._name = name
+        self._target = target
+        self._inputs = list(inputs)
+        self._outputs = list(outputs)
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def target(self):
+        return self._target
+
+    @property
+    def inputs(self):
+        return self._inputs
+
+    @property
+    def outputs(self):
+        return self._outputs
+
+
+# Process → data → experiment 的全部步骤，原来分散在三个 __main__ 中按顺序手动运行
+STAGES = [
+    Stage("features", "Process:get_all_patients_features", [FEATURES_CSV], ["allPatientFeatures_merge.npy"]),
+    Stage("labels", "Process:get_all_patients_labels", [LABELS_CSV], ["allPatientLabels_merge_1.npy"]),
+    Stage("ragged", "Process:get_all_patients_ragged", [FEATURES_CSV, LABELS_CSV],
+          ["allPatientFeatures_merge_ragged.npz", "allPatientLabels_merge_1_ragged.npz"]),
+    Stage("normalize_time", "Process:read_features", ["allPatientFeatures_right.npy"], ["allPatientFeatures1.npy"]),
+    Stage("pick_5_visit", "data:pick_5_visit", ["allPatientFeatures_merge.npy", "allPatientLabels_merge_1.npy"],
+          ["pick_5_visit_features_merge_1.npy", "pick_5_visit_labels_merge_1.npy"]),
+    Stage("attention_weights", "experiment:save_attention_weight_repeats",
+          ["pick_5_visit_features_merge_1.npy", "pick_5_visit_labels_merge_1.npy"],
+          ["allAttentionWeight_{}.npy".format(i) for i in range(1, 6)]),
+    Stage("average_weight", "experiment:get_average_weight",
+          ["allAttentionWeight_{}.npy".format(i) for i in range(1, 6)], ["average_weight.npy"]),
+    Stage("cluster", "experiment:AttentionBiLSTMExperiments.cluster_by_attention_weight",
+          ["average_weight.npy"], ["all_features_breaks_ave.npy"]),
+    Stage("stages", "experiment:AttentionBiLSTMExperiments.get_stages",
+          ["all_features_breaks_ave.npy", "average_weight.npy"],
+          ["all_patient_stage_ave.npy", "all_patient_score_ave.npy"]),
+]
+
+
+def _run_target(target):
+    module, attribute = target.split(":")
+    function = importlib.import_module(module)
+    for name in attribute.split("."):
+        function = getattr(function, name)
+    function()
+
+
+class Pipeline(object):
+    """
+        按输入输出文件推出各步之间的依赖，只重新运行过期的步骤：输出不存在、输入或输出的内容hash与上次运行时不同，
+        或者上游重新运行之后输入发生了变化。互相独立的步骤在进程池中同时运行
+    """
+    def __init__(self, stages=None, state_file="pipeline_state.json", n_workers=4):
+        self._stages = {stage.name: stage for stage in (STAGES if stages is None else stages)}
+        self._state_file = state_file
+        self._n_workers = n_workers
+        self._producer = {}
+        for stage in self._stages.values():
+            for output in stage.outputs:
+                if output in self._producer:
+                    raise ValueError("{} is written by both {} and {}".format(output, self._producer[output],
+                                                                              stage.name))
+                self._producer[output] = stage.name
+        self._upstream = {name: sorted({self._producer[file] for file in stage.inputs if file in self._producer})
+                          for name, stage in self._stages.items()}
+        self._check_acyclic()
+        self._state = {}
+        if os.path.exists(state_file):
+            with open(state_file, 'r') as f:
+                self._state = json.load(f)
+
+    def _check_acyclic(self):
+        visiting, visited = set(), set()
+
+        def visit(name):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError("pipeline has a cycle through {}".format(name))
+            visiting.add(name)
+            for upstream in self._upstream[name]:
+                visit(upstream)
+            visiting.discard(name)
+            visited.add(name)
+
+        for name in self._stages:
+            visit(name)
+
+    def _required(self, targets):
+        # targets 及其所有上游
+        required = set()
+        pending = list(self._stages if targets is None else targets)
+        while pending:
+            name = pending.pop()
+            if name not in self._stages:
+                raise ValueError("unknown stage: {}".format(name))
+            if name not in required:
+                required.add(name)
+                pending.extend(self._upstream[name])
+        return required
+
+    @staticmethod
+    def _hashes(files):
+        return {file: file_hash(file) if os.path.exists(file) else None for file in files}
+
+    def is_stale(self, name):
+        stage = self._stages[name]
+        entry = self._state.get(name)
+        # 没有完整记录（如旧版本写入的失败步骤）时重新运行
+        if entry is None or "inputs" not in entry or "outputs" not in entry:
+            return True
+        if any(not os.path.exists(file) for file in stage.outputs):
+            return True
+        return self._hashes(stage.inputs) != entry["inputs"] or self._hashes(stage.outputs) != entry["outputs"]
+
+    def run(self, targets=None, force=()):
+        """
+        :param targets: 要得到的步骤名，默认为全部
+        :param force: 无论是否过期都重新运行的步骤名
+        :return: 实际运行了的步骤名
+        """
+        required = self._required(targets)
+        done, failed, ran = set(), {}, []
+        running = {}
+        # 运行开始时的输入hash，只在成功后写入 state
+        pending_inputs = {}
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(self._n_workers, mp_context=context) as pool:
+            while True:
+                ready = [name for name in sorted(required - done - set(failed) - set(running.values()))
+                         if all(upstream in done for upstream in self._upstream[name])]
+                for name in ready:
+                    stage = self._stages[name]
+                    missing = [file for file in stage.inputs if not os.path.exists(file)]
+                    if missing:
+                        failed[name] = "missing inputs: {}".format(missing)
+                    elif name in force or self.is_stale(name):
+                        print("run", name, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
+                        running[pool.submit(_run_target, stage.target)] = name
+                        pending_inputs[name] = self._hashes(stage.inputs)
+                    else:
+                        done.add(name)
+                if ready and not running:
+                    continue
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                        self._finish(name, pending_inputs.pop(name))
+                        done.add(name)
+                        ran.append(name)
+                    except Exception as e:
+                        pending_inputs.pop(name, None)
+                        failed[name] = repr(e)
+        # 上游失败的步骤不会运行
+        skipped = sorted(required - done - set(failed))
+        if failed or skipped:
+            raise RuntimeError("failed: {}, skipped: {}".format(failed, skipped))
+        return ran
+
+    def _finish(self, name, inputs):
+        stage = self._stages[name]
+        missing = [file for file in stage.outputs if not os.path.exists(file)]
+        if missing:
+            raise RuntimeError("{} did not write {}".format(name, missing))
+        # 记录运行开始时的输入hash，运行期间输入被修改时下次会重新运行
+        self._state[name] = {"inputs": inputs,
+                             "outputs": self._hashes(stage.outputs),
+                             "finished": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())}
+        with open(self._state_file, 'w') as f:
+            json.dump(self._state, f, indent=2, ensure_ascii=False)
+
+    def stale(self, targets=None):
+        # 不运行，列出过期的步骤以及会因此重新运行的下游步骤
+        required = self._required(targets)
+        stale = set()
+        for name in self._topological_order():
+            if name in required and (self.is_stale(name) or any(up in stale for up in self._upstream[name])):
+                stale.add(name)
+        return [name for name in self._topological_order() if name in stale]
+
+    def _topological_order(self):
+        order = []
+
+        def visit(name):
+            if name in order:
+                return
+            for upstream in self._upstream[name]:
+                visit(upstream)
+            order.append(name)
+
+        for name in self._stages:
+            visit(name)
+        return order
+
+
+if __name__ == '__main__':
+    import sys
+    # python pipeline.py [步骤名 ...]
+    pipeline = Pipeline()
+    print("stale:", pipeline.stale(sys.argv[1:] or None))
+    print("ran:", pipeline.run(sys.argv[1:] or None))
@@ -0,0 +1,106 @@
+import os
+import numpy as np
+import pandas as pd
+
+GROUPS = np.array(["tn", "fp", "fn", "tp"])
+METRICS = ["acc", "auc", "recall", "precision", "f1-score", "threshold"]
+
+
+def confusion_group(y_label, y_pred_label):
+    # 每个样本属于 tn/fp/fn/tp 中的哪一组
+    return GROUPS[2 * np.asarray(y_label, dtype=np.int64).reshape(-1) +
+                  np.asarray(y_pred_label, dtype=np.int64).reshape(-1)]
+
+
+def group_feature_frequency(samples, test_index, y_label, y_pred_label, chunk_size=65536):
+    """
+    每个特征在 tn/fp/fn/tp 各组中出现（不为0）的次数和比例
+    用布尔mask做一次矩阵乘法得到全部组和特征的计数，按 chunk_size 行分块，内存与测试集大小无关
+    :param samples: 每次入院记录的特征，n_visits×92，按 test_index 取行
+    :return: DataFrame，每个特征一行，列为 feature 和每组的 "<组>_count"、"<组>_rate"
+    """
+    test_index = np.asarray(test_index, dtype=np.int64).reshape(-1)
+    group = confusion_group(y_label, y_pred_label)
+    group_mask = (group[:, np.newaxis] == GROUPS[np.newaxis, :]).astype(np.float64)
+    counts = np.zeros((len(GROUPS), samples.shape[1]))
+    for start in range(0, len(test_index), chunk_size):
+        present = np.asarray(samples[test_index[start:start + chunk_size]]) != 0
+        counts += group_mask[start:start + chunk_size].T @ present
+    group_sizes = group_mask.sum(axis=0)
+    rates = counts / np.maximum(group_sizes, 1)[:, np.newaxis]
+    frequency = {"feature": np.arange(samples.shape[1])}
+    for k, name in enumerate(GROUPS):
+        frequency[name + "_count"] = counts[k].astype(np.int64)
+        frequency[name + "_rate"] = rates[k]
+    return pd.DataFrame(frequency, columns=list(frequency))
+
+
+def write_report(file_name, test_index, y_label, y_score, y_pred_label, fpr, tpr, thresholds, metrics, fmt="csv",
+                 samples=None):
+    """
+    按列整体写出 evaluate 的结果，没有行数限制
+    fmt="csv"：file_name + " predictions.csv"、" roc.csv"、" metrics.csv" 三个文件
+    fmt="npz"：file_name + ".npz" 一个文件
+    fmt="parquet"：同 csv 的三个表，保存为 .parquet（需要 pyarrow 或 fastparquet）
+    :param metrics: {"acc", "auc", "recall", "precision", "f1-score", "threshold"}
+    :param samples: 给出时同时写出 group_feature_frequency 的结果，csv/parquet 为 " frequency" 表，
+                    npz 中为 "frequency_<列名>"
+    :return: 写出的文件
+    """
+    y_label = np.asarray(y_label).reshape(-1)
+    y_pred_label = np.asarray(y_pred_label).reshape(-1)
+    predictions = {"test_index": np.asarray(test_index, dtype=np.int64).reshape(-1),
+                   "label": y_label.astype(np.int64),
+                   "prob": np.asarray(y_score, dtype=np.float64).reshape(-1),
+                   "pre": y_pred_label.astype(np.int64),
+                   "group": confusion_group(y_label, y_pred_label)}
+    roc = {"fpr": np.asarray(fpr), "tpr": np.asarray(tpr), "thresholds": np.asarray(thresholds, dtype=np.float64)}
+    metrics = {name: [float(metrics[name])] for name in METRICS}
+    tables = [("predictions", predictions), ("roc", roc), ("metrics", metrics)]
+    if samples is not None:
+        frequency = group_feature_frequency(samples, test_index, y_label, y_pred_label)
+        tables.append(("frequency", {name: frequency[name].values for name in frequency.columns}))
+    if fmt == "npz":
+        file = file_name + ".npz"
+        columns = dict(predictions, **roc)
+        columns.update({name: np.array(value) for name, value in metrics.items()})
+        if samples is not None:
+            columns.update({"frequency_" + name: value for name, value in tables[-1][1].items()})
+        np.savez(file, **columns)
+        return [file]
+    if fmt not in ("csv", "parquet"):
+        raise ValueError("unknown report format: {}".format(fmt))
+    files = []
+    for table_name, columns in tables:
+        table = pd.DataFrame(columns, columns=list(columns))
+        file = "{} {}.{}".format(file_name, table_name, fmt)
+        if fmt == "csv":
+            table.to_csv(file, index=False)
+        else:
+            table.to_parquet(file, index=False)
+        files.append(file)
+    return files
+
+
+def read_report(file_name, fmt="csv"):
+    """
+    读回 write_report 写出的结果
+    :return: {"predictions": DataFrame, "roc": DataFrame, "metrics": dict}，写出了特征频率时还有 "frequency": DataFrame
+    """
+    if fmt == "npz":
+        with np.load(file_name + ".npz") as result:
+            data = {name: result[name] for name in result.files}
+        tables = {"predictions": pd.DataFrame({name: data[name] for name in
+                                               ["test_index", "label", "prob", "pre", "group"]}),
+                  "roc": pd.DataFrame({name: data[name] for name in ["fpr", "tpr", "thresholds"]}),
+                  "metrics": {name: float(data[name][0]) for name in METRICS}}
+        frequency = [name for name in data if name.startswith("frequency_")]
+        if frequency:
+            tables["frequency"] = pd.DataFrame({name[len("frequency_"):]: data[name] for name in frequency})
+        return tables
+    read = pd.read_csv if fmt == "csv" else pd.read_parquet
+    tables = {name: read("{} {}.{}".format(file_name, name, fmt)) for name in ["predictions", "roc", "metrics"]}
+    tables["metrics"] = tables["metrics"].iloc[0].to_dict()
+    if os.path.exists("{} frequency.{}".format(file_name, fmt)):
+        tables["frequency"] = read("{} frequency.{}".format(file_name, fmt))
+    return tables
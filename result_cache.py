@@ -0,0 +1,135 @@
+import hashlib
+import os
+import shutil
+import uuid
+import numpy as np
+
+
+def array_fingerprint(array, sha1=None):
+    """
+    数组内容的sha1，包括 dtype 和 shape。RaggedVisits、CompactFeatures 等对象按其中的数组计算
+    """
+    sha1 = hashlib.sha1() if sha1 is None else sha1
+    if isinstance(array, np.ndarray):
+        sha1.update(str(array.dtype).encode("utf-8"))
+        sha1.update(str(array.shape).encode("utf-8"))
+        sha1.update(np.ascontiguousarray(array).data)
+    elif hasattr(array, "__dict__"):
+        sha1.update(type(array).__name__.encode("utf-8"))
+        for name in sorted(vars(array)):
+            sha1.update(name.encode("utf-8"))
+            array_fingerprint(vars(array)[name], sha1)
+    else:
+        sha1.update(repr(array).encode("utf-8"))
+    return sha1.hexdigest()
+
+
+class ResultCache(object):
+    """
+        按内容寻址的每折结果缓存：模型类、ExperimentSetup、折的下标和输入数组相同时直接返回上次的 prediction 和 label。
+        每个条目是 root 下的一个目录，包括 result.npz 和模型的checkpoint，目录的修改时间即最近使用时间，
+        总大小超过 max_bytes 时删除最久没有使用的条目。条目先写到临时目录再改名，多个进程可以同时使用
+    """
+    def __init__(self, root="result_cache", max_bytes=2 << 30):
+        self._root = root
+        self._max_bytes = max_bytes
+        self._fingerprints = {}
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def key(self, *parts):
+        """
+        :param parts: 字符串、数字、元组或数组，如 (模型名, setup.all, train_index, test_index, dynamic_features, labels)
+        :return: 缓存的key
+        """
+        sha1 = hashlib.sha1()
+        for part in parts:
+            sha1.update(self._fingerprint(part).encode("utf-8"))
+        return sha1.hexdigest()
+
+    def _fingerprint(self, part):
+        if isinstance(part, (str, int, float, tuple)):
+            return repr(part)
+        # 同一个数据集在各折中重复出现，只计算一次
+        cached = self._fingerprints.get(id(part))
+        if cached is not None and cached[0] is part:
+            return cached[1]
+        fingerprint = array_fingerprint(part)
+        if not isinstance(part, np.ndarray) or part.size > 1 << 16:
+            self._fingerprints[id(part)] = (part, fingerprint)
+        return fingerprint
+
+    def _path(self, key):
+        return os.path.join(self._root, key)
+
+    def get(self, key):
+        """
+        :return: (prediction, label)，没有缓存时为None
+        """
+        path = self._path(key)
+        if not os.path.exists(os.path.join(path, "result.npz")):
+            return None
+        with np.load(os.path.join(path, "result.npz")) as result:
+            prediction, labels = result["prediction"], result["labels"]
+        os.utime(path, None)
+        return prediction, labels
+
+    def checkpoint(self, key):
+        # 缓存的模型checkpoint路径，可以直接传给 tf.train.Saver.restore
+        return os.path.join(os.path.abspath(self._path(key)), "model.ckpt")
+
+    def put(self, key, prediction, labels, model=None):
+        """
+        :param model: 有 save(path) 方法的模型，同时保存当前的权重
+        """
+        path = self._path(key)
+        if os.path.exists(path):
+            if model is None or os.path.exists(self.checkpoint(key) + ".index"):
+                os.utime(path, None)
+                return
+            # 原来的条目没有checkpoint，换成新的
+            shutil.rmtree(path, ignore_errors=True)
+        tmp = os.path.join(self._root, ".tmp-" + uuid.uuid4().hex)
+        os.makedirs(tmp)
+        np.savez(os.path.join(tmp, "result.npz"), prediction=prediction, labels=labels)
+        if model is not None:
+            model.save(os.path.join(os.path.abspath(tmp), "model.ckpt"))
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # 另一个进程已经写好了同一个条目
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        # 按最近使用时间从旧到新删除，直到总大小不超过 max_bytes
+        entries = []
+        for name in os.listdir(self._root):
+            path = os.path.join(self._root, name)
+            if name.startswith(".tmp-") or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(directory, file))
+                       for directory, _, files in os.walk(path) for file in files)
+            entries.append((os.path.getmtime(path), size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+        return total
+
+    def clear(self):
+        shutil.rmtree(self._root, ignore_errors=True)
+        os.makedirs(self._root)
+
+
+_default_cache = None
+
+
+def default_cache():
+    # 每个进程共用一个 ResultCache
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ResultCache()
+    return _default_cache
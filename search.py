@@ -0,0 +1,182 @@
+import json
+import math
+import os
+import time
+from concurrent.futures import as_completed
+import numpy as np
+from experiment import ExperimentSetup, worker_pool, AttentionBiLSTMExperiments
+
+# 可以搜索的 ExperimentSetup 字段，epoch 由 successive halving 的每一轮决定
+SEARCH_FIELDS = ("learning_rate", "max_loss", "max_pace", "ridge", "batch_size", "hidden_size", "dropout")
+
+
+def sample_params(space, base_setup, random_state):
+    """
+    :param space: {字段: 取值}，取值为列表时从中选一个，为 (low, high) 时均匀采样（两端都是int时采样整数），
+                  为 (low, high, "log") 时在对数尺度上均匀采样
+    :param base_setup: space 中没有的字段取 base_setup 的值
+    :return: {字段: 值}
+    """
+    params = {name: getattr(base_setup, name) for name in SEARCH_FIELDS}
+    for name, values in space.items():
+        if name not in SEARCH_FIELDS:
+            raise ValueError("unknown ExperimentSetup field: {}".format(name))
+        if isinstance(values, list):
+            value = values[random_state.randint(len(values))]
+        elif len(values) == 3 and values[2] == "log":
+            value = math.exp(random_state.uniform(math.log(values[0]), math.log(values[1])))
+        elif isinstance(values[0], int) and isinstance(values[1], int):
+            value = random_state.randint(values[0], values[1] + 1)
+        else:
+            value = random_state.uniform(values[0], values[1])
+        params[name] = value.item() if isinstance(value, np.generic) else value
+    return params
+
+
+def trial_score(history, last=3):
+    """
+    :param history: 模型的 history，[(epoch, loss, auc)]
+    :return: 最后 last 次输出的验证集auc的平均，比只看最后一次的auc稳定；没有有效的auc时为None
+    """
+    aucs = [auc for _, _, auc in history[-last:] if auc is not None and not np.isnan(auc)]
+    return float(np.mean(aucs)) if aucs else None
+
+
+def run_trial(experiment_class, horizon, params, epochs, fold=0):
+    """
+    在进程池中训练一个试验：只用第 fold 折的训练集，从中分出验证集（见 validation_split），
+    从头训练 epochs 轮（不从上一轮的checkpoint继续），用 fit 中最后几次输出的验证集auc作为结果。
+    第 fold 折的测试集不参与选择
+    :return: {"auc": trial_score, "last_auc": 最后一次输出的auc, "history": [(epoch, loss, auc)], "seconds": 用时}
+    """
+    start = time.time()
+    # 每个试验的图结构可能不同，不使用进程中缓存的模型，用完即关闭
+    experiment = experiment_class(horizon, ExperimentSetup(epoch=epochs, **params), reuse_graph=False)
+    train_index, _ = experiment.folds()[fold]
+    train_index, validation_index = experiment.validation_split(train_index)
+    # 不经过 result_cache：命中时不训练，history 为空
+    experiment._fit_fold(train_index, validation_index)
+    history = experiment.model.history
+    experiment.model.close()
+    return {"auc": trial_score(history),
+            "last_auc": history[-1][2] if history else None,
+            "history": history,
+            "seconds": time.time() - start}
+
+
+class SuccessiveHalving(object):
+    """
+        在 ExperimentSetup 的字段上随机搜索超参数，用 successive halving 提前淘汰差的试验：
+        第 k 轮每个试验从头训练 min_epochs×eta^k 轮，只保留 trial_score 最高的 1/eta 进入下一轮。
+        每个试验的参数和每一轮的结果都追加写入 directory/trials.jsonl，中断后用同一个 directory 重新 run 即可继续
+    """
+    def __init__(self, space, experiment_class=AttentionBiLSTMExperiments, horizon=None, n_trials=27,
+                 min_epochs=5, max_epochs=45, eta=3, n_workers=None, directory="search", seed=0):
+        """
+        :param space: 见 sample_params
+        :param experiment_class: 如 AttentionBiLSTMExperiments，space 以外的字段取它的类属性 setup
+        :param n_trials: 第一轮的试验个数
+        :param n_workers: 同时运行的试验数，默认为 ExperimentSetup.n_workers
+        """
+        self._space = space
+        self._experiment_class = experiment_class
+        self._horizon = horizon
+        self._n_trials = n_trials
+        self._min_epochs = min_epochs
+        self._max_epochs = max_epochs
+        self._eta = eta
+        self._n_workers = n_workers
+        self._directory = directory
+        self._seed = seed
+        self._file = os.path.join(directory, "trials.jsonl")
+        self._trials = {}
+        self._results = {}
+
+    @property
+    def rungs(self):
+        # 每一轮的训练轮数
+        epochs = []
+        rung_epochs = self._min_epochs
+        while rung_epochs < self._max_epochs:
+            epochs.append(rung_epochs)
+            rung_epochs *= self._eta
+        epochs.append(self._max_epochs)
+        return epochs
+
+    def _load(self):
+        self._trials = {}
+        self._results = {}
+        if not os.path.exists(self._file):
+            return
+        with open(self._file, 'r') as f:
+            for line in f:
+                record = json.loads(line)
+                if record["type"] == "trial":
+                    self._trials[record["trial"]] = record["params"]
+                else:
+                    self._results[(record["trial"], record["rung"])] = record
+
+    def _append(self, record):
+        with open(self._file, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+
+    def _sample_trials(self):
+        # 参数只在第一次运行时采样，继续搜索时从文件中读取
+        random_state = np.random.RandomState(self._seed)
+        for trial in range(self._n_trials):
+            params = sample_params(self._space, self._experiment_class.setup, random_state)
+            if trial not in self._trials:
+                self._trials[trial] = params
+                self._append({"type": "trial", "trial": trial, "params": params})
+
+    def _score(self, trial, rung):
+        auc = self._results[(trial, rung)].get("auc")
+        return -np.inf if auc is None or np.isnan(auc) else auc
+
+    def run(self):
+        """
+        :return: 最后一轮auc最高的试验 {"trial", "params", "auc"}
+        """
+        if not os.path.exists(self._directory):
+            os.makedirs(self._directory)
+        self._load()
+        self._sample_trials()
+        alive = list(range(self._n_trials))
+        with worker_pool(self._n_workers) as pool:
+            for rung, epochs in enumerate(self.rungs):
+                pending = [trial for trial in alive if (trial, rung) not in self._results]
+                futures = {pool.submit(run_trial, self._experiment_class, self._horizon, self._trials[trial],
+                                       epochs): trial for trial in pending}
+                for future in as_completed(futures):
+                    trial = futures[future]
+                    record = {"type": "result", "trial": trial, "rung": rung, "epochs": epochs}
+                    try:
+                        record.update(future.result())
+                    except Exception as e:
+                        record.update({"auc": None, "error": repr(e)})
+                    self._results[(trial, rung)] = record
+                    self._append(record)
+                    print("rung {}\ttrial {}\tepochs {}\tauc {}".format(rung, trial, epochs, record["auc"]),
+                          time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
+                alive = sorted(alive, key=lambda trial: self._score(trial, rung), reverse=True)
+                if rung < len(self.rungs) - 1:
+                    alive = alive[:max(1, len(alive) // self._eta)]
+        best = alive[0]
+        return {"trial": best, "params": self._trials[best], "auc": self._score(best, len(self.rungs) - 1)}
+
+    def results(self):
+        # 所有已完成的 (试验, 轮) 的结果
+        self._load()
+        return [self._results[key] for key in sorted(self._results)]
+
+
+if __name__ == '__main__':
+    search = SuccessiveHalving({"learning_rate": (1e-4, 1e-1, "log"),
+                                "max_loss": (0.05, 2.0),
+                                "max_pace": (1e-4, 1e-2, "log"),
+                                "ridge": (1e-5, 1e-2, "log"),
+                                "batch_size": [16, 32, 64, 128],
+                                "hidden_size": [64, 128, 256],
+                                "dropout": (0.5, 1.0)},
+                               n_workers=8)
+    print(search.run())
@@ -0,0 +1,212 @@
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+LOCAL_HOSTS = ("127.0.0.1", "localhost", "::1")
+
+
+class MicroBatcher(object):
+    """
+        把并发的打分请求合并成一个batch，只调用一次 score_fn
+        第一个请求到达后最多再等待 max_wait 秒，或者凑满 max_batch_size 个病人就开始计算
+    """
+    def __init__(self, score_fn, max_batch_size=256, max_wait=0.005, n_statistics=10000):
+        """
+        :param score_fn: score_fn(dynamic_features) 返回 n_samples×time_steps×n_output 的预测，如 model.score
+        :param max_batch_size: 每个batch最多的病人数
+        :param max_wait: 凑batch时最多等待的秒数
+        :param n_statistics: 统计延迟时保留的最近请求数
+        """
+        self._score_fn = score_fn
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait
+        self._requests = queue.Queue()
+        self._latency = []
+        self._batch_sizes = []
+        self._n_statistics = n_statistics
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, dynamic_features):
+        """
+        :param dynamic_features: 一个或多个病人，n_samples×time_steps×93
+        :return: 这些病人的预测
+        """
+        request = {"features": dynamic_features, "done": threading.Event(), "start": time.time()}
+        self._requests.put(request)
+        request["done"].wait()
+        if "error" in request:
+            raise RuntimeError("scoring failed: {!r}".format(request["error"])) from request["error"]
+        return request["prediction"]
+
+    def _collect(self):
+        try:
+            first = self._requests.get(timeout=0.1)
+        except queue.Empty:
+            return []
+        batch = [first]
+        n_samples = len(first["features"])
+        deadline = time.time() + self._max_wait
+        while n_samples < self._max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            n_samples += len(request["features"])
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._collect()
+            if not batch:
+                continue
+            sizes = [len(request["features"]) for request in batch]
+            try:
+                prediction = self._score_fn(np.concatenate([request["features"] for request in batch]))
+                for request, part in zip(batch, np.split(prediction, np.cumsum(sizes)[:-1])):
+                    request["prediction"] = part
+            except Exception as e:
+                for request in batch:
+                    request["error"] = e
+            end = time.time()
+            with self._lock:
+                self._batch_sizes.append(sum(sizes))
+                self._latency.extend(end - request["start"] for request in batch)
+                del self._batch_sizes[:-self._n_statistics]
+                del self._latency[:-self._n_statistics]
+            for request in batch:
+                request["done"].set()
+
+    def statistics(self):
+        """
+        :return: 最近请求的 p50/p99 延迟(毫秒)，平均batch大小和batch填充率
+        """
+        with self._lock:
+            latency = np.array(self._latency) * 1000
+            batch_sizes = np.array(self._batch_sizes, dtype=np.float64)
+        if len(latency) == 0:
+            return {"requests": 0, "batches": 0}
+        return {"requests": len(latency),
+                "batches": len(batch_sizes),
+                "p50_ms": float(np.percentile(latency, 50)),
+                "p99_ms": float(np.percentile(latency, 99)),
+                "mean_batch_size": float(batch_sizes.mean()),
+                "batch_fill": float(np.mean(np.minimum(batch_sizes / self._max_batch_size, 1.0)))}
+
+    def close(self):
+        self._stop.set()
+        self._worker.join()
+
+
+class ScoringService(object):
+    """
+        本机HTTP打分服务，每个模型一个常驻的session和一个 MicroBatcher
+        POST /score/<模型名>  {"dynamic_features": 一个病人 time_steps×93，或多个病人 n×time_steps×93}
+                               就诊次数少于模型的 time_steps 时在后面补0
+        GET  /stats           每个模型的延迟和batch统计
+    """
+    def __init__(self, models, host="127.0.0.1", port=8000, max_batch_size=256, max_wait=0.005):
+        """
+        :param models: 训练好的模型列表，如 [AttentionLSTMModel, BidirectionalLSTMModel]，按 model.name 访问
+        """
+        if host not in LOCAL_HOSTS:
+            raise ValueError("scoring service only listens on localhost, got {}".format(host))
+        self._models = {model.name: model for model in models}
+        self._batchers = {}
+        for model in models:
+            # 先跑一次，避免第一个请求承担图的初始化
+            model.score(np.zeros((1, model.time_steps, 93), dtype=np.float32))
+            self._batchers[model.name] = MicroBatcher(model.score, max_batch_size, max_wait)
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._serving = False
+
+    def score(self, name, dynamic_features):
+        model = self._models[name]
+        dynamic_features = np.asarray(dynamic_features, dtype=np.float32)
+        if dynamic_features.ndim == 2:
+            dynamic_features = dynamic_features[np.newaxis]
+        # 不合法的请求在进入 MicroBatcher 之前拒绝，否则会使同一个batch中的其它请求一起失败
+        if dynamic_features.ndim != 3 or dynamic_features.shape[2] != 93:
+            raise ValueError("expected time_steps×93 or n×time_steps×93 features, got shape {}".format(
+                dynamic_features.shape))
+        if not 0 < dynamic_features.shape[1] <= model.time_steps:
+            raise ValueError("1 to {} visits per patient".format(model.time_steps))
+        padded = np.zeros((dynamic_features.shape[0], model.time_steps, dynamic_features.shape[2]), dtype=np.float32)
+        padded[:, :dynamic_features.shape[1]] = dynamic_features
+        return self._batchers[name].submit(padded)
+
+    def statistics(self):
+        return {name: batcher.statistics() for name, batcher in self._batchers.items()}
+
+    def _handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/stats":
+                    return self._reply(404, {"error": "unknown path"})
+                self._reply(200, service.statistics())
+
+            def do_POST(self):
+                name = self.path[len("/score/"):]
+                if not self.path.startswith("/score/") or name not in service._models:
+                    return self._reply(404, {"error": "unknown model"})
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                    prediction = service.score(name, body["dynamic_features"])
+                except (ValueError, KeyError, TypeError, IndexError) as e:
+                    return self._reply(400, {"error": str(e)})
+                except Exception as e:
+                    return self._reply(500, {"error": str(e)})
+                self._reply(200, {"prediction": prediction.tolist()})
+
+            def _reply(self, status, content):
+                data = json.dumps(content).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def serve_forever(self):
+        print("serving {} on http://{}:{}".format(list(self._models), *self._server.server_address[:2]),
+              time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
+        self._serving = True
+        self._server.serve_forever()
+
+    def close(self):
+        # 没有 serve_forever 时 shutdown 会一直等待
+        if self._serving:
+            self._server.shutdown()
+        self._server.server_close()
+        for batcher in self._batchers.values():
+            batcher.close()
+
+
+if __name__ == '__main__':
+    import sys
+    from models import AttentionLSTMModel
+    # python serving.py save_net10-17-19-02-53.ckpt
+    model = AttentionLSTMModel(time_steps=5, num_features=92, lstm_size=128, n_output=1, dropout=1.0)
+    model.restore(sys.argv[1])
+    service = ScoringService([model])
+    try:
+        service.serve_forever()
+    finally:
+        print(service.statistics())
+        service.close()
@@ -0,0 +1,133 @@
+import numpy as np
+import pytest
+from data import DataSet, BucketedDataSet, StreamingDataSet, CompactFeatures, RaggedVisits, take_rows, write_shards
+
+
+def _padded(lengths, num_features=3, time_steps=4, seed=0):
+    # 前 length 次入院记录非零，其余为全零的padding
+    random_state = np.random.RandomState(seed)
+    padded = np.zeros((len(lengths), time_steps, num_features))
+    for i, length in enumerate(lengths):
+        padded[i, 0:length] = random_state.rand(length, num_features) + 1
+    return padded
+
+
+def _epoch_rows(data_set, batch_size):
+    # 取完一个epoch，返回每个batch中第0列的行号（batch是buffer的视图，先拷贝）
+    rows = []
+    while data_set.epoch_completed == 0:
+        dynamic_features, _ = data_set.next_batch(batch_size)
+        rows.append(np.array(dynamic_features[:, 0, 0]))
+    return np.concatenate(rows)
+
+
+def test_ragged_pad_round_trip_with_empty_last_patient():
+    lengths = [2, 4, 1, 0]
+    padded = _padded(lengths)
+    ragged = RaggedVisits.from_padded(padded)
+    np.testing.assert_array_equal(ragged.lengths, lengths)
+    np.testing.assert_array_equal(ragged.pad(4), padded)
+    np.testing.assert_array_equal(ragged.pad(4, np.array([3, 1])), padded[[3, 1]])
+    np.testing.assert_array_equal(ragged.patient(3), np.zeros((0, 3)))
+    # 超过 time_steps 的入院记录截掉
+    np.testing.assert_array_equal(ragged.pad(2), padded[:, 0:2])
+    np.testing.assert_array_equal(ragged.take(np.array([0, 3])).pad(4), padded[[0, 3]])
+
+
+def test_ragged_save_load(tmp_path):
+    padded = _padded([3, 0, 2])
+    file = str(tmp_path / "ragged.npz")
+    RaggedVisits.from_padded(padded).save(file)
+    np.testing.assert_array_equal(RaggedVisits.load(file).pad(4), padded)
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_compact_features_expand(packed):
+    random_state = np.random.RandomState(0)
+    dynamic_features = (random_state.rand(6, 5, 12) > 0.7).astype(np.float32)
+    dynamic_features[..., 0] = random_state.rand(6, 5)
+    compact = CompactFeatures.from_dense(dynamic_features, packed=packed)
+    assert compact.shape == dynamic_features.shape
+    assert len(compact) == 6
+    np.testing.assert_array_equal(compact.expand(), dynamic_features)
+    index = np.array([4, 0, 2])
+    np.testing.assert_array_equal(compact.expand(index), dynamic_features[index])
+    np.testing.assert_array_equal(compact.take(index).expand(), dynamic_features[index])
+    np.testing.assert_array_equal(take_rows(compact, index), dynamic_features[index])
+
+
+def test_compact_features_rejects_non_binary():
+    with pytest.raises(ValueError):
+        CompactFeatures.from_dense(np.full((2, 3, 4), 0.5))
+
+
+@pytest.mark.parametrize("index_batching", [False, True])
+def test_data_set_covers_every_row_once_per_epoch(index_batching):
+    dynamic_features = np.arange(23, dtype=np.float64).reshape(-1, 1, 1).repeat(3, axis=2)
+    labels = np.arange(23).reshape(-1, 1, 1)
+    data_set = DataSet(dynamic_features, labels, index_batching=index_batching)
+    rows = _epoch_rows(data_set, 5)
+    np.testing.assert_array_equal(np.sort(rows), np.arange(23))
+
+
+def test_data_set_subset_and_chunks():
+    dynamic_features = np.arange(20, dtype=np.float64).reshape(-1, 1, 1)
+    labels = np.arange(20).reshape(-1, 1)
+    index = np.array([7, 3, 12, 0, 19])
+    data_set = DataSet(dynamic_features, labels, index=index)
+    rows = _epoch_rows(data_set, 2)
+    np.testing.assert_array_equal(np.sort(rows), np.sort(index))
+    # chunks 与 dynamic_features/labels 的顺序相同
+    chunks = list(data_set.chunks(2))
+    assert [chunk[1].shape[0] for chunk in chunks] == [2, 2, 1]
+    np.testing.assert_array_equal(np.concatenate([chunk[0] for chunk in chunks]), data_set.dynamic_features)
+    np.testing.assert_array_equal(np.concatenate([chunk[1] for chunk in chunks]), data_set.labels)
+    np.testing.assert_array_equal(data_set.labels.reshape(-1), np.sort(index))
+
+
+def test_data_set_rejects_bad_index():
+    dynamic_features = np.zeros((5, 2, 3))
+    labels = np.zeros((5, 1))
+    for index in [np.array([0, 5]), np.array([-1, 2])]:
+        with pytest.raises(IndexError):
+            DataSet(dynamic_features, labels, index=index)
+    with pytest.raises(ValueError):
+        DataSet(dynamic_features, labels, index=np.array([0.0, 1.0]))
+    assert DataSet(dynamic_features, labels, index=np.array([], dtype=np.int64)).num_examples == 0
+
+
+def test_bucketed_data_set_groups_similar_lengths():
+    lengths = [1, 4, 2, 4, 1, 3, 2, 3, 1, 4]
+    padded = _padded(lengths)
+    # 第0次入院的第0列加上病人编号，用来找回每一行
+    padded[:, 0, 0] += np.arange(len(lengths)) * 10
+    labels = np.arange(len(lengths)).reshape(-1, 1)
+    data_set = BucketedDataSet(RaggedVisits.from_padded(padded), labels, time_steps=4)
+    patients = []
+    while data_set.epoch_completed == 0:
+        dynamic_features, batch_labels = data_set.next_batch(3)
+        batch = np.array(batch_labels).reshape(-1)
+        np.testing.assert_array_equal(dynamic_features, padded[batch])
+        patients.append(batch)
+    np.testing.assert_array_equal(np.sort(np.concatenate(patients)), np.arange(len(lengths)))
+    statistics = data_set.padding_statistics()
+    assert statistics["real_visits"] == sum(lengths)
+    assert statistics["efficiency"] >= statistics["full_padding_efficiency"]
+
+
+def test_streaming_data_set_covers_every_row_once_per_epoch(tmp_path):
+    dynamic_features = np.arange(25, dtype=np.float64).reshape(-1, 1, 1).repeat(2, axis=2)
+    labels = np.arange(25).reshape(-1, 1)
+    assert write_shards(dynamic_features, labels, str(tmp_path), shard_size=7) == 4
+    data_set = StreamingDataSet(str(tmp_path), window_shards=2, eval_size=10)
+    assert data_set.num_examples == 25
+    for epoch in range(2):
+        rows = []
+        while data_set.epoch_completed == epoch:
+            batch_features, batch_labels = data_set.next_batch(4)
+            np.testing.assert_array_equal(batch_features[:, 0, 0], batch_labels.reshape(-1))
+            rows.append(batch_labels.reshape(-1))
+        np.testing.assert_array_equal(np.sort(np.concatenate(rows)), np.arange(25))
+    # 评价用的样本是固定的
+    np.testing.assert_array_equal(data_set.labels, data_set.labels)
+    assert len(np.unique(data_set.labels)) == 10
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+# experiment 依赖 TensorFlow、lifelines 等，没有安装时跳过
+experiment = pytest.importorskip("experiment")
+
+
+def test_kfold_indices_matches_contiguous_folds():
+    # 不分层、不打乱时与原来按顺序切成5份相同
+    folds = experiment.kfold_indices(20, 5)
+    for i, (train_index, test_index) in enumerate(folds):
+        np.testing.assert_array_equal(test_index, np.arange(i * 4, (i + 1) * 4))
+        np.testing.assert_array_equal(train_index, np.setdiff1d(np.arange(20), test_index))
+    # 余下的样本依次分到前几折
+    folds = experiment.kfold_indices(22, 5)
+    assert [len(test_index) for _, test_index in folds] == [5, 5, 4, 4, 4]
+    np.testing.assert_array_equal(np.sort(np.concatenate([test_index for _, test_index in folds])), np.arange(22))
+
+
+def test_kfold_indices_groups_and_stratification():
+    events = np.zeros(50)
+    events[0:50:5] = 1
+    groups = np.arange(50) // 5
+    folds = experiment.kfold_indices(50, 5, events=events, groups=groups, shuffle=True, seed=0)
+    for train_index, test_index in folds:
+        assert not set(groups[train_index]) & set(groups[test_index])
+        assert events[test_index].sum() == 2
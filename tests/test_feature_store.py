@@ -0,0 +1,48 @@
+import multiprocessing
+import json
+import os
+import numpy as np
+from feature_store import FeatureStore
+
+
+def _put_many(root, prefix, n):
+    store = FeatureStore(root)
+    for i in range(n):
+        store.put("{}{}".format(prefix, i), np.arange(i + 1))
+
+
+def test_concurrent_puts_keep_all_entries(tmp_path):
+    # Pipeline 中的 features 和 labels 两步在不同的进程中同时 put
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=_put_many, args=(str(tmp_path), prefix, 20)) for prefix in ["a", "b"]]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    with open(os.path.join(str(tmp_path), FeatureStore.manifest_name)) as f:
+        manifest = json.load(f)
+    assert sorted(manifest) == sorted("{}{}".format(prefix, i) for prefix in ["a", "b"] for i in range(20))
+    store = FeatureStore(str(tmp_path))
+    np.testing.assert_array_equal(store.get("b19"), np.arange(20))
+
+
+def test_stale_when_source_or_upstream_changes(tmp_path):
+    root = str(tmp_path)
+    source = os.path.join(root, "source.csv")
+    with open(source, 'w') as f:
+        f.write("1,2\n")
+    store = FeatureStore(root)
+    assert store.put("features", np.arange(3), source=source) == 1
+    assert store.put("picked", np.arange(2), source=os.path.join(root, "features.npy")) == 1
+    # 内容不变时版本号不变
+    assert store.put("features", np.arange(3), source=source) == 1
+    assert not store.is_stale("features")
+    assert not store.is_stale("picked")
+    with open(source, 'w') as f:
+        f.write("1,2,3\n")
+    assert store.is_stale("features")
+    assert store.is_stale("picked")
+    assert store.put("features", np.arange(4), source=source) == 2
+    assert not store.is_stale("features")
+    assert store.is_stale("picked")
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from inference import NumpyAttentionLSTM, IncrementalScorer
+
+
+def _engine(num_features=92, lstm_size=8, n_output=2, seed=0):
+    random_state = np.random.RandomState(seed)
+
+    def weights(*shape):
+        return random_state.normal(scale=0.3, size=shape)
+
+    return NumpyAttentionLSTM(weights(num_features, num_features),
+                              {direction: weights(num_features + lstm_size, 4 * lstm_size)
+                               for direction in ("forward", "backward")},
+                              {direction: weights(4 * lstm_size) for direction in ("forward", "backward")},
+                              weights(2 * lstm_size, n_output),
+                              weights(n_output))
+
+
+def _patients(lengths, time_steps=5, seed=1):
+    # 第0列为时间，1:93 为0/1特征，超过 length 的就诊为全零的padding
+    random_state = np.random.RandomState(seed)
+    dynamic_features = np.zeros((len(lengths), time_steps, 93), dtype=np.float32)
+    for i, length in enumerate(lengths):
+        dynamic_features[i, 0:length, 0] = np.arange(1, length + 1)
+        dynamic_features[i, 0:length, 1:] = random_state.rand(length, 92) > 0.8
+        dynamic_features[i, 0:length, 1] = 1
+    return dynamic_features
+
+
+def test_padding_does_not_change_prediction():
+    engine = _engine()
+    dynamic_features = _patients([5, 2, 3])
+    pred = engine.predict(dynamic_features)
+    assert pred.shape == (3, 5, 2)
+    np.testing.assert_array_equal(pred[1, 2:], 0)
+    for i, length in enumerate([5, 2, 3]):
+        np.testing.assert_allclose(engine.predict(dynamic_features[i:i + 1, 0:length])[0], pred[i, 0:length],
+                                   rtol=1e-5, atol=1e-6)
+
+
+def test_incremental_scorer_matches_full_forward():
+    engine = _engine()
+    lengths = [5, 2, 3, 1]
+    dynamic_features = _patients(lengths)
+    scorer = IncrementalScorer(engine)
+    for step in range(max(lengths)):
+        patients = [i for i, length in enumerate(lengths) if step < length]
+        scores = scorer.append_visits(patients, dynamic_features[patients, step])
+        # 每次新增就诊后与重新计算整个病史的结果相同
+        for patient, score in zip(patients, scores):
+            expected = engine.predict(dynamic_features[patient:patient + 1, 0:step + 1])[0]
+            np.testing.assert_allclose(score, expected, rtol=1e-5, atol=1e-6)
+    pred, w_z = engine.forward(dynamic_features[:, :, 1:93])
+    for patient, score in enumerate(scorer.score(range(len(lengths)))):
+        np.testing.assert_allclose(score, pred[patient, 0:lengths[patient]], rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(scorer.attention(patient), w_z[patient, 0:lengths[patient]], rtol=1e-5)
+
+
+def test_incremental_scorer_rejects_bad_visits():
+    scorer = IncrementalScorer(_engine())
+    visits = _patients([1, 1])[:, 0]
+    with pytest.raises(ValueError):
+        scorer.append_visits([0, 0], visits)
+    with pytest.raises(ValueError):
+        scorer.append_visit(0, np.zeros(93))
+    assert 0 not in scorer
+
+
+def test_save_load(tmp_path):
+    engine = _engine()
+    file = str(tmp_path / "weights.npz")
+    engine.save(file)
+    dynamic_features = _patients([4, 2])
+    np.testing.assert_array_equal(NumpyAttentionLSTM.load(file).predict(dynamic_features),
+                                  engine.predict(dynamic_features))
@@ -0,0 +1,51 @@
+import pytest
+from pipeline import Pipeline, Stage
+
+
+def _copy(source, target):
+    with open(source, 'r') as f:
+        text = f.read()
+    with open(target, 'w') as f:
+        f.write(text + "+")
+
+
+def copy_raw():
+    _copy("raw.txt", "middle.txt")
+
+
+def copy_middle():
+    _copy("middle.txt", "final.txt")
+
+
+def _pipeline():
+    # 目标在子进程中按模块名 import，本文件所在的 tests 目录在 sys.path 中
+    return Pipeline([Stage("middle", "test_pipeline:copy_raw", ["raw.txt"], ["middle.txt"]),
+                     Stage("final", "test_pipeline:copy_middle", ["middle.txt"], ["final.txt"])],
+                    state_file="state.json", n_workers=2)
+
+
+def test_only_stale_stages_rerun(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "raw.txt").write_text("a")
+    pipeline = _pipeline()
+    assert pipeline.stale() == ["middle", "final"]
+    assert pipeline.run() == ["middle", "final"]
+    assert (tmp_path / "final.txt").read_text() == "a++"
+    # 新建的 Pipeline 从 state 文件读出上次的hash
+    assert _pipeline().stale() == []
+    assert _pipeline().run() == []
+    # 下游的输出被改动时只有下游过期
+    (tmp_path / "final.txt").write_text("edited")
+    assert _pipeline().stale() == ["final"]
+    assert _pipeline().run() == ["final"]
+    # 源文件改变时上游和下游都重新运行
+    (tmp_path / "raw.txt").write_text("bb")
+    assert _pipeline().stale() == ["middle", "final"]
+    assert _pipeline().run() == ["middle", "final"]
+    assert (tmp_path / "final.txt").read_text() == "bb++"
+
+
+def test_missing_input_fails(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(RuntimeError):
+        _pipeline().run()
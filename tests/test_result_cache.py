@@ -0,0 +1,34 @@
+import os
+import numpy as np
+from result_cache import ResultCache
+
+
+def test_key_depends_on_content(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    a = np.arange(10)
+    assert cache.key("model", a) == cache.key("model", a.copy())
+    assert cache.key("model", a) != cache.key("model", a[::-1].copy())
+    assert cache.key("model", a) != cache.key("model", a.astype(np.float32))
+    assert cache.key("model", a) != cache.key("other model", a)
+
+
+def test_put_get_and_evict(tmp_path):
+    root = str(tmp_path)
+    cache = ResultCache(root, max_bytes=1 << 40)
+    prediction = np.random.RandomState(0).rand(2000)
+    labels = np.zeros(2000, dtype=np.int32)
+    for i in range(3):
+        cache.put("key{}".format(i), prediction + i, labels)
+        # 条目的修改时间就是最近使用时间，显式给出先后
+        os.utime(os.path.join(root, "key{}".format(i)), (1000 + i, 1000 + i))
+    np.testing.assert_array_equal(cache.get("key1")[0], prediction + 1)
+    assert cache.get("missing") is None
+    entry_size = cache.evict() // 3
+    # key1 刚被读过，超过大小上限时先删除 key0，再删除 key2
+    assert ResultCache(root, max_bytes=2 * entry_size).evict() <= 2 * entry_size
+    assert cache.get("key0") is None
+    assert cache.get("key2") is not None
+    os.utime(os.path.join(root, "key2"), (1000, 1000))
+    ResultCache(root, max_bytes=entry_size).evict()
+    assert cache.get("key2") is None
+    np.testing.assert_array_equal(cache.get("key1")[1], labels)
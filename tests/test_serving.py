@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+from serving import ScoringService
+
+tf = pytest.importorskip("tensorflow")
+from models import AttentionLSTMModel
+
+
+def test_score_is_deterministic_with_dropout():
+    # 训练用的 dropout<1.0，预测时 keep_prob 为1.0，同一个病人每次得到相同的分数
+    model = AttentionLSTMModel(time_steps=5, num_features=92, lstm_size=8, n_output=1, dropout=0.5)
+    model.initialize()
+    dynamic_features = np.random.RandomState(0).rand(3, 5, 93).astype(np.float32)
+    np.testing.assert_array_equal(model.score(dynamic_features), model.score(dynamic_features))
+    service = ScoringService([model], port=0)
+    try:
+        np.testing.assert_array_equal(service.score(model.name, dynamic_features),
+                                      service.score(model.name, dynamic_features))
+    finally:
+        service.close()
+        model.close()